@@ -53,16 +53,41 @@
 import sys
 import math
 import random
+import bisect
+import heapq
+import collections
+import concurrent.futures
+import threading
+import queue
 import os
+import mmap
+import struct
 import time as chrono
 import csv
-from datetime import datetime
+import hashlib
+import json
+import io
+import gzip
+import bz2
+
+try:
+    # lzma is in the standard library, but Python is sometimes built without it
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    # NumPy is optional: if it's available some things run faster, but everything works without it
+    import numpy as np
+except ImportError:
+    np = None
 
 # a bunch of system constants (globals)
 bse_sys_minprice = 1                    # minimum price in the system, in cents/pennies
 bse_sys_maxprice = 500                  # maximum price in the system, in cents/pennies
 # ticksize should be a param of an exchange (so different exchanges can have different ticksizes)
 ticksize = 1  # minimum change in price, in cents/pennies
+verbose = False  # global verbosity flag: the __main__ block sets its own value
 
 
 # an Order/quote has a trader id, a type (buy/sell) price, quantity, timestamp, and unique i.d.
@@ -71,8 +96,11 @@ class Order:
     An Order: this is used both for client-orders from exogenous customers to the robot traders acting as sales traders,
     and for the trader-orders (aka quotes) sent by the robot traders to the BSE exchange.
     In both use-cases, an order has a trader-i.d., a type (buy/sell), price, quantity, timestamp, and unique quote-i.d.
+    Orders are created in huge numbers, so they have fixed __slots__ rather than a per-instance __dict__.
     """
 
+    __slots__ = ('tid', 'otype', 'price', 'qty', 'time', 'qid')
+
     def __init__(self, tid, otype, price, qty, time, qid):
         self.tid = tid  # trader i.d.
         self.otype = otype  # order type
@@ -90,6 +118,9 @@ class OrderbookHalf:
     """
     OrderbookHalf is one side of the book: a list of bids or a list of asks, each sorted best-price-first,
     and with orders at the same price arranged by arrival time (oldest first) for time-priority processing.
+    The book is maintained incrementally: a sorted list of the prices currently on the book is kept as an index
+    into the lob dictionary, each price-level holds its own queue of orders, and the best price/tid are cached,
+    so adding, overwriting, cancelling, or filling an order doesn't require rebuilding the whole book.
     """
 
     def __init__(self, booktype, worstprice):
@@ -104,8 +135,16 @@ class OrderbookHalf:
         self.orders = {}
         # limit order book, dictionary indexed by price, with order info
         self.lob = {}
-        # anonymized LOB, lists, with only price/qty info
+        # sorted list (lowest first) of the prices that are currently on the lob: the price-level index
+        self.prices = []
+        # queue-priority of each trader's order: set when the trader first gets an order on this side of the book;
+        # an overwrite keeps the trader's place in the queue at its (new) price
+        self.priority = {}
+        self.priority_counter = 0
+        # anonymized LOB, lists, with only price/qty info: rebuilt only when it is read after a change to the book
         self.lob_anon = []
+        # if not None, the set of prices whose levels have changed, kept for recording LOB deltas (LOBDeltaRecorder)
+        self.changed_prices = None
         # summary stats
         self.best_price = None
         self.best_tid = None
@@ -114,25 +153,104 @@ class OrderbookHalf:
         self.n_orders = 0  # how many orders?
         self.lob_depth = 0  # how many different prices on lob?
 
+    @property
+    def lob_anon(self):
+        """
+        The anonymized LOB, a list of [price, qty] items sorted lowest price first.
+        This is only rebuilt when it is read after the book has changed.
+        """
+        if self.lob_anon_stale:
+            self.anonymize_lob()
+        return self.lob_anon_list
+
+    @lob_anon.setter
+    def lob_anon(self, lob_anon_list):
+        self.lob_anon_list = lob_anon_list
+        self.lob_anon_stale = False
+
     def anonymize_lob(self):
         """
         anonymize a lob, strip out order details, format as a sorted list
         NB for asks, the sorting should be reversed
         :return: <nothing>
         """
-        self.lob_anon = []
-        for price in sorted(self.lob):
-            qty = self.lob[price][0]
-            self.lob_anon.append([price, qty])
+        self.lob_anon = [[price, self.lob[price][0]] for price in self.prices]
+
+    def update_best(self):
+        """
+        Update the cached best price and associated trader-id from the price-level index.
+        Also marks the anonymized LOB as needing to be rebuilt next time it is read.
+        :return: <nothing>
+        """
+        self.lob_depth = len(self.prices)
+        if self.lob_depth > 0:
+            if self.booktype == 'Bid':
+                self.best_price = self.prices[-1]
+            else:
+                self.best_price = self.prices[0]
+            self.best_tid = self.lob[self.best_price][1][0][2]
+        else:
+            self.best_price = None
+            self.best_tid = None
+        self.lob_anon_stale = True
+
+    def level_insert(self, order):
+        """
+        Insert an order into the queue at its price level, creating the level if it doesn't yet exist.
+        :param order: the order to be inserted, already recorded in self.orders and self.priority.
+        :return: <nothing>
+        """
+        price = order.price
+        entry = [order.time, order.qty, order.tid, order.qid]
+        if price in self.lob:
+            level = self.lob[price]
+            orderlist = level[1]
+            # new arrivals go on the back of the queue; an overwrite goes back into its old place
+            position = len(orderlist)
+            priority = self.priority[order.tid]
+            while position > 0 and self.priority[orderlist[position - 1][2]] > priority:
+                position -= 1
+            orderlist.insert(position, entry)
+            level[0] += order.qty
+        else:
+            self.lob[price] = [order.qty, [entry]]
+            bisect.insort(self.prices, price)
+        if self.changed_prices is not None:
+            self.changed_prices.add(price)
+
+    def level_remove(self, order):
+        """
+        Remove an order from the queue at its price level, deleting the level if it is then empty.
+        :param order: the order to be removed, as currently recorded in self.orders.
+        :return: <nothing>
+        """
+        price = order.price
+        level = self.lob[price]
+        orderlist = level[1]
+        for position in range(len(orderlist)):
+            if orderlist[position][2] == order.tid:
+                del (orderlist[position])
+                break
+        if len(orderlist) > 0:
+            level[0] -= order.qty
+        else:
+            del (self.lob[price])
+            del (self.prices[bisect.bisect_left(self.prices, price)])
+        if self.changed_prices is not None:
+            self.changed_prices.add(price)
 
     def build_lob(self):
         """
         Take a list of orders and build a limit-order-book (lob) from it
         NB the exchange needs to know arrival times and trader-id associated with each order
         also builds anonymized version (just price/quantity, sorted, as a list) for publishing to traders
+        The book is normally kept up to date incrementally, so this full rebuild is only needed to resync it.
         :return: lob as a dictionary (i.e., unsorted)
         """
         lob_verbose = False
+        if self.changed_prices is not None:
+            # any of the old price levels might change
+            self.changed_prices.update(self.lob)
         self.lob = {}
         for tid in self.orders:
             order = self.orders.get(tid)
@@ -146,18 +264,13 @@ class OrderbookHalf:
             else:
                 # create a new dictionary entry
                 self.lob[price] = [order.qty, [[order.time, order.qty, order.tid, order.qid]]]
+        self.prices = sorted(self.lob)
+        if self.changed_prices is not None:
+            self.changed_prices.update(self.prices)
+        # record best price and associated trader-id
+        self.update_best()
         # create anonymized version
         self.anonymize_lob()
-        # record best price and associated trader-id
-        if len(self.lob) > 0:
-            if self.booktype == 'Bid':
-                self.best_price = self.lob_anon[-1][0]
-            else:
-                self.best_price = self.lob_anon[0][0]
-            self.best_tid = self.lob[self.best_price][1][0][2]
-        else:
-            self.best_price = None
-            self.best_tid = None
 
         if lob_verbose:
             print(self.lob)
@@ -179,9 +292,16 @@ class OrderbookHalf:
 
         # add the order to the book
         n_orders = self.n_orders
+        if order.tid in self.orders:
+            # overwrite: take this trader's previous order off its price level
+            self.level_remove(self.orders[order.tid])
+        else:
+            self.priority[order.tid] = self.priority_counter
+            self.priority_counter += 1
         self.orders[order.tid] = order
         self.n_orders = len(self.orders)
-        self.build_lob()
+        self.level_insert(order)
+        self.update_best()
         # print('book_add < %s %s' % (order, self.orders))
         if n_orders != self.n_orders:
             return 'Addition'
@@ -197,9 +317,11 @@ class OrderbookHalf:
         :return: <nothing>
         """
         if self.orders.get(order.tid) is not None:
+            self.level_remove(self.orders[order.tid])
             del (self.orders[order.tid])
+            del (self.priority[order.tid])
             self.n_orders = len(self.orders)
-            self.build_lob()
+            self.update_best()
         # print('book_del %s', self.orders)
 
     def delete_best(self):
@@ -207,48 +329,494 @@ class OrderbookHalf:
         When the best bid/ask has been hit/lifted, delete it from the book.
         :return: TraderID of the deleted order is return-value, as counterparty to the trade.
         """
+        best_price_counterparty = self.best_tid
+        self.level_remove(self.orders[best_price_counterparty])
+        del (self.orders[best_price_counterparty])
+        del (self.priority[best_price_counterparty])
+        self.n_orders = self.n_orders - 1
+        self.update_best()
+        return best_price_counterparty
 
-        best_price_orders = self.lob[self.best_price]
-        best_price_qty = best_price_orders[0]
-        best_price_counterparty = best_price_orders[1][0][2]
-        if best_price_qty == 1:
-            # here the order deletes the best price
-            del (self.lob[self.best_price])
-            del (self.orders[best_price_counterparty])
-            self.n_orders = self.n_orders - 1
-            if self.n_orders > 0:
-                if self.booktype == 'Bid':
-                    self.best_price = max(self.lob.keys())
-                else:
-                    self.best_price = min(self.lob.keys())
-                self.lob_depth = len(self.lob.keys())
-            else:
-                self.best_price = self.worstprice
-                self.lob_depth = 0
+
+class TapeRecord:
+    """
+    Base class for the records of events that go on the tape (and, for trades, in the traders' blotters).
+    Like Order, these are slotted to keep them compact. BSE has always used dictionaries for these records, so the
+    fields can be read by key, e.g. trade['price'], as well as by attribute, e.g. trade.price.
+    """
+
+    __slots__ = ()
+    fields = ()     # the field names, in the order they were in the dictionaries
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        if key not in self.fields:
+            return default
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def keys(self):
+        return list(self.fields)
+
+    def __repr__(self):
+        return repr(dict((field, getattr(self, field)) for field in self.fields))
+
+
+class TradeRecord(TapeRecord):
+    """ The record of a trade """
+
+    __slots__ = ('time', 'price', 'party1', 'party2', 'qty')
+    fields = ('type', 'time', 'price', 'party1', 'party2', 'qty')
+    type = 'Trade'
+
+    def __init__(self, time, price, party1, party2, qty):
+        """
+        :param time: the time of the trade.
+        :param price: the transaction price.
+        :param party1: the trader-I.D. of the counterparty whose order was on the LOB.
+        :param party2: the trader-I.D. of the trader whose order crossed the spread.
+        :param qty: the quantity traded.
+        """
+        self.time = time
+        self.price = price
+        self.party1 = party1
+        self.party2 = party2
+        self.qty = qty
+
+
+class CancelRecord(TapeRecord):
+    """ The record of an order being cancelled """
+
+    __slots__ = ('time', 'order')
+    fields = ('type', 'time', 'order')
+    type = 'Cancel'
+
+    def __init__(self, time, order):
+        """
+        :param time: the time of the cancellation.
+        :param order: the order that was cancelled.
+        """
+        self.time = time
+        self.order = order
+
+
+class Tape:
+    """
+    The exchange's tape: a record of trades and cancellations, oldest first.
+    The most recent max_length events are held in memory in a ring buffer, so appending is O(1) however long the
+    session runs; the tape can be read like a list (len(), iteration, positive or negative indexing).
+    Events pushed out of the ring are discarded, unless a spill_filename is given, in which case they're written as
+    fixed-size records to a memory-mapped file and can still be read back, so the whole session's tape is kept.
+    """
+
+    # each spilled record is: type ('T' or 'C'), otype ('B', 'A', or ' '), time, price, qty, qid, order-time, party1,
+    # party2. For a trade party1 & party2 are the counterparty and the initiating trader; for a cancellation party1 is
+    # the tid on the cancelled order and the remaining fields are the order's details.
+    spill_format = '<ccddiqd16s16s'
+    spill_record_size = struct.calcsize(spill_format)
+    spill_chunk = 65536     # how many records the spill file grows by when it is full
+
+    def __init__(self, max_length, spill_filename=None):
+        """
+        Create an empty tape.
+        :param max_length: maximum number of events held in memory.
+        :param spill_filename: if not None, older events are spilled to this file instead of being discarded.
+        """
+        self.max_length = max_length
+        self.ring = [None] * max_length
+        self.start = 0          # position in the ring of the oldest in-memory event
+        self.n_ring = 0         # how many events are in the ring
+        self.n_spilled = 0      # how many events have been spilled to file
+        self.n_appended = 0     # how many events have ever been appended (since the tape was last cleared)
+        self.spill_file = None
+        self.spill_map = None
+        if spill_filename is not None:
+            self.spill_file = open(spill_filename, 'w+b')
+            self.spill_file.truncate(self.spill_chunk * self.spill_record_size)
+            self.spill_map = mmap.mmap(self.spill_file.fileno(), self.spill_chunk * self.spill_record_size)
+
+    def __len__(self):
+        return self.n_spilled + self.n_ring
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __reversed__(self):
+        # newest first: walk back through the ring and then (if need be) the spill file
+        for i in range(self.n_ring - 1, -1, -1):
+            yield self.ring[(self.start + i) % self.max_length]
+        for i in range(self.n_spilled - 1, -1, -1):
+            yield self.unspill(i)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if -self.n_ring <= index < 0:
+            # the common case: looking back from the most recent event, within the in-memory ring
+            return self.ring[(self.start + self.n_ring + index) % self.max_length]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('tape index out of range')
+        if index < self.n_spilled:
+            return self.unspill(index)
+        return self.ring[(self.start + index - self.n_spilled) % self.max_length]
+
+    def append(self, item):
+        """
+        Add an event to the end of the tape: if the ring is full, the oldest event is spilled or discarded.
+        :param item: the trade or cancellation record.
+        :return: <nothing>
+        """
+        self.n_appended += 1
+        if self.n_ring < self.max_length:
+            self.ring[(self.start + self.n_ring) % self.max_length] = item
+            self.n_ring += 1
         else:
-            # best_bid_qty>1 so the order decrements the quantity of the best bid
-            # update the lob with the decremented order data
-            self.lob[self.best_price] = [best_price_qty - 1, best_price_orders[1][1:]]
-
-            # update the bid list: counterparty's bid has been deleted
-            del (self.orders[best_price_counterparty])
-            self.n_orders = self.n_orders - 1
-        self.build_lob()
-        return best_price_counterparty
+            if self.spill_map is not None:
+                self.spill(self.ring[self.start])
+            self.ring[self.start] = item
+            self.start = (self.start + 1) % self.max_length
+
+    def clear(self):
+        """ Wipe the tape clean, including any events spilled to file """
+        self.ring = [None] * self.max_length
+        self.start = 0
+        self.n_ring = 0
+        self.n_spilled = 0
+        self.n_appended = 0
+
+    def spill(self, item):
+        """
+        Write an event out to the next free record in the memory-mapped spill file, growing the file if it is full.
+        :param item: the trade or cancellation record.
+        :return: <nothing>
+        """
+        offset = self.n_spilled * self.spill_record_size
+        if offset + self.spill_record_size > len(self.spill_map):
+            new_size = len(self.spill_map) + self.spill_chunk * self.spill_record_size
+            self.spill_map.close()
+            self.spill_file.truncate(new_size)
+            self.spill_map = mmap.mmap(self.spill_file.fileno(), new_size)
+        if item['type'] == 'Trade':
+            record = (b'T', b' ', item['time'], item['price'], item['qty'], 0, 0.0,
+                      item['party1'].encode(), item['party2'].encode())
+        else:
+            order = item['order']
+            record = (b'C', order.otype[0].encode(), item['time'], order.price, order.qty, order.qid, order.time,
+                      order.tid.encode(), b'')
+        struct.pack_into(self.spill_format, self.spill_map, offset, *record)
+        self.n_spilled += 1
+
+    def unspill(self, index):
+        """
+        Read an event back from the spill file.
+        :param index: the position of the event on the tape.
+        :return: the trade or cancellation record.
+        """
+        (etype, otype, time, price, qty, qid, otime, party1, party2) = \
+            struct.unpack_from(self.spill_format, self.spill_map, index * self.spill_record_size)
+        if price == int(price):
+            price = int(price)
+        if etype == b'T':
+            return TradeRecord(time, price, party1.rstrip(b'\0').decode(), party2.rstrip(b'\0').decode(), qty)
+        if otype == b'B':
+            otype = 'Bid'
+        else:
+            otype = 'Ask'
+        order = Order(party1.rstrip(b'\0').decode(), otype, price, qty, otime, qid)
+        return CancelRecord(time, order)
+
+    def close(self):
+        """ Close the spill file (if there is one), trimming it to just the records written """
+        if self.spill_map is not None:
+            self.spill_map.flush()
+            self.spill_map.close()
+            self.spill_map = None
+            self.spill_file.truncate(self.n_spilled * self.spill_record_size)
+            self.spill_file.close()
+            self.spill_file = None
+
+
+class RollingTradeStats:
+    """
+    Rolling statistics of recent trade prices, maintained by the exchange as trades happen, so that traders can read
+    (e.g.) the average price of the last n trades in O(1) time instead of searching back through the tape for them.
+    The statistics are kept for windows of the last n trades, for whatever values of n traders ask for: the first
+    time a window-length is asked for, its window is filled from the tape, and from then on it's updated incrementally.
+    Available for each window-length n: the last n prices, their simple moving average (SMA), their volume-weighted
+    average price (VWAP), and an exponential moving average (EMA) over all trades with smoothing factor 2/(n+1).
+    Only trades still on the tape count, so if fewer than n trades are on the tape the stats for n are None.
+    """
+
+    def __init__(self, tape):
+        """
+        Create the rolling stats for an exchange's tape.
+        :param tape: the exchange's Tape, which the windows are filled from when first created.
+        """
+        self.tape = tape
+        # windows of recent trades, indexed by window-length n: each is
+        # [deque of [tape_position, price, qty], sum of prices, sum of price*qty, sum of qty]
+        self.windows = {}
+        # exponential moving averages, indexed by n
+        self.emas = {}
+
+    def window(self, n):
+        """
+        Get the window of the last n trades, creating it from the tape if this is the first time n has been asked for.
+        :param n: the window-length.
+        :return: the window.
+        """
+        window = self.windows.get(n)
+        if window is None:
+            trades = collections.deque(maxlen=n)
+            position = self.tape.n_appended
+            for tape_item in reversed(self.tape):
+                position -= 1
+                if tape_item['type'] == 'Trade':
+                    trades.appendleft([position, tape_item['price'], tape_item['qty']])
+                    if len(trades) == n:
+                        break
+            window = [trades,
+                      sum(trade[1] for trade in trades),
+                      sum(trade[1] * trade[2] for trade in trades),
+                      sum(trade[2] for trade in trades)]
+            self.windows[n] = window
+        return window
+
+    def add_trade(self, trade):
+        """
+        Update all the windows and EMAs with a new trade, which has just been appended to the tape.
+        :param trade: the transaction record.
+        :return: <nothing>
+        """
+        position = self.tape.n_appended - 1
+        price = trade['price']
+        qty = trade['qty']
+        for n in self.windows:
+            window = self.windows[n]
+            trades = window[0]
+            if len(trades) == n:
+                # the oldest trade drops out of the window
+                oldest = trades[0]
+                window[1] -= oldest[1]
+                window[2] -= oldest[1] * oldest[2]
+                window[3] -= oldest[2]
+            trades.append([position, price, qty])
+            window[1] += price
+            window[2] += price * qty
+            window[3] += qty
+        for n in self.emas:
+            if self.emas[n] is None:
+                self.emas[n] = price
+            else:
+                alpha = 2.0 / (n + 1)
+                self.emas[n] = alpha * price + (1.0 - alpha) * self.emas[n]
+
+    def clear(self):
+        """ Forget all trades, e.g. because the tape has been wiped """
+        self.windows = {}
+        self.emas = {}
+
+    def trade_index(self, n):
+        """
+        Where on the tape is the n'th most recent trade?
+        :param n: the window-length.
+        :return: the index on the tape of the oldest of the last n trades, or None if there aren't n trades on the tape.
+        """
+        trades = self.window(n)[0]
+        if len(trades) < n:
+            return None
+        index = trades[0][0] - (self.tape.n_appended - len(self.tape))
+        if index < 0:
+            return None
+        return index
+
+    def last_prices(self, n):
+        """
+        :param n: the window-length.
+        :return: the prices of the last n trades, oldest first, or None if there aren't n trades on the tape.
+        """
+        if self.trade_index(n) is None:
+            return None
+        return [trade[1] for trade in self.windows[n][0]]
+
+    def sma(self, n):
+        """
+        :param n: the window-length.
+        :return: the simple moving average of the last n trade prices, or None if there aren't n trades on the tape.
+        """
+        if self.trade_index(n) is None:
+            return None
+        return self.windows[n][1] / n
+
+    def vwap(self, n):
+        """
+        :param n: the window-length.
+        :return: the volume-weighted average price of the last n trades, or None if there aren't n trades on the tape.
+        """
+        if self.trade_index(n) is None:
+            return None
+        return self.windows[n][2] / self.windows[n][3]
+
+    def ema(self, n):
+        """
+        :param n: the window-length, which sets the EMA's smoothing factor to 2/(n+1).
+        :return: the exponential moving average of trade prices, or None if there are no trades on the tape.
+        """
+        if n not in self.emas:
+            ema = None
+            alpha = 2.0 / (n + 1)
+            for tape_item in self.tape:
+                if tape_item['type'] == 'Trade':
+                    if ema is None:
+                        ema = tape_item['price']
+                    else:
+                        ema = alpha * tape_item['price'] + (1.0 - alpha) * ema
+            self.emas[n] = ema
+        return self.emas[n]
 
 
 class Orderbook(OrderbookHalf):
     """ Orderbook for a single tradeable asset: list of bids and list of asks """
 
-    def __init__(self):
-        """Construct a new orderbook"""
+    def __init__(self, tape_spill_filename=None):
+        """
+        Construct a new orderbook
+        :param tape_spill_filename: if not None, tape events too old to keep in memory are spilled to this file.
+        """
 
         self.bids = OrderbookHalf('Bid', bse_sys_minprice)
         self.asks = OrderbookHalf('Ask', bse_sys_maxprice)
-        self.tape = []
         self.tape_length = 10000    # max events on in-memory tape (older events can be written to tape_dump file)
+        self.tape = Tape(self.tape_length, tape_spill_filename)
+        self.rolling_stats = RollingTradeStats(self.tape)   # rolling statistics of recent trade prices
         self.quote_id = 0           # unique ID code for each quote accepted onto the book
         self.lob_string = ''        # character-string linearization of public lob items with nonzero quantities
+        self.lob_version = 0        # incremented whenever the book or tape changes
+        self.lob_snapshot = None    # most recently published LOB data
+        self.lob_sides = None       # published bid & ask data for the current lob_version: [version, bids, asks]
+        self.lob_frame_version = None   # lob_version when lob_string was last brought up to date
+        self.lob_levels = None      # the LOB prices & quantities in the last frame written to a ColumnStore
+        self.tape_decimator = None  # if not None, the Decimator for trades written to the tape file
+        self.lob_decimator = None   # if not None, the Decimator for frames written to the LOB frames file
+        self.feed_top = (None, None, None, None)    # best bid & ask prices and quantities, at last market_events()
+        self.feed_trade = False     # has there been a trade since the last call to market_events()?
+        self.feed_cancel = False    # has there been a cancellation since the last call to market_events()?
+
+
+class StaleLOBSnapshot(Exception):
+    """
+    Raised when a published LOB snapshot's depth list is first read after the book has changed without the
+    exchange knowing, e.g. by altering its OrderbookHalf directly rather than through Exchange.add_order() etc.:
+    the depth lists are only built when read, so they can't be built for a version of the book that no longer exists.
+    NB the exchange builds any unread depth lists of its latest snapshot before it changes the book, so traders
+    that hang on to old LOB data still see the depth as it was when the snapshot was published.
+    """
+    pass
+
+
+class PublishedLOB(dict):
+    """
+    A read-only dictionary, used for the LOB data published by the exchange: the same snapshot can be handed out
+    again and again for as long as the book is unchanged, so nobody is allowed to alter it.
+    Any items named in lazy_items are only computed (by calling the associated function) the first time they're read;
+    iterating over the snapshot (keys(), items(), printing it, etc.) computes them all.
+    """
+
+    def __init__(self, items, lazy_items=None):
+        """
+        Create the snapshot.
+        :param items: dictionary of the items that are known now.
+        :param lazy_items: dictionary of functions (taking no arguments) that compute the remaining items when needed.
+        """
+        dict.__init__(self, items)
+        if lazy_items is None:
+            lazy_items = {}
+        self.lazy_items = lazy_items
+
+    def __missing__(self, key):
+        if key in self.lazy_items:
+            value = self.lazy_items[key]()
+            del self.lazy_items[key]
+            dict.__setitem__(self, key, value)
+            return value
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.lazy_items
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def materialize(self):
+        """ Compute all the lazy items that haven't been read yet """
+        for key in list(self.lazy_items):
+            self[key]
+
+    def __len__(self):
+        return dict.__len__(self) + len(self.lazy_items)
+
+    def __iter__(self):
+        self.materialize()
+        return dict.__iter__(self)
+
+    def keys(self):
+        self.materialize()
+        return dict.keys(self)
+
+    def values(self):
+        self.materialize()
+        return dict.values(self)
+
+    def items(self):
+        self.materialize()
+        return dict.items(self)
+
+    def copy(self):
+        """ A plain (alterable) dictionary of all the items """
+        self.materialize()
+        return dict(dict.items(self))
+
+    def __repr__(self):
+        self.materialize()
+        return dict.__repr__(self)
+
+    def __eq__(self, other):
+        self.materialize()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        self.materialize()
+        return dict.__ne__(self, other)
+
+    def __or__(self, other):
+        return self.copy() | other
+
+    def __ror__(self, other):
+        return dict(other) | self.copy()
+
+    def read_only(self, *args, **kwargs):
+        """ any attempt to alter the snapshot is an error"""
+        raise TypeError('published LOB data is read-only')
+
+    __setitem__ = read_only
+    __delitem__ = read_only
+    clear = read_only
+    pop = read_only
+    popitem = read_only
+    setdefault = read_only
+    update = read_only
+    __ior__ = read_only
 
 
 class Exchange(Orderbook):
@@ -264,18 +832,14 @@ class Exchange(Orderbook):
         # add a quote/order to the exchange and update all internal records; return unique i.d.
         order.qid = self.quote_id
         self.quote_id = order.qid + 1
+        self.new_lob_version()
         if vrbs:
             print('add_order QID=%d self.quote.id=%d' % (order.qid, self.quote_id))
+        # NB book_add() keeps the best price and best tid up to date
         if order.otype == 'Bid':
             response = self.bids.book_add(order)
-            best_price = self.bids.lob_anon[-1][0]
-            self.bids.best_price = best_price
-            self.bids.best_tid = self.bids.lob[best_price][1][0][2]
         else:
             response = self.asks.book_add(order)
-            best_price = self.asks.lob_anon[0][0]
-            self.asks.best_price = best_price
-            self.asks.best_tid = self.asks.lob[best_price][1][0][2]
         return [order.qid, response]
 
     def del_order(self, time, order, tape_file, vrbs):
@@ -290,38 +854,28 @@ class Exchange(Orderbook):
         # delete a trader's quote/order from the exchange, update all internal records
         if vrbs:
             print('del_order QID=%d' % order.qid)
+        self.new_lob_version()
+        self.feed_cancel = True
         if order.otype == 'Bid':
             self.bids.book_del(order)
-            if self.bids.n_orders > 0:
-                best_price = self.bids.lob_anon[-1][0]
-                self.bids.best_price = best_price
-                self.bids.best_tid = self.bids.lob[best_price][1][0][2]
-            else:  # this side of book is empty
-                self.bids.best_price = None
-                self.bids.best_tid = None
-            cancel_record = {'type': 'Cancel', 'time': time, 'order': order}
-            if tape_file is not None:
+            cancel_record = CancelRecord(time, order)
+            if isinstance(tape_file, ColumnStore):
+                tape_file.append('events', ('CAN', time, order.price, order.qid, 'Bid'))
+            elif tape_file is not None:
                 tape_file.write('CAN, %f, %d, Bid, %d\n' % (time, order.qid, order.price))
+            # NB the tape keeps only the most recent items in memory
             self.tape.append(cancel_record)
-            # right-truncate the tape so that it keeps only the most recent items
-            self.tape = self.tape[-self.tape_length:]
 
         elif order.otype == 'Ask':
             self.asks.book_del(order)
-            if self.asks.n_orders > 0:
-                best_price = self.asks.lob_anon[0][0]
-                self.asks.best_price = best_price
-                self.asks.best_tid = self.asks.lob[best_price][1][0][2]
-            else:  # this side of book is empty
-                self.asks.best_price = None
-                self.asks.best_tid = None
-            
-            cancel_record = {'type': 'Cancel', 'time': time, 'order': order}
-            if tape_file is not None:
+
+            cancel_record = CancelRecord(time, order)
+            if isinstance(tape_file, ColumnStore):
+                tape_file.append('events', ('CAN', time, order.price, order.qid, 'Ask'))
+            elif tape_file is not None:
                 tape_file.write('CAN, %f, %d, Ask, %d\n' % (time, order.qid, order.price))
+            # NB the tape keeps only the most recent items in memory
             self.tape.append(cancel_record)
-            # right-truncate the tape so that it keeps only the most recent items
-            self.tape = self.tape[-self.tape_length:]
         else:
             # neither bid nor ask?
             sys.exit('bad order type in del_quote()')
@@ -387,23 +941,63 @@ class Exchange(Orderbook):
             # process the trade
             if vrbs:
                 print('>>>>>>>>>>>>>>>>>TRADE t=%010.3f $%d %s %s' % (time, price, counterparty, order.tid))
-            transaction_record = {'type': 'Trade',
-                                  'time': time,
-                                  'price': price,
-                                  'party1': counterparty,
-                                  'party2': order.tid,
-                                  'qty': order.qty
-                                  }
+            transaction_record = TradeRecord(time, price, counterparty, order.tid, order.qty)
+            self.new_lob_version()
+            self.feed_trade = True
             if tape_file is not None:
-                tape_file.write('TRD, %f, %d\n' % (time, price))
+                if self.tape_decimator is not None:
+                    self.write_trades(tape_file, self.tape_decimator.add(time, (price,)))
+                else:
+                    self.write_trades(tape_file, [(time, (price,), None)])
+            # NB the tape keeps only the most recent items in memory
             self.tape.append(transaction_record)
-            # right-truncate the tape so that it keeps only the most recent items
-            self.tape = self.tape[-self.tape_length:]
+            self.rolling_stats.add_trade(transaction_record)
 
             return transaction_record
         else:
             return None
 
+    def write_trades(self, tape_file, trades):
+        """
+        Write trades to the tape file.
+        :param tape_file: the tape file (or a ColumnStore).
+        :param trades: a list of the trades, each (time, (price,), None), as returned by a Decimator.
+        :return: <nothing>
+        """
+        for (time, (price,), _) in trades:
+            if isinstance(tape_file, ColumnStore):
+                tape_file.append('events', ('TRD', time, price, -1, ''))
+            else:
+                tape_file.write('TRD, %f, %d\n' % (time, price))
+
+    def write_lob_frames(self, lob_file, frames):
+        """
+        Write frames to the LOB frames file.
+        :param lob_file: the LOB frames file (or a ColumnStore).
+        :param frames: a list of the frames, each (time, values, frame), as returned by a Decimator: for a ColumnStore
+                       the frame is (bid levels, ask levels), otherwise it's the frame's character-string.
+        :return: <nothing>
+        """
+        for (time, _, frame) in frames:
+            if isinstance(lob_file, ColumnStore):
+                lob_file.append('frames', (time, len(frame[0]), len(frame[1])))
+                lob_file.extend('levels', frame[0])
+                lob_file.extend('levels', frame[1])
+            else:
+                lob_file.write('%.3f, %s\n' % (time, frame))
+
+    def flush_decimators(self, tape_file, lob_file):
+        """
+        At the end of the session, write whatever the tape and LOB frames Decimators (if any) have held back.
+        :param tape_file: the tape file (or None).
+        :param lob_file: the LOB frames file (or None).
+        :return: <nothing>
+        """
+        if self.tape_decimator is not None and tape_file is not None:
+            self.write_trades(tape_file, self.tape_decimator.flush())
+        if self.lob_decimator is not None and lob_file is not None:
+            self.write_lob_frames(lob_file, self.lob_decimator.flush())
+
     def tape_dump(self, fname, fmode, tmode):
         """
         Currently tape_dump only writes a list of transactions (i.e., it ignores any cancellations)
@@ -419,59 +1013,106 @@ class Exchange(Orderbook):
                 dumpfile.write('Trd, %010.3f, %s\n' % (tapeitem['time'], tapeitem['price']))
         dumpfile.close()
         if tmode == 'wipe':
-            self.tape = []
+            self.tape.clear()
+            self.rolling_stats.clear()
+            self.new_lob_version()
+
+    def new_lob_version(self):
+        """
+        Move on to a new lob_version, because the book or tape is about to change.
+        First, any depth lists of the snapshot published at the current lob_version that haven't been read yet are
+        built, while the book is still as it was: so a trader that holds on to that snapshot can still read its depth.
+        :return: <nothing>
+        """
+        if self.lob_sides is not None and self.lob_sides[0] == self.lob_version:
+            self.lob_sides[1].materialize()
+            self.lob_sides[2].materialize()
+        self.lob_version += 1
+
+    def published_depth(self, half, version):
+        """
+        Return the anonymized depth list for one side of the book, for a snapshot published at a given lob_version.
+        :param half: the OrderbookHalf (self.bids or self.asks).
+        :param version: the lob_version of the snapshot asking for it.
+        :return: the lob_anon list for that side of the book.
+        :raises StaleLOBSnapshot: if the book has changed since the snapshot was published (without new_lob_version()).
+        """
+        if version != self.lob_version:
+            # the book has changed since the snapshot was published, so its depth can't be reconstructed
+            raise StaleLOBSnapshot('LOB depth read from a snapshot published at lob_version %d, now %d' %
+                                   (version, self.lob_version))
+        return half.lob_anon
 
     def publish_lob(self, time, lob_file, vrbs):
         """
         Returns the public LOB data published by the exchange, 
         i.e. the version of the LOB that's accessible to the traders.
+        The data is cached: for as long as the book and tape are unchanged (i.e., same lob_version) the same read-only
+        snapshot is returned (or, if the time has moved on, a new snapshot that shares all the unchanged data);
+        the depth lists ['bids']['lob'] and ['asks']['lob'] are only built the first time they are read, or (if they
+        haven't been read) just before the book next changes, so an old snapshot still has the depth it was
+        published with.
         :param time: the current time.
-        :param lob_file: 
+        :param lob_file: if not None, then write a new frame to this file whenever the LOB changes.
         :param vrbs: verbosity: if True, print a running commentary; if False, stay silent.
         :return: the public LOB data.
         """
-        public_data = dict()
-        public_data['time'] = time
-        public_data['bids'] = {'best': self.bids.best_price,
-                               'worst': self.bids.worstprice,
-                               'n': self.bids.n_orders,
-                               'lob': self.bids.lob_anon}
-        public_data['asks'] = {'best': self.asks.best_price,
-                               'worst': self.asks.worstprice,
-                               'sess_hi': self.asks.session_extreme,
-                               'n': self.asks.n_orders,
-                               'lob': self.asks.lob_anon}
-        public_data['QID'] = self.quote_id
-        public_data['tape'] = self.tape
-
-        if lob_file is not None:
+        version = self.lob_version
+
+        if self.lob_sides is None or self.lob_sides[0] != version:
+            bids = PublishedLOB({'best': self.bids.best_price,
+                                 'worst': self.bids.worstprice,
+                                 'n': self.bids.n_orders},
+                                {'lob': lambda: self.published_depth(self.bids, version)})
+            asks = PublishedLOB({'best': self.asks.best_price,
+                                 'worst': self.asks.worstprice,
+                                 'sess_hi': self.asks.session_extreme,
+                                 'n': self.asks.n_orders},
+                                {'lob': lambda: self.published_depth(self.asks, version)})
+            self.lob_sides = [version, bids, asks]
+            self.lob_snapshot = None
+
+        if self.lob_snapshot is None or self.lob_snapshot['time'] != time:
+            self.lob_snapshot = PublishedLOB({'time': time,
+                                              'bids': self.lob_sides[1],
+                                              'asks': self.lob_sides[2],
+                                              'QID': self.quote_id,
+                                              'tape': self.tape,
+                                              'rolling_stats': self.rolling_stats})
+        public_data = self.lob_snapshot
+
+        if isinstance(lob_file, ColumnStore) and self.lob_frame_version != version:
+            # binary output: write a frame of the prices & quantities if they're different to the last frame written
+            levels = (self.bids.lob_anon, self.asks.lob_anon)
+            if levels != self.lob_levels:
+                if self.lob_decimator is not None:
+                    frames = self.lob_decimator.add(time, (self.bids.best_price, self.asks.best_price), levels)
+                else:
+                    frames = [(time, None, levels)]
+                self.write_lob_frames(lob_file, frames)
+                # NB the lob_anon lists are replaced, not altered, when the LOB changes, so it's OK to keep them
+                self.lob_levels = levels
+            self.lob_frame_version = version
+
+        elif isinstance(lob_file, LOBDeltaRecorder) and self.lob_frame_version != version:
+            # delta-encoded output: the recorder writes just the price levels that have changed
+            lob_file.record(time, self.bids, self.asks)
+            self.lob_frame_version = version
+
+        elif lob_file is not None and self.lob_frame_version != version:
             # build a linear character-string summary of only those prices on LOB with nonzero quantities
-            lobstring = 'Bid:,'
-            n_bids = len(self.bids.lob_anon)
-            if n_bids > 0:
-                lobstring += '%d,' % n_bids
-                for lobitem in self.bids.lob_anon:
-                    price_str = '%d,' % lobitem[0]
-                    qty_str = '%d,' % lobitem[1]
-                    lobstring = lobstring + price_str + qty_str
-            else:
-                lobstring += '0,'
-            lobstring += 'Ask:,'
-            n_asks = len(self.asks.lob_anon)
-            if n_asks > 0:
-                lobstring += '%d,' % n_asks
-                for lobitem in self.asks.lob_anon:
-                    price_str = '%d,' % lobitem[0]
-                    qty_str = '%d,' % lobitem[1]
-                    lobstring = lobstring + price_str + qty_str
-            else:
-                lobstring += '0,'
+            lobstring = lob_frame_string(self.bids.lob_anon, self.asks.lob_anon)
             # is this different to the last lob_string?
             if lobstring != self.lob_string:
                 # write it
-                lob_file.write('%.3f, %s\n' % (time, lobstring))
+                if self.lob_decimator is not None:
+                    frames = self.lob_decimator.add(time, (self.bids.best_price, self.asks.best_price), lobstring)
+                else:
+                    frames = [(time, None, lobstring)]
+                self.write_lob_frames(lob_file, frames)
                 # remember it
                 self.lob_string = lobstring
+            self.lob_frame_version = version
 
         if vrbs:
             vstr = 'publish_lob: t=%f' % time
@@ -483,6 +1124,41 @@ class Exchange(Orderbook):
 
         return public_data
 
+    def market_events(self):
+        """
+        The exchange's change feed: which kinds of market event have happened since the last call to this method.
+        The event types are:
+            'best_bid' -- the best bid price, or the quantity at that price, has changed (including bids emptying);
+            'best_ask' -- likewise for the best ask;
+            'trade' -- a trade has taken place;
+            'cancel' -- an order has been cancelled.
+        :return: the set of event types that have happened (empty if, e.g., an order was added behind the best price).
+        """
+        if self.bids.best_price is None:
+            bid_top = (None, None)
+        else:
+            bid_top = (self.bids.best_price, self.bids.lob[self.bids.best_price][0])
+        if self.asks.best_price is None:
+            ask_top = (None, None)
+        else:
+            ask_top = (self.asks.best_price, self.asks.lob[self.asks.best_price][0])
+        top = bid_top + ask_top
+
+        events = set()
+        if top[0:2] != self.feed_top[0:2]:
+            events.add('best_bid')
+        if top[2:4] != self.feed_top[2:4]:
+            events.add('best_ask')
+        if self.feed_trade:
+            events.add('trade')
+        if self.feed_cancel:
+            events.add('cancel')
+
+        self.feed_top = top
+        self.feed_trade = False
+        self.feed_cancel = False
+        return events
+
 
 # #################--Traders below here--#############
 
@@ -490,7 +1166,26 @@ class Exchange(Orderbook):
 # Trader superclass
 # all Traders have a trader id, bank balance, blotter, and list of orders to execute
 class Trader:
-    """The parent class for all types of robot trader in BSE"""
+    """
+    The parent class for all types of robot trader in BSE
+    The attributes that all traders have are held in fixed __slots__, so a trader-type with no attributes of its own
+    (e.g. GVWY, ZIC) needs no per-instance __dict__, which matters in markets with very many traders.
+    """
+
+    __slots__ = ('ttype', 'tid', 'type_aggs', 'bank_balance', 'params', 'blotter', 'blotter_length', 'orders',
+                 'n_quotes', 'birthtime', 'profitpertime', 'profit_mintime', 'n_trades', 'lastquote', 'rng')
+
+    # the kinds of market event (see Exchange.market_events()) that make market_session() call this trader's
+    # respond(): None means respond after every order processed by the exchange, whatever happened.
+    # Trader-types that don't override respond() (GVWY, ZIC, SHVR, SNPR) set this to the empty set, so they are
+    # never called: all Trader.respond() does is refresh profitpertime, so NB for those types profitpertime is
+    # only what bookkeep() sets it to after each trade (balance divided by time alive, with no profit_mintime
+    # floor) rather than being refreshed by respond() after every event. Nothing else reads it but __str__().
+    respond_events = None
+
+    # True for trader-types whose respond() can give the trader an order of its own to work (e.g. PT1 and PT2),
+    # so that market_session()'s event engine knows it may have to wake the trader after it has responded
+    orders_self = False
 
     def __init__(self, ttype, tid, balance, params, time):
         """
@@ -504,7 +1199,8 @@ class Trader:
         """
         self.ttype = ttype          # what type / strategy this trader is
         self.tid = tid              # trader unique ID code
-        self.balance = balance      # money in the bank
+        self.type_aggs = None       # the TypeAggregates that this trader's balance is counted in, if any
+        self.bank_balance = balance     # money in the bank: read and written via the balance property
         self.params = params        # parameters/extras associated with this trader-type or individual trader.
         self.blotter = []           # record of trades executed
         self.blotter_length = 100   # maximum length of blotter
@@ -515,6 +1211,19 @@ class Trader:
         self.profit_mintime = 60    # minimum duration in seconds for calculating profitpertime
         self.n_trades = 0           # how many trades has this trader done?
         self.lastquote = None       # record of what its last quote was
+        self.rng = random           # source of random numbers in the hot paths: the random module, or a RandomStream
+
+    @property
+    def balance(self):
+        """ How much money the trader has in the bank """
+        return self.bank_balance
+
+    @balance.setter
+    def balance(self, balance):
+        # whatever changes the balance, keep the running total for this trader's type up to date
+        if self.type_aggs is not None:
+            self.type_aggs.balance_change(self.ttype, balance - self.bank_balance)
+        self.bank_balance = balance
 
     def __str__(self):
         """ return a character-string that summarises a trader """
@@ -625,12 +1334,47 @@ class Trader:
         self.profitpertime = self.profitpertime_update(time, self.birthtime, self.balance)
         return None
 
+    @classmethod
+    def respond_batch(cls, traders, time, lob, trade, vrbs):
+        """
+        Make all of a list of traders of this class respond to events in the market, in one call.
+        market_session() calls this rather than calling each trader's respond() itself, so that a trader class can
+        override it to batch up the work of responding for all its traders. This default just calls each trader's
+        respond() in turn -- unless the class hasn't overridden respond(), in which case all there is to do is
+        update each trader's profitpertime, which is done here directly.
+        :param traders: the list of traders, all of them instances of this class.
+        :param time: the current time.
+        :param lob: the current state of the LOB.
+        :param trade: details of most recent trade, if any.
+        :param vrbs: verbosity: if True, print a running commentary; if False, stay silent.
+        :return: True if any of the traders' respond() asked for a snapshot frame to be recorded; False otherwise.
+        """
+        if cls.respond is Trader.respond and cls.profitpertime_update is Trader.profitpertime_update:
+            # same as calling Trader.respond() for each trader, but without the function-call overheads
+            for trader in traders:
+                time_alive = time - trader.birthtime
+                if time_alive >= trader.profit_mintime:
+                    trader.profitpertime = trader.balance / time_alive
+                else:
+                    trader.profitpertime = trader.balance / trader.profit_mintime
+            return False
+
+        record_frame = False
+        for trader in traders:
+            if trader.respond(time, lob, trade, vrbs):
+                record_frame = True
+        return record_frame
+
 
 class TraderGiveaway(Trader):
     """
     Trader subclass Giveaway (GVWY): even dumber than a ZI-U: just give the deal away (but never make a loss)
     """
 
+    __slots__ = ()    # no attributes beyond those of Trader
+
+    respond_events = frozenset()    # see Trader.respond_events
+
     def getorder(self, time, countdown, lob):
         """
         Create this trader's order to be sent to the exchange.
@@ -661,6 +1405,10 @@ class TraderZIC(Trader):
     Trader subclass ZI-C: after Gode & Sunder 1993
     """
 
+    __slots__ = ()    # no attributes beyond those of Trader
+
+    respond_events = frozenset()    # see Trader.respond_events
+
     def getorder(self, time, countdown, lob):
         """
         Create this trader's order to be sent to the exchange.
@@ -683,9 +1431,9 @@ class TraderZIC(Trader):
             limit = self.orders[0].price
             otype = self.orders[0].otype
             if otype == 'Bid':
-                quoteprice = random.randint(int(minprice), int(limit))
+                quoteprice = self.rng.randint(int(minprice), int(limit))
             else:
-                quoteprice = random.randint(int(limit), int(maxprice))
+                quoteprice = self.rng.randint(int(limit), int(maxprice))
                 # NB should check it == 'Ask' and barf if not
             order = Order(self.tid, otype, quoteprice, self.orders[0].qty, time, qid)
             self.lastquote = order
@@ -698,6 +1446,10 @@ class TraderShaver(Trader):
     but if there is no best price, creates "stub quote" at system max/min
     """
 
+    __slots__ = ()    # no attributes beyond those of Trader
+
+    respond_events = frozenset()    # see Trader.respond_events
+
     def getorder(self, time, countdown, lob):
         """
         Create this trader's order to be sent to the exchange.
@@ -741,6 +1493,10 @@ class TraderSniper(Trader):
     then gets increasing aggressive, increasing "shave thickness" as time runs out
     """
 
+    __slots__ = ()    # no attributes beyond those of Trader
+
+    respond_events = frozenset()    # see Trader.respond_events
+
     def getorder(self, time, countdown, lob):
         """
         Create this trader's order to be sent to the exchange.
@@ -777,6 +1533,75 @@ class TraderSniper(Trader):
         return order
 
 
+class CDFLUTCache:
+    """
+    A bounded least-recently-used (LRU) cache of PRZI cumulative distribution function (CDF) look-up tables (LUTs),
+    keyed on (strategy, theta0, m, dirn, pmin, pmax): the arguments that the LUT is calculated from.
+    PRZI-family traders (PRZI, PRSH, PRDE) often need exactly the same LUT as each other, so they share one cache
+    (przi_lut_cache, below) rather than each calculating and storing its own copy. LUTs in the cache are shared,
+    so must never be altered. When the cache is full, the least recently used LUT is thrown out to make room.
+    """
+
+    def __init__(self, capacity):
+        """
+        Create an empty cache.
+        :param capacity: maximum number of LUTs to keep; if zero, nothing is cached.
+        """
+        self.capacity = capacity
+        self.luts = {}      # NB Python dicts keep insertion order: most recently used LUT is always the last one
+        self.hits = 0       # how many lookups found the LUT in the cache
+        self.misses = 0     # how many lookups didn't
+
+    def __len__(self):
+        return len(self.luts)
+
+    def get(self, key):
+        """
+        Look up a LUT in the cache.
+        :param key: the (strategy, theta0, m, dirn, pmin, pmax) tuple.
+        :return: the LUT, or None if it's not in the cache.
+        """
+        lut = self.luts.pop(key, None)
+        if lut is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            # put it back in at the end, as the most recently used
+            self.luts[key] = lut
+        return lut
+
+    def put(self, key, lut):
+        """
+        Add a LUT to the cache, making room for it if the cache is full.
+        :param key: the (strategy, theta0, m, dirn, pmin, pmax) tuple.
+        :param lut: the LUT.
+        :return: <nothing>
+        """
+        if self.capacity < 1:
+            return
+        self.luts.pop(key, None)
+        while len(self.luts) >= self.capacity:
+            # evict the least recently used
+            del self.luts[next(iter(self.luts))]
+        self.luts[key] = lut
+
+    def set_capacity(self, capacity):
+        """ Change the cache's capacity, evicting least-recently-used LUTs if it now holds too many """
+        self.capacity = capacity
+        while len(self.luts) > max(0, capacity):
+            del self.luts[next(iter(self.luts))]
+
+    def clear(self):
+        """ Empty the cache and reset the hit/miss counters """
+        self.luts = {}
+        self.hits = 0
+        self.misses = 0
+
+
+# the CDF LUT cache shared by all the PRZI-family traders in this process
+przi_lut_cache = CDFLUTCache(4096)
+
+
 class TraderPRZI(Trader):
     """
     Cliff's Parameterized-Response Zero-Intelligence (PRZI) trader -- pronounced "prezzie"
@@ -1006,7 +1831,9 @@ class TraderPRZI(Trader):
             :param dirn: direction: 'buy' or 'sell'
             :param pmin: lower bound on discrete-valued price-range
             :param pmax: upper bound on discrete-valued price-range
-            :return: {'strat': strategy, 'dirn': dirn, 'pmin': pmin, 'pmax': pmax, 'cdf_lut': cdf}
+            :return: {'strat': strategy, 'dirn': dirn, 'pmin': pmin, 'pmax': pmax, 'price0': price0, 'cdf_lut': cdf}
+                    where cdf is an array (or, without NumPy, a list) of cumulative probabilities:
+                    cdf[i] is the cumulative probability of price price0+i.
             """
 
             # the threshold function used to clip
@@ -1039,14 +1866,15 @@ class TraderPRZI(Trader):
                 # so cdf is simply the limit-price with probability 1
 
                 if dirn == 'buy':
-                    cdf = [{'price': pmax, 'cum_prob': 1.0}]
+                    price0 = pmax
                 else:   # must be a sell
-                    cdf = [{'price': pmin, 'cum_prob': 1.0}]
+                    price0 = pmin
+                cdf = [1.0]
 
                 if lut_vrbs:
                     print('\n\ncdf:', cdf)
 
-                return {'strat': strategy, 'dirn': dirn, 'pmin': pmin, 'pmax': pmax, 'cdf_lut': cdf}
+                return {'strat': strategy, 'dirn': dirn, 'pmin': pmin, 'pmax': pmax, 'price0': price0, 'cdf_lut': cdf}
 
             c = threshold(t0, m * math.tan(math.pi * (strategy + 0.5)))
 
@@ -1061,48 +1889,81 @@ class TraderPRZI(Trader):
 
             # calculate the discrete calligraphic-P function over interval [pmin, pmax]
             # (i.e., this is Equation 8 in the PRZI Technical Note)
-            calp_interval = []
-            calp_sum = 0
-            for p in range(pmin, pmax + 1):
-                # normalize the price to proportion of its range
-                p_r = (p - pmin) / p_range  # p_r in [0.0, 1.0]
+            if np is not None:
+                # normalize the prices to proportion of their range
+                p_r = (np.arange(pmin, pmax + 1) - pmin) / p_range  # p_r in [0.0, 1.0]
                 if strategy == 0.0:
                     # special case: this is just ZIC
-                    cal_p = 1 / (p_range + 1)
-                elif strategy > 0:
-                    if dirn == 'buy':
-                        cal_p = (math.exp(c * p_r) - 1.0) / e2cm1
-                    else:   # dirn == 'sell'
-                        cal_p = (math.exp(c * (1 - p_r)) - 1.0) / e2cm1
-                else:   # self.strat < 0
+                    calp_interval = np.full(len(p_r), 1 / (p_range + 1))
+                else:
                     if dirn == 'buy':
-                        cal_p = 1.0 - ((math.exp(c * p_r) - 1.0) / e2cm1)
+                        exponents = c * p_r
                     else:   # dirn == 'sell'
-                        cal_p = 1.0 - ((math.exp(c * (1 - p_r)) - 1.0) / e2cm1)
-
-                if cal_p < 0:
-                    cal_p = 0   # just in case
-
-                calp_interval.append({'price': p, "cal_p": cal_p})
-                calp_sum += cal_p
+                        exponents = c * (1 - p_r)
+                    # NB math.exp() rather than np.exp(), because np.exp() can differ from math.exp() in the last bit,
+                    # and then the LUT (and so the prices sampled from it) wouldn't be exactly the same as without NumPy
+                    calp_interval = (np.array([math.exp(x) for x in exponents.tolist()]) - 1.0) / e2cm1
+                    if strategy < 0:
+                        calp_interval = 1.0 - calp_interval
+                calp_interval[calp_interval < 0] = 0   # just in case
+                # NB cumsum() adds up the values in sequence, so gives the same sums as doing it one by one
+                calp_sum = np.cumsum(calp_interval)[-1]
+            else:
+                calp_interval = []
+                calp_sum = 0
+                for p in range(pmin, pmax + 1):
+                    # normalize the price to proportion of its range
+                    p_r = (p - pmin) / p_range  # p_r in [0.0, 1.0]
+                    if strategy == 0.0:
+                        # special case: this is just ZIC
+                        cal_p = 1 / (p_range + 1)
+                    elif strategy > 0:
+                        if dirn == 'buy':
+                            cal_p = (math.exp(c * p_r) - 1.0) / e2cm1
+                        else:   # dirn == 'sell'
+                            cal_p = (math.exp(c * (1 - p_r)) - 1.0) / e2cm1
+                    else:   # self.strat < 0
+                        if dirn == 'buy':
+                            cal_p = 1.0 - ((math.exp(c * p_r) - 1.0) / e2cm1)
+                        else:   # dirn == 'sell'
+                            cal_p = 1.0 - ((math.exp(c * (1 - p_r)) - 1.0) / e2cm1)
+
+                    if cal_p < 0:
+                        cal_p = 0   # just in case
+
+                    calp_interval.append(cal_p)
+                    calp_sum += cal_p
 
             if calp_sum <= 0:
                 print('calp_interval:', calp_interval)
                 print('pmin=%f, pmax=%f, calp_sum=%f' % (pmin, pmax, calp_sum))
 
-            cdf = []
-            cum_prob = 0
             # now go thru interval summing and normalizing to give the CDF
-            for p in range(pmin, pmax + 1):
-                cal_p = calp_interval[p-pmin]['cal_p']
-                prob = cal_p / calp_sum
-                cum_prob += prob
-                cdf.append({'price': p, 'cum_prob': cum_prob})
+            if np is not None:
+                cdf = np.cumsum(calp_interval / calp_sum)
+            else:
+                cdf = []
+                cum_prob = 0
+                for cal_p in calp_interval:
+                    cum_prob += cal_p / calp_sum
+                    cdf.append(cum_prob)
 
             if lut_vrbs:
                 print('\n\ncdf:', cdf)
 
-            return {'strat': strategy, 'dirn': dirn, 'pmin': pmin, 'pmax': pmax, 'cdf_lut': cdf}
+            return {'strat': strategy, 'dirn': dirn, 'pmin': pmin, 'pmax': pmax, 'price0': pmin, 'cdf_lut': cdf}
+
+        def shared_cdf_lut(strategy, t0, m, dirn, pmin, pmax):
+            """
+            Get the CDF LUT from the shared cache; if it's not there, calculate it and add it to the cache.
+            (Arguments are the same as for calc_cdf_lut.)
+            """
+            key = (strategy, t0, m, dirn, pmin, pmax)
+            cdf_lut = przi_lut_cache.get(key)
+            if cdf_lut is None:
+                cdf_lut = calc_cdf_lut(strategy, t0, m, dirn, pmin, pmax)
+                przi_lut_cache.put(key, cdf_lut)
+            return cdf_lut
 
         vrbs = False
 
@@ -1142,12 +2003,11 @@ class TraderPRZI(Trader):
                     self.pmax = maxprice
 
             # use the cdf look-up table
-            # cdf_lut is a list of little dictionaries
-            # each dictionary has form: {'cum_prob':nnn, 'price':nnn}
+            # cdf_lut is an array of cumulative probabilities, in increasing order of price
+            # cdf_lut[i] is the cumulative probability for the price price0+i
             # generate u=U(0,1) uniform disrtibution
-            # starting with the lowest nonzero cdf value at cdf_lut[0],
-            # walk up the lut (i.e., examine higher cumulative probabilities),
-            # until we're in the range of u; then return the relevant price
+            # binary-search the lut to find the first (lowest-price) entry whose cumulative probability
+            # is greater than u; then return the relevant price
 
             strat = self.strats[self.active_strat]['stratval']
 
@@ -1172,7 +2032,7 @@ class TraderPRZI(Trader):
                     if vrbs:
                         print('New bid LUT')
                     self.strats[self.active_strat]['lut_bid'] = \
-                        calc_cdf_lut(strat, self.theta0, self.m, 'buy', p_min, p_max)
+                        shared_cdf_lut(strat, self.theta0, self.m, 'buy', p_min, p_max)
 
                 lut = self.strats[self.active_strat]['lut_bid']
 
@@ -1199,7 +2059,7 @@ class TraderPRZI(Trader):
                     if vrbs:
                         print('New ask LUT')
                     self.strats[self.active_strat]['lut_ask'] = \
-                        calc_cdf_lut(strat, self.theta0, self.m, 'sell', p_min, p_max)
+                        shared_cdf_lut(strat, self.theta0, self.m, 'sell', p_min, p_max)
 
                 lut = self.strats[self.active_strat]['lut_ask']
 
@@ -1208,9 +2068,8 @@ class TraderPRZI(Trader):
                 print('PRZI strat=%f LUT=%s \n \n' % (strat, lut))
                 # for debugging: print a table of lut: price and cum_prob, with the discrete derivative (gives PMF).
                 last_cprob = 0.0
-                for lut_entry in lut['cdf_lut']:
-                    cprob = lut_entry['cum_prob']
-                    print('%d, %f, %f' % (lut_entry['price'], cprob - last_cprob, cprob))
+                for (i, cprob) in enumerate(lut['cdf_lut']):
+                    print('%d, %f, %f' % (lut['price0'] + i, cprob - last_cprob, cprob))
                     last_cprob = cprob
                 print('\n')
                 
@@ -1218,11 +2077,13 @@ class TraderPRZI(Trader):
             
             # do inverse lookup on the LUT to find the price
             quoteprice = None
-            u = random.random()
-            for entry in lut['cdf_lut']:
-                if u < entry['cum_prob']:
-                    quoteprice = entry['price']
-                    break
+            u = self.rng.random()
+            if np is not None:
+                i = int(np.searchsorted(lut['cdf_lut'], u, side='right'))
+            else:
+                i = bisect.bisect_right(lut['cdf_lut'], u)
+            if i < len(lut['cdf_lut']):
+                quoteprice = lut['price0'] + i
 
             order = Order(self.tid, otype, quoteprice, self.orders[0].qty, time, lob['QID'])
 
@@ -1543,6 +2404,10 @@ class TraderZIP(Trader):
     The code here implements the original ZIP, and also the strategy-optimizing variuants ZIPSH and ZIPDE.
     """
 
+    # ZIP only alters its margin when the best bid or best ask moves (a trade always moves one of them),
+    # so it responds only to those events -- but ZIPSH/ZIPDE set this to None, to manage their strategies as time passes
+    respond_events = frozenset(['best_bid', 'best_ask'])
+
     # ZIP init key param-values are those used in Cliff's 1997 original HP Labs tech report
     # NB this implementation keeps separate margin values for buying & selling,
     #    so a single trader can both buy AND sell
@@ -1688,10 +2553,14 @@ class TraderZIP(Trader):
         self.prev_best_bid_q = None     # best bid quantity on LOB on previous update
         self.prev_best_ask_p = None     # best ask price on LOB on previous update
         self.prev_best_ask_q = None     # best ask quantity on LOB on previous update
+        self.popn = None                # the ZIPPopulation engine this trader belongs to, if any
+        self.popn_index = None          # this trader's index in the ZIPPopulation's arrays
 
         # the following set of variables are needed only by ZIP with added hyperparameter optimization (e.g. ZIPSH)
         self.k = k                  # how many strategies evaluated at any one time?
         self.optmzr = optimizer     # what form of strategy-optimizer we're using
+        if self.optmzr is not None:
+            self.respond_events = None  # strategy-optimization runs on time, so respond to every event
         self.strats = None          # the list of strategies, each of which is a dictionary
         self.strat_wait_time = init_stratwaittime()     # how many secs do we give any one strat before switching?
         self.strat_eval_time = self.k * self.strat_wait_time  # time to cycle through evaluating all k strategies
@@ -1736,30 +2605,64 @@ class TraderZIP(Trader):
         if len(self.orders) < 1:
             self.active = False
             order = None
+            if self.popn is not None:
+                self.popn.active[self.popn_index] = False
         else:
             self.active = True
             self.limit = self.orders[0].price
             self.job = self.orders[0].otype
-            if self.job == 'Bid':
-                # currently a buyer (working a bid order)
-                self.margin = self.margin_buy
+            if self.popn is not None:
+                # the ZIPPopulation engine holds this trader's margins: the quote-price is worked out in its arrays
+                quoteprice = self.popn.quote(self.popn_index, self.limit, self.job)
             else:
-                # currently a seller (working a sell order)
-                self.margin = self.margin_sell
-            quoteprice = int(self.limit * (1 + self.margin))
+                if self.job == 'Bid':
+                    # currently a buyer (working a bid order)
+                    self.margin = self.margin_buy
+                else:
+                    # currently a seller (working a sell order)
+                    self.margin = self.margin_sell
+                quoteprice = int(self.limit * (1 + self.margin))
+                self.price = quoteprice
 
             lastprice = -1  # dummy value for if there is no lastprice
             if self.lastquote is not None:
                 lastprice = self.lastquote.price
 
-            self.price = quoteprice
             order = Order(self.tid, self.job, quoteprice, self.orders[0].qty, time, lob['QID'])
             self.lastquote = order
 
             if self.logging and order.price != lastprice:
                 self.logfile.write('%f, Order:, %s\n' % (time, str(order)))
+
         return order
 
+    @classmethod
+    def respond_batch(cls, traders, time, lob, trade, vrbs):
+        """
+        Make a list of ZIP traders respond to events in the market, in one call.
+        Traders in a ZIPPopulation have their margins updated all at once by the population engine, so only those
+        with an optimizer (e.g. ZIPSH) need their own respond() calling, for their strategy-optimization work.
+        NB the ZIPPopulation(s) updated are those that these traders belong to, which market_session() creates
+        one per batch of traders, so each population is updated just once.
+        :param traders: the list of ZIP traders.
+        :param time: the current time.
+        :param lob: the current state of the LOB.
+        :param trade: details of most recent trade, if any.
+        :param vrbs: verbosity: if True, print a running commentary; if False, stay silent.
+        :return: True if any of the traders' respond() asked for a snapshot frame to be recorded; False otherwise.
+        """
+        record_frame = False
+        popns = []
+        for trader in traders:
+            if trader.popn is None or trader.optmzr is not None:
+                if trader.respond(time, lob, trade, vrbs):
+                    record_frame = True
+            if trader.popn is not None and trader.popn not in popns:
+                popns.append(trader.popn)
+        for popn in popns:
+            popn.respond(time, lob, trade)
+        return record_frame
+
     def respond(self, time, lob, trade, vrbs):
         """
         Update ZIP profit margin on basis of what happened in market.
@@ -1773,18 +2676,22 @@ class TraderZIP(Trader):
         # ZIP trader responds to market events, altering its margin
         # does this whether it currently has an order to work or not
 
+        if self.popn is not None and self.optmzr is None:
+            # vanilla ZIP in a ZIPPopulation: the population engine does all the work, in its own respond()
+            return False
+
         def target_up(price):
             """ Generate a higher target price by randomly perturbing given price"""
-            ptrb_abs = self.ca * random.random()  # absolute shift
-            ptrb_rel = price * (1.0 + (self.cr * random.random()))  # relative shift
+            ptrb_abs = self.ca * self.rng.random()  # absolute shift
+            ptrb_rel = price * (1.0 + (self.cr * self.rng.random()))  # relative shift
             target = int(round(ptrb_rel + ptrb_abs, 0))
             # #                        print('TargetUp: %d %d\n' % (price,target))
             return target
 
         def target_down(price):
             """ Generate a lower target price by randomly perturbing given price"""
-            ptrb_abs = self.ca * random.random()  # absolute shift
-            ptrb_rel = price * (1.0 - (self.cr * random.random()))  # relative shift
+            ptrb_abs = self.ca * self.rng.random()  # absolute shift
+            ptrb_rel = price * (1.0 - (self.cr * self.rng.random()))  # relative shift
             target = int(round(ptrb_rel - ptrb_abs, 0))
             # #                        print('TargetDn: %d %d\n' % (price,target))
             return target
@@ -1835,6 +2742,8 @@ class TraderZIP(Trader):
             self.momntm = stratvec['momntm']
             self.ca = stratvec['ca']
             self.cr = stratvec['cr']
+            if self.popn is not None:
+                self.popn.store_strat(self)
             # bookkeeping
             self.n_trades = 0
             self.birthtime = birthtime
@@ -1979,6 +2888,10 @@ class TraderZIP(Trader):
             # this is vanilla ZIP -- nonadaptive, no optimizer, nothing to change here.
             pass
 
+        if self.popn is not None:
+            # the ZIPPopulation engine updates the margins of all its ZIP traders at once, in its own respond()
+            return snapshot
+
         # what, if anything, has happened on the bid LOB?
         bid_improved = False
         bid_hit = False
@@ -2085,32 +2998,257 @@ class TraderZIP(Trader):
         return snapshot
 
 
-class TraderPT1(Trader):
+class ZIPPopulation:
     """
-    A minimally simple propreitary trader that buys & sells to make profit
-
-    PT1 long-only buy-and-hold strategy in pseudocode:
-
-    1 wait until the market has been open for 5 minutes (to give prices a chance to settle)
-    2 then repeat forever:
-    2.1 if (I am not holding a unit)
-    2.1.1  and (best ask price is "cheap" -- i.e., less than average of recent transaction prices)
-    2.1.2  and (I have enough money in my bank to pay the asking price)
-    2.2 then
-    2.2.1   (buy the unit -- lift the ask)
-    2.2.2   (remember the purchase-price I paid for it)
-    2.3 else if (I am holding a unit)
-    2.4 then
-    2.4.1   (my asking-price is that unit’s purchase-price plus my profit margin)
-    2.4.1   if (best bid price is more than my asking price)
-    2.4.1   then
-    2.4.1.1    (sell my unit -- hit the bid)
-    2.4.1.2    (put the money in my bank)
+    A struct-of-arrays engine for a population of ZIP traders (including ZIPSH), which needs NumPy.
+    Instead of each ZIP trader updating its own margin in its respond(), the margins, beta, momentum, c_a, c_r,
+    limit prices, quote prices etc. of all the traders are held in NumPy arrays, one element per trader, and are
+    updated for all the traders at once, in one vectorized step per market event, by ZIPPopulation.respond().
+    The traders' getorder(), bookkeep(), and (for ZIPSH) strategy-optimization work just as they do otherwise,
+    except that getorder() works out the quote-price directly in the arrays, by calling quote() with the trader's
+    index: so while a trader is in a population its own margin, margin_buy, margin_sell and price attributes are
+    not kept up to date -- the arrays are the master copy.
+    NB every ZIP trader responds to every market event, so all of them have the same memory of the previous best
+    bid and ask: that is held once, here, rather than once per trader.
+    The random perturbations of target prices are drawn from this engine's own random-number generator (by default,
+    seeded from the random module), so results are reproducible but aren't the same as those of scalar ZIPs.
     """
 
-    def __init__(self, ttype, tid, balance, params, time):
+    # job is held as an integer code
+    job_codes = {None: 0, 'Bid': 1, 'Ask': 2}
+    job_names = {0: None, 1: 'Bid', 2: 'Ask'}
+
+    def __init__(self, zip_traders, rng=None):
         """
-        Construct a PT1 trader
+        Create the engine and hand over the state of each of the ZIP traders to it.
+        :param zip_traders: list of the TraderZIP traders.
+        :param rng: the NumPy random Generator to use; if None, one is created, seeded from the random module.
+        """
+        self.traders = list(zip_traders)
+        self.n = len(self.traders)
+
+        def column(attr):
+            # None values (e.g., price before first quote) are held as NaN
+            return np.array([np.nan if getattr(t, attr) is None else getattr(t, attr) for t in self.traders],
+                            dtype=float)
+
+        self.margin = column('margin')
+        self.margin_buy = column('margin_buy')
+        self.margin_sell = column('margin_sell')
+        self.beta = column('beta')
+        self.momntm = column('momntm')
+        self.ca = column('ca')
+        self.cr = column('cr')
+        self.prev_change = column('prev_change')
+        self.price = column('price')
+        self.limit = column('limit')
+        self.job = np.array([self.job_codes[t.job] for t in self.traders], dtype=np.int8)
+        self.active = np.array([t.active for t in self.traders], dtype=bool)
+
+        self.prev_best_bid_p = None     # best bid price on LOB on previous update
+        self.prev_best_bid_q = None     # best bid quantity on LOB on previous update
+        self.prev_best_ask_p = None     # best ask price on LOB on previous update
+        self.prev_best_ask_q = None     # best ask quantity on LOB on previous update
+
+        if rng is None:
+            rng = np.random.default_rng(random.getrandbits(64))
+        self.rng = rng
+
+        for (i, trader) in enumerate(self.traders):
+            trader.popn = self
+            trader.popn_index = i
+
+    def quote(self, i, limit, job):
+        """
+        Work out the quote-price for one trader, from its margin: the same calculation as TraderZIP.getorder() does.
+        :param i: the trader's index in the arrays.
+        :param limit: the limit price of the order the trader is working.
+        :param job: 'Bid' or 'Ask'.
+        :return: the quote-price.
+        """
+        if job == 'Bid':
+            margin = self.margin_buy[i]
+        else:
+            margin = self.margin_sell[i]
+        quoteprice = int(limit * (1 + margin))
+        self.margin[i] = margin
+        self.price[i] = quoteprice
+        self.limit[i] = limit
+        self.job[i] = self.job_codes[job]
+        self.active[i] = True
+        return quoteprice
+
+    def store_strat(self, trader):
+        """ Copy a trader's strategy (as loaded by ZIPSH) into the arrays """
+        i = trader.popn_index
+        self.margin_buy[i] = trader.margin_buy
+        self.margin_sell[i] = trader.margin_sell
+        self.beta[i] = trader.beta
+        self.momntm[i] = trader.momntm
+        self.ca[i] = trader.ca
+        self.cr[i] = trader.cr
+
+    def respond(self, time, lob, trade):
+        """
+        Update the profit margins of all the ZIP traders, on the basis of what happened in the market:
+        this is the same calculation as TraderZIP.respond() does for one trader, done for all of them at once.
+        :param time: the current time.
+        :param lob: the current state of the LOB.
+        :param trade: details of most recent trade, if any.
+        :return: <nothing>
+        """
+        if time < 0:
+            sys.exit('Negative time')
+
+        # what, if anything, has happened on the bid LOB? (same for every trader)
+        bid_improved = False
+        bid_hit = False
+        lob_best_bid_p = lob['bids']['best']
+        lob_best_bid_q = None
+        if lob_best_bid_p is not None:
+            # non-empty bid LOB
+            lob_best_bid_q = lob['bids']['lob'][-1][1]
+            if (self.prev_best_bid_p is not None) and (self.prev_best_bid_p < lob_best_bid_p):
+                # best bid has improved
+                bid_improved = True
+            elif trade is not None and self.prev_best_bid_p is not None and \
+                    ((self.prev_best_bid_p > lob_best_bid_p) or
+                     ((self.prev_best_bid_p == lob_best_bid_p) and (self.prev_best_bid_q > lob_best_bid_q))):
+                # previous best bid was hit
+                bid_hit = True
+        elif self.prev_best_bid_p is not None:
+            # the bid LOB has been emptied: was it cancelled or hit?
+            bid_hit = lob['tape'][-1]['type'] != 'Cancel'
+
+        # what, if anything, has happened on the ask LOB?
+        ask_improved = False
+        ask_lifted = False
+        lob_best_ask_p = lob['asks']['best']
+        lob_best_ask_q = None
+        if lob_best_ask_p is not None:
+            # non-empty ask LOB
+            lob_best_ask_q = lob['asks']['lob'][0][1]
+            if (self.prev_best_ask_p is not None) and (self.prev_best_ask_p > lob_best_ask_p):
+                # best ask has improved
+                ask_improved = True
+            elif trade is not None and self.prev_best_ask_p is not None and \
+                    ((self.prev_best_ask_p < lob_best_ask_p) or
+                     ((self.prev_best_ask_p == lob_best_ask_p) and (self.prev_best_ask_q > lob_best_ask_q))):
+                # assume previous best ask was lifted
+                ask_lifted = True
+        elif self.prev_best_ask_p is not None:
+            # the ask LOB is empty now but was not previously: canceled or lifted?
+            ask_lifted = lob['tape'][-1]['type'] != 'Cancel'
+
+        deal = bid_hit or ask_lifted
+
+        # now work out which traders alter their margins, and the price each one's target is generated from:
+        # rows in the arrays where alter is True get a new target, which is higher than ref_price where up is True,
+        # lower where it is False; or, where stub is True, the target is exactly ref_price (a stub quote)
+        is_bid = self.job == 1
+        is_ask = self.job == 2
+        price = self.price
+        alter = np.zeros(self.n, dtype=bool)
+        up = np.zeros(self.n, dtype=bool)
+        stub = np.zeros(self.n, dtype=bool)
+        ref_price = np.zeros(self.n)
+
+        if deal:
+            tradeprice = trade['price']
+            ref_price[:] = tradeprice
+            # sellers: could sell for more? raise margin; else if wouldn't have got this deal, reduce margin
+            ask_up = is_ask & (price <= tradeprice)
+            ask_down = is_ask & (price > tradeprice) & self.active & ask_lifted
+            # buyers: could buy for less? raise margin (cut price); else if wouldn't have got this deal, reduce margin
+            bid_down = is_bid & (price >= tradeprice)
+            bid_up = is_bid & (price < tradeprice) & self.active & bid_hit
+            alter = ask_up | ask_down | bid_down | bid_up
+            up = ask_up | bid_up
+        else:
+            if ask_improved:
+                # no deal: sellers aim for a target price higher than best bid
+                ask_alter = is_ask & (price > lob_best_ask_p)
+                alter = alter | ask_alter
+                up = up | ask_alter
+                if lob_best_bid_p is not None:
+                    ref_price[ask_alter] = lob_best_bid_p
+                else:
+                    ref_price[ask_alter] = lob['asks']['worst']
+                    stub = stub | ask_alter
+            if bid_improved:
+                # no deal: buyers aim for target price lower than best ask
+                bid_alter = is_bid & (price < lob_best_bid_p)
+                alter = alter | bid_alter
+                if lob_best_ask_p is not None:
+                    ref_price[bid_alter] = lob_best_ask_p
+                else:
+                    ref_price[bid_alter] = lob['bids']['worst']
+                    stub = stub | bid_alter
+
+        idx = np.flatnonzero(alter)
+        if len(idx) > 0:
+            # generate the target prices by randomly perturbing the reference prices
+            perturbed = idx[~stub[idx]]
+            target = ref_price[idx]
+            r_abs = self.rng.random(len(perturbed))
+            r_rel = self.rng.random(len(perturbed))
+            ptrb_abs = self.ca[perturbed] * r_abs     # absolute shift
+            ptrb_rel = self.cr[perturbed] * r_rel     # relative shift
+            target_up = np.round(ref_price[perturbed] * (1.0 + ptrb_rel) + ptrb_abs)
+            target_down = np.round(ref_price[perturbed] * (1.0 - ptrb_rel) - ptrb_abs)
+            target[~stub[idx]] = np.where(up[perturbed], target_up, target_down)
+
+            # ZIP profit-margin update on basis of target price
+            diff = target - price[idx]
+            change = ((1.0 - self.momntm[idx]) * (self.beta[idx] * diff)) + (self.momntm[idx] * self.prev_change[idx])
+            self.prev_change[idx] = change
+            newmargin = ((price[idx] + change) / self.limit[idx]) - 1.0
+            buy_ok = is_bid[idx] & (newmargin < 0.0)
+            sell_ok = is_ask[idx] & (newmargin > 0.0)
+            self.margin_buy[idx[buy_ok]] = newmargin[buy_ok]
+            self.margin_sell[idx[sell_ok]] = newmargin[sell_ok]
+            self.margin[idx[buy_ok | sell_ok]] = newmargin[buy_ok | sell_ok]
+            # set the price from limit and profit-margin
+            self.price[idx] = np.round(self.limit[idx] * (1.0 + self.margin[idx]))
+
+        # remember the best LOB data ready for next response
+        self.prev_best_bid_p = lob_best_bid_p
+        self.prev_best_bid_q = lob_best_bid_q
+        self.prev_best_ask_p = lob_best_ask_p
+        self.prev_best_ask_q = lob_best_ask_q
+
+
+class TraderPT1(Trader):
+    """
+    A minimally simple propreitary trader that buys & sells to make profit
+
+    PT1 long-only buy-and-hold strategy in pseudocode:
+
+    1 wait until the market has been open for 5 minutes (to give prices a chance to settle)
+    2 then repeat forever:
+    2.1 if (I am not holding a unit)
+    2.1.1  and (best ask price is "cheap" -- i.e., less than average of recent transaction prices)
+    2.1.2  and (I have enough money in my bank to pay the asking price)
+    2.2 then
+    2.2.1   (buy the unit -- lift the ask)
+    2.2.2   (remember the purchase-price I paid for it)
+    2.3 else if (I am holding a unit)
+    2.4 then
+    2.4.1   (my asking-price is that unit’s purchase-price plus my profit margin)
+    2.4.1   if (best bid price is more than my asking price)
+    2.4.1   then
+    2.4.1.1    (sell my unit -- hit the bid)
+    2.4.1.2    (put the money in my bank)
+    """
+
+    # respond() looks at recent trades on the tape and at the best bid and ask; NB cancellations go on the tape too
+    respond_events = frozenset(['trade', 'cancel', 'best_bid', 'best_ask'])
+
+    orders_self = True      # respond() issues orders to self, which are then processed in getorder()
+
+    def __init__(self, ttype, tid, balance, params, time):
+        """
+        Construct a PT1 trader
         :param ttype: the ticker-symbol for the type of trader (its strategy)
         :param tid: the trader id
         :param balance: the trader's bank balance
@@ -2187,21 +3325,14 @@ class TraderPT1(Trader):
         vstr = 't=%f PT1 respond: ' % time
 
         # what is average price of most recent n trades?
-        # work backwards from end of tape (most recent trade)
-        tape_position = -1
-        n_prices = 0
-        sum_prices = 0
+        # the exchange keeps rolling stats of recent trades, so no need to work backwards through the tape
+        # NB the oldest item on the tape is never looked at
         avg_price_ok = False
         avg_price = -1
-        while n_prices < self.n_past_trades and abs(tape_position) < len(lob['tape']):
-            if lob['tape'][tape_position]['type'] == 'Trade':
-                price = lob['tape'][tape_position]['price']
-                n_prices += 1
-                sum_prices += price
-            tape_position -= 1
-        if n_prices == self.n_past_trades:
+        trade_index = lob['rolling_stats'].trade_index(self.n_past_trades)
+        if trade_index is not None and trade_index > 0:
             # there's been enough trades to form an acceptable average
-            avg_price = int(round(sum_prices / n_prices))
+            avg_price = int(round(lob['rolling_stats'].sma(self.n_past_trades)))
             avg_price_ok = True
         vstr += "avg_price_ok=%s, avg_price=%d " % (avg_price_ok, avg_price)
 
@@ -2318,6 +3449,11 @@ class TraderPT2(Trader):
     2.4.1.2    (put the money in my bank)
     """
 
+    # respond() looks at recent trades on the tape and at the best bid and ask; NB cancellations go on the tape too
+    respond_events = frozenset(['trade', 'cancel', 'best_bid', 'best_ask'])
+
+    orders_self = True      # respond() issues orders to self, which are then processed in getorder()
+
     def __init__(self, ttype, tid, balance, params, time):
         """
         Construct a PT2 trader
@@ -2397,21 +3533,14 @@ class TraderPT2(Trader):
         vstr = 't=%f PT2 respond: ' % time
 
         # what is average price of most recent n trades?
-        # work backwards from end of tape (most recent trade)
-        tape_position = -1
-        n_prices = 0
-        sum_prices = 0
+        # the exchange keeps rolling stats of recent trades, so no need to work backwards through the tape
+        # NB the oldest item on the tape is never looked at
         avg_price_ok = False
         avg_price = -1
-        while n_prices < self.n_past_trades and abs(tape_position) < len(lob['tape']):
-            if lob['tape'][tape_position]['type'] == 'Trade':
-                price = lob['tape'][tape_position]['price']
-                n_prices += 1
-                sum_prices += price
-            tape_position -= 1
-        if n_prices == self.n_past_trades:
+        trade_index = lob['rolling_stats'].trade_index(self.n_past_trades)
+        if trade_index is not None and trade_index > 0:
             # there's been enough trades to form an acceptable average
-            avg_price = int(round(sum_prices / n_prices))
+            avg_price = int(round(lob['rolling_stats'].sma(self.n_past_trades)))
             avg_price_ok = True
         vstr += "avg_price_ok=%s, avg_price=%d " % (avg_price_ok, avg_price)
 
@@ -2510,54 +3639,1113 @@ class TraderPT2(Trader):
 # #########################---Below lies the experiment/test-rig---##################
 
 
-def trade_stats(expid, traders, dumpfile, time, lob):
+class TypeAggregates:
+    """
+    Running totals for each type of trader in the market: how many traders of that type, the sum of their bank
+    balances, and how many trades they've done. The balance totals are kept up to date as balances change (see the
+    Trader.balance property), so trade_stats() can write each line of the avg_balance file in time proportional to
+    the number of trader-types, rather than re-analysing every trader on every trade. The trade counts are kept up
+    to date by market_session(), which calls trade() for both parties to each trade as it is bookkept: so they count
+    every trade done, whatever the trader does with its own n_trades (e.g. ZIPSH resets it for each new strategy).
+    """
+
+    def __init__(self, traders):
+        """
+        Start the running totals for a population of traders, and tell each trader to keep them up to date.
+        :param traders: the dictionary of traders in the market.
+        :return: <nothing>
+        """
+        self.types = {}
+        for t in traders:
+            self.add_trader(traders[t])
+
+    def add_trader(self, trader):
+        """
+        Add a trader to the totals for its type.
+        :param trader: the trader.
+        :return: <nothing>
+        """
+        if trader.ttype in self.types:
+            self.types[trader.ttype]['n'] += 1
+            self.types[trader.ttype]['balance_sum'] += trader.balance
+        else:
+            self.types[trader.ttype] = {'n': 1, 'balance_sum': trader.balance, 'n_trades': 0}
+        trader.type_aggs = self
+
+    def balance_change(self, ttype, delta):
+        """ A trader of type ttype has had its balance changed by delta """
+        self.types[ttype]['balance_sum'] += delta
+
+    def trade(self, ttype):
+        """ A trader of type ttype has done a trade """
+        self.types[ttype]['n_trades'] += 1
+
+
+def trade_stats(expid, traders, dumpfile, time, lob, type_aggs=None, decimator=None, last=False):
     """
     Dump CSV statistics on exchange data and trader population to file for later analysis.
     This makes no assumptions about the number of types of traders, or the number of traders of any one type
     -- allows either/both to change between successive calls, but that does make it inefficient as it has to
-    re-analyse the entire set of traders on each call.
+    re-analyse the entire set of traders on each call, unless it is given the TypeAggregates for the traders.
     :param expid: the experiment-I.D. character-string.
     :param traders: the list of traders in the market.
-    :param dumpfile: the file that will be written to.
+    :param dumpfile: the file that will be written to (or a ColumnStore for avg_balance output).
     :param time: the current time.
     :param lob: the current state of the LOB.
+    :param type_aggs: if not None, the TypeAggregates kept up to date for these traders, which saves re-analysing them.
+    :param decimator: if not None, the Decimator that decides which lines are written (the values it's given are
+                      the best bid, the best ask, and the balance_sum for each type of trader).
+    :param last: True if this is the last call for this file, so the decimator should be flushed.
     :return: <nothing>
     """
 
-    # Analyse the set of traders, to see what types we have
-    trader_types = {}
-    for t in traders:
-        ttype = traders[t].ttype
-        if ttype in trader_types.keys():
-            t_balance = trader_types[ttype]['balance_sum'] + traders[t].balance
-            n = trader_types[ttype]['n'] + 1
+    if type_aggs is not None:
+        trader_types = type_aggs.types
+    else:
+        # Analyse the set of traders, to see what types we have
+        trader_types = {}
+        for t in traders:
+            ttype = traders[t].ttype
+            if ttype in trader_types.keys():
+                t_balance = trader_types[ttype]['balance_sum'] + traders[t].balance
+                n = trader_types[ttype]['n'] + 1
+            else:
+                t_balance = traders[t].balance
+                n = 1
+            trader_types[ttype] = {'n': n, 'balance_sum': t_balance}
+
+    ttypes = sorted(list(trader_types.keys()))
+    values = (lob['bids']['best'], lob['asks']['best']) + tuple([trader_types[t]['balance_sum'] for t in ttypes])
+    type_ns = [(ttype, trader_types[ttype]['n']) for ttype in ttypes]
+    if decimator is None:
+        rows = [(time, values, type_ns)]
+    else:
+        rows = decimator.add(time, values, type_ns)
+        if last:
+            rows += decimator.flush()
+
+    for (row_time, row_values, row_type_ns) in rows:
+        best_bid = row_values[0]
+        best_ask = row_values[1]
+
+        if isinstance(dumpfile, ColumnStore):
+            # binary output: one row for this frame, and one row for each trader type (undefined best prices are -1)
+            dumpfile.append('frames', (row_time, -1 if best_bid is None else best_bid,
+                                       -1 if best_ask is None else best_ask, len(row_type_ns)))
+            for ((ttype, n), s) in zip(row_type_ns, row_values[2:]):
+                dumpfile.append('types', (ttype, s, n))
+            continue
+
+        # first two columns of output are the session_id and the time
+        dumpfile.write('%s, %06d, ' % (expid, row_time))
+
+        # second two columns of output are the LOB best bid and best offer (or 'None' if they're undefined)
+        if best_bid is not None:
+            dumpfile.write('%d, ' % best_bid)
+        else:
+            dumpfile.write('None, ')
+        if best_ask is not None:
+            dumpfile.write('%d, ' % best_ask)
+        else:
+            dumpfile.write('None, ')
+
+        # total remaining number of columns printed depends on number of different trader-types at this timestep
+        # for each trader type we print FOUR columns...
+        # TraderTypeCode, TotalProfitForThisTraderType, NumberOfTradersOfThisType, AverageProfitPerTraderOfThisType
+        for ((ttype, n), s) in zip(row_type_ns, row_values[2:]):
+            dumpfile.write('%s, %d, %d, %f, ' % (ttype, s, n, s / float(n)))
+
+        dumpfile.write('\n')
+
+
+class CompressedFile:
+    """
+    A write-only text file that is compressed (by gzip, bz2 or lzma) as it's written.
+    The text is compressed in chunks of about chunk_size characters, each ending at the end of a line, and each chunk is
+    compressed as a complete stream of its own, one after another in the file: gzip/bzip2/xz and Python's gzip/bz2/
+    lzma modules read that as one stream, but each chunk can also be decompressed on its own. So an index file,
+    <fname>.idx, records where each chunk starts, and read_dump_lines() uses it to seek straight to a given line.
+    """
+
+    # the file-name suffix and default compression level for each kind of compression
+    suffixes = {'gzip': '.gz', 'bz2': '.bz2', 'lzma': '.xz'}
+    default_levels = {'gzip': 6, 'bz2': 9, 'lzma': 6}
+
+    def __init__(self, fname, compression, level=None, chunk_size=1048576):
+        """
+        Open the file (and its index file) for writing.
+        :param fname: the name of the file (NB the suffix isn't added automatically).
+        :param compression: 'gzip', 'bz2', or 'lzma'.
+        :param level: the compression level (0-9 for gzip & lzma, 1-9 for bz2); if None, the default for compression.
+        :param chunk_size: roughly how many characters of text are compressed into each chunk.
+        """
+        if compression not in self.suffixes:
+            sys.exit('FAIL: unknown compression %s for CompressedFile' % compression)
+        if compression == 'lzma' and lzma is None:
+            sys.exit('FAIL: lzma compression is not available in this Python')
+        if level is None:
+            level = self.default_levels[compression]
+        self.compression = compression
+        self.level = level
+        self.chunk_size = chunk_size
+        self.pending = []       # text written but not yet compressed
+        self.n_pending = 0      # number of characters in pending
+        self.n_lines = 0        # lines compressed so far
+        self.text_offset = 0    # bytes of text compressed so far
+        self.file_offset = 0    # bytes of compressed data written so far
+        self.file = open(fname, 'wb')
+        self.index = open(fname + '.idx', 'w')
+        self.index.write('first_line, text_offset, file_offset\n')
+
+    @classmethod
+    def compression_of(cls, fname):
+        """ The compression used for a file, going by its suffix (None if it isn't compressed) """
+        for (compression, suffix) in cls.suffixes.items():
+            if fname.endswith(suffix):
+                return compression
+        return None
+
+    def compress(self, data):
+        """ Compress a chunk of data into a complete stream """
+        if self.compression == 'gzip':
+            # NB mtime=0, so that the same text always compresses to the same file
+            return gzip.compress(data, compresslevel=self.level, mtime=0)
+        elif self.compression == 'bz2':
+            return bz2.compress(data, self.level)
+        else:
+            return lzma.compress(data, preset=self.level)
+
+    def write(self, s):
+        """ Write a string to the file """
+        self.pending.append(s)
+        self.n_pending += len(s)
+        if self.n_pending >= self.chunk_size:
+            self.write_chunk(False)
+
+    def write_chunk(self, last):
+        """
+        Compress the pending text and write it to the file as a chunk.
+        :param last: if True, compress all of the pending text; if False, stop at the end of the last complete line.
+        :return: <nothing>
+        """
+        text = ''.join(self.pending)
+        if last:
+            cut = len(text)
         else:
-            t_balance = traders[t].balance
-            n = 1
-        trader_types[ttype] = {'n': n, 'balance_sum': t_balance}
+            cut = text.rfind('\n') + 1
+        if cut == 0:
+            return
+        data = text[:cut].encode()
+        chunk = self.compress(data)
+        self.index.write('%d, %d, %d\n' % (self.n_lines, self.text_offset, self.file_offset))
+        self.file.write(chunk)
+        self.n_lines += text.count('\n', 0, cut)
+        self.text_offset += len(data)
+        self.file_offset += len(chunk)
+        self.pending = [text[cut:]]
+        self.n_pending = len(text) - cut
+
+    def flush(self):
+        """ Compress and write all complete lines written so far (this starts a new chunk) """
+        self.write_chunk(False)
+        self.file.flush()
+        self.index.flush()
+
+    def fileno(self):
+        """ The file descriptor of the compressed file, e.g. for os.fsync() """
+        return self.file.fileno()
+
+    def close(self):
+        """ Compress and write whatever is left, and close the file """
+        self.write_chunk(True)
+        if self.file_offset == 0:
+            # nothing was written, but the file should still be a valid (empty) compressed file
+            self.file.write(self.compress(b''))
+        self.file.close()
+        self.index.close()
+
+
+def read_dump_lines(fname, start_line=0):
+    """
+    Read the lines of an output file, which may have been written compressed by a CompressedFile.
+    :param fname: the name of the file; if it ends .gz, .bz2 or .xz it's decompressed as it's read.
+    :param start_line: the number (from 0) of the first line to read: for a compressed file with an index file, reading
+                       starts from the chunk that this line is in, rather than from the start of the file.
+    :return: a generator of the lines, as strings.
+    """
+    compression = CompressedFile.compression_of(fname)
+    line_no = 0
+    if compression is None:
+        with open(fname, 'r') as dump_file:
+            for line in dump_file:
+                if line_no >= start_line:
+                    yield line
+                line_no += 1
+        return
+
+    file_offset = 0
+    if start_line > 0 and os.path.exists(fname + '.idx'):
+        with open(fname + '.idx', 'r') as index:
+            index.readline()    # skip the header
+            chunks = [[int(field) for field in line.split(',')] for line in index]
+        chunk = bisect.bisect_right([c[0] for c in chunks], start_line) - 1
+        if chunk >= 0:
+            line_no = chunks[chunk][0]
+            file_offset = chunks[chunk][2]
+
+    with open(fname, 'rb') as raw:
+        raw.seek(file_offset)
+        if compression == 'gzip':
+            stream = gzip.GzipFile(fileobj=raw, mode='rb')
+        elif compression == 'bz2':
+            stream = bz2.BZ2File(raw, 'rb')
+        else:
+            stream = lzma.LZMAFile(raw, 'rb')
+        with io.TextIOWrapper(stream) as text:
+            for line in text:
+                if line_no >= start_line:
+                    yield line
+                line_no += 1
 
-    # first two columns of output are the session_id and the time
-    dumpfile.write('%s, %06d, ' % (expid, time))
 
-    # second two columns of output are the LOB best bid and best offer (or 'None' if they're undefined)
-    if lob['bids']['best'] is not None:
-        dumpfile.write('%d, ' % (lob['bids']['best']))
+def lob_frame_string(bid_levels, ask_levels):
+    """
+    The linear character-string summary of the LOB that is written to the LOB frames file,
+    listing only those prices on the LOB with nonzero quantities.
+    :param bid_levels: the anonymized bids, a list of [price, qty] items, lowest price first.
+    :param ask_levels: the anonymized asks, likewise.
+    :return: the string, e.g. 'Bid:,2,99,1,100,3,Ask:,1,105,1,'
+    """
+    lobstring = 'Bid:,'
+    n_bids = len(bid_levels)
+    if n_bids > 0:
+        lobstring += '%d,' % n_bids
+        for lobitem in bid_levels:
+            price_str = '%d,' % lobitem[0]
+            qty_str = '%d,' % lobitem[1]
+            lobstring = lobstring + price_str + qty_str
     else:
-        dumpfile.write('None, ')
-    if lob['asks']['best'] is not None:
-        dumpfile.write('%d, ' % (lob['asks']['best']))
+        lobstring += '0,'
+    lobstring += 'Ask:,'
+    n_asks = len(ask_levels)
+    if n_asks > 0:
+        lobstring += '%d,' % n_asks
+        for lobitem in ask_levels:
+            price_str = '%d,' % lobitem[0]
+            qty_str = '%d,' % lobitem[1]
+            lobstring = lobstring + price_str + qty_str
     else:
-        dumpfile.write('None, ')
+        lobstring += '0,'
+    return lobstring
 
-    # total remaining number of columns printed depends on number of different trader-types at this timestep
-    # for each trader type we print FOUR columns...
-    # TraderTypeCode, TotalProfitForThisTraderType, NumberOfTradersOfThisType, AverageProfitPerTraderOfThisType
-    for ttype in sorted(list(trader_types.keys())):
-        n = trader_types[ttype]['n']
-        s = trader_types[ttype]['balance_sum']
-        dumpfile.write('%s, %d, %d, %f, ' % (ttype, s, n, s / float(n)))
 
-    dumpfile.write('\n')
+class LOBDeltaRecorder:
+    """
+    Records LOB frames delta-encoded. The LOB frames file has the whole LOB written out every time it changes;
+    instead, this writes a keyframe of the whole LOB every keyframe_interval frames, and in between writes each frame as
+    just the price levels that have changed, with their new quantities (0 if the level has gone).
+    The OrderbookHalfs keep track of which of their price levels have changed, so writing a frame doesn't need the
+    whole LOB. The file starts with a header line giving the keyframe interval; after that, line n+1 is frame n, either
+        K, <time>, <the LOB, as written in the LOB frames file>
+    or
+        D, <time>, <side>,<price>,<qty>, ... for each changed level, where side is B (bids) or A (asks).
+    read_lob_deltas() reads the frames back.
+    """
+
+    def __init__(self, dumpfile, keyframe_interval=1000):
+        """
+        :param dumpfile: the file to write to.
+        :param keyframe_interval: every keyframe_interval-th frame is a keyframe.
+        """
+        self.dumpfile = dumpfile
+        self.keyframe_interval = keyframe_interval
+        self.n_frames = 0
+        self.levels = None      # the LOB as last written: [dict of bid qty by price, dict of ask qty by price]
+        dumpfile.write('LOB deltas, keyframe_interval, %d\n' % keyframe_interval)
+
+    def record(self, time, bids, asks):
+        """
+        Write a frame, if the LOB has changed since the last frame was written.
+        :param time: the current time.
+        :param bids: the exchange's bids OrderbookHalf.
+        :param asks: the exchange's asks OrderbookHalf.
+        :return: <nothing>
+        """
+        if self.levels is None:
+            # the first frame: from now on the book keeps track of which price levels have changed
+            bids.changed_prices = set()
+            asks.changed_prices = set()
+            self.write_keyframe(time, bids, asks)
+            return
+
+        changes = []
+        for (side, half, levels) in (('B', bids, self.levels[0]), ('A', asks, self.levels[1])):
+            for price in sorted(half.changed_prices):
+                if price in half.lob:
+                    qty = half.lob[price][0]
+                else:
+                    qty = 0
+                if levels.get(price, 0) != qty:
+                    changes.append('%s,%d,%d,' % (side, price, qty))
+                    if qty == 0:
+                        del (levels[price])
+                    else:
+                        levels[price] = qty
+            half.changed_prices.clear()
+
+        if len(changes) > 0:
+            if self.n_frames % self.keyframe_interval == 0:
+                self.write_keyframe(time, bids, asks)
+            else:
+                self.dumpfile.write('D, %.3f, %s\n' % (time, ''.join(changes)))
+                self.n_frames += 1
+
+    def write_keyframe(self, time, bids, asks):
+        """ Write the whole LOB as a keyframe """
+        self.levels = [dict(bids.lob_anon), dict(asks.lob_anon)]
+        self.dumpfile.write('K, %.3f, %s\n' % (time, lob_frame_string(bids.lob_anon, asks.lob_anon)))
+        self.n_frames += 1
+
+    def close(self):
+        """ Close the file """
+        self.dumpfile.close()
+
+
+def read_lob_deltas(fname, start_frame=0):
+    """
+    Read back the LOB frames written by a LOBDeltaRecorder (the file may be compressed: see read_dump_lines()).
+    :param fname: the name of the file.
+    :param start_frame: the number (from 0) of the first frame to return: reading starts at the keyframe before it.
+    :return: a generator of frames, each [time, bids, asks], where bids and asks are lists of [price, qty] items,
+             lowest price first, as in the anonymized LOB.
+    """
+    header = next(read_dump_lines(fname)).split(',')
+    if header[0] != 'LOB deltas':
+        sys.exit('FAIL: %s is not a LOB deltas file' % fname)
+    keyframe_interval = int(header[2])
+
+    frame_no = start_frame - start_frame % keyframe_interval
+    levels = None
+    for line in read_dump_lines(fname, frame_no + 1):
+        (ftype, ftime, body) = line.rstrip('\n').split(', ', 2)
+        fields = body.split(',')
+        if ftype == 'K':
+            # Bid:,n_bids,price,qty,...,Ask:,n_asks,price,qty,...,
+            n_bids = int(fields[1])
+            bid_fields = fields[2:2 + 2 * n_bids]
+            ask_fields = fields[4 + 2 * n_bids:-1]
+            levels = [dict(zip(map(int, bid_fields[0::2]), map(int, bid_fields[1::2]))),
+                      dict(zip(map(int, ask_fields[0::2]), map(int, ask_fields[1::2])))]
+        elif levels is None:
+            sys.exit('FAIL: no keyframe before frame %d in %s' % (frame_no, fname))
+        else:
+            # side,price,qty, for each changed level
+            for i in range(0, len(fields) - 1, 3):
+                side_levels = levels[0] if fields[i] == 'B' else levels[1]
+                qty = int(fields[i + 2])
+                if qty == 0:
+                    del (side_levels[int(fields[i + 1])])
+                else:
+                    side_levels[int(fields[i + 1])] = qty
+        if frame_no >= start_frame:
+            yield [float(ftime),
+                   [[price, levels[0][price]] for price in sorted(levels[0])],
+                   [[price, levels[1][price]] for price in sorted(levels[1])]]
+        frame_no += 1
+
+
+def lob_deltas_frame(fname, frame_no):
+    """
+    Reconstruct one frame from a file written by a LOBDeltaRecorder.
+    :param fname: the name of the file.
+    :param frame_no: the number (from 0) of the frame.
+    :return: the frame, [time, bids, asks], as returned by read_lob_deltas().
+    """
+    for frame in read_lob_deltas(fname, frame_no):
+        return frame
+    sys.exit('FAIL: there is no frame %d in %s' % (frame_no, fname))
+
+
+def lob_deltas_to_frames(fname, frames_fname):
+    """
+    Convert a file written by a LOBDeltaRecorder into a LOB frames file, as market_session writes when not recording
+    deltas.
+    :param fname: the name of the LOB deltas file.
+    :param frames_fname: the name of the LOB frames file to write.
+    :return: <nothing>
+    """
+    with open(frames_fname, 'w') as frames_file:
+        for (time, bids, asks) in read_lob_deltas(fname):
+            frames_file.write('%.3f, %s\n' % (time, lob_frame_string(bids, asks)))
+
+
+class Decimator:
+    """
+    A decimation policy for one output file, deciding which of the records it's given are actually written, so that
+    the amount written depends on the resolution wanted rather than on the number of events.
+    Each record is given as a time, a tuple of values (numbers, or None), and a payload (anything else that's needed
+    to write the record). The policy is a dictionary, one of:
+        {'every': n} -- write every nth record (the first, the n+1th, the 2n+1th, ...);
+        {'bucket': t, 'agg': a} -- divide time into buckets t seconds long, and write one record for each bucket that
+            has any: its values are the 'last', 'mean', 'min', or 'max' of each value over the bucket's records
+            (ignoring Nones), and its time and payload are those of the bucket's last record;
+        {'threshold': x} -- write a record when any of its values differs by more than x from the record last written
+            (a value changing to or from None counts as a difference).
+    Whatever the policy, the first record is always written, and flush() returns the last record if it wasn't.
+    """
+
+    aggregations = ('last', 'mean', 'min', 'max')
+
+    def __init__(self, policy, name='output'):
+        """
+        :param policy: the decimation policy, as above.
+        :param name: the name of the output, for error messages.
+        """
+        self.policy = policy
+        if 'every' in policy:
+            self.kind = 'every'
+            self.every = int(policy['every'])
+            if self.every < 1:
+                sys.exit('FAIL: decimation for %s needs every >= 1' % name)
+        elif 'bucket' in policy:
+            self.kind = 'bucket'
+            self.bucket_length = float(policy['bucket'])
+            self.agg = policy.get('agg', 'last')
+            if self.bucket_length <= 0 or self.agg not in self.aggregations:
+                sys.exit('FAIL: decimation for %s needs bucket > 0 and agg one of %s' % (name, self.aggregations))
+        elif 'threshold' in policy:
+            self.kind = 'threshold'
+            self.threshold = policy['threshold']
+        else:
+            sys.exit('FAIL: unknown decimation policy %s for %s' % (policy, name))
+        self.n_records = 0      # how many records have been added
+        self.last = None        # the last record added, if it hasn't been written
+        self.written = None     # the values of the record last written (for the threshold policy)
+        self.bucket = None      # the number of the current bucket
+        self.acc = None         # the current bucket's aggregated values: for 'mean', [sum, count] for each value
+        # NB for the bucket policy, last is the current bucket's last record (None if the bucket is empty)
+
+    def add(self, time, values, payload=None):
+        """
+        Add a record.
+        :param time: the time of the record.
+        :param values: the record's values, a tuple.
+        :param payload: whatever else is needed to write the record.
+        :return: a list of the records to be written now, each a tuple (time, values, payload).
+        """
+        self.n_records += 1
+        if self.kind == 'every':
+            if (self.n_records - 1) % self.every == 0:
+                self.last = None
+                return [(time, values, payload)]
+            self.last = (time, values, payload)
+            return []
+
+        if self.kind == 'threshold':
+            if self.written is None or self.changed(values):
+                self.written = values
+                self.last = None
+                return [(time, values, payload)]
+            self.last = (time, values, payload)
+            return []
+
+        # bucket: write out the previous bucket if this record is in a new one (or if its values don't match)
+        to_write = []
+        bucket = int(time // self.bucket_length)
+        if self.last is not None and (bucket != self.bucket or len(values) != len(self.acc)):
+            to_write = self.flush()
+        self.bucket = bucket
+        if self.last is None:
+            # the first record in this bucket
+            if self.agg == 'mean':
+                self.acc = [[v, 1] if v is not None else [0, 0] for v in values]
+            else:
+                self.acc = list(values)
+        elif self.agg == 'mean':
+            for (acc, v) in zip(self.acc, values):
+                if v is not None:
+                    acc[0] += v
+                    acc[1] += 1
+        elif self.agg == 'min':
+            self.acc = [a if v is None or (a is not None and a <= v) else v for (a, v) in zip(self.acc, values)]
+        elif self.agg == 'max':
+            self.acc = [a if v is None or (a is not None and a >= v) else v for (a, v) in zip(self.acc, values)]
+        else:
+            self.acc = list(values)
+        self.last = (time, values, payload)
+        return to_write
+
+    def changed(self, values):
+        """ Does any value differ by more than the threshold from the record last written? """
+        if len(values) != len(self.written):
+            return True
+        for (old, new) in zip(self.written, values):
+            if (old is None) != (new is None):
+                return True
+            if old is not None and abs(new - old) > self.threshold:
+                return True
+        return False
+
+    def flush(self):
+        """
+        Finish off: e.g. at the end of the session.
+        :return: a list of any records still to be written (the current bucket, or the last record if not written).
+        """
+        if self.last is None:
+            return []
+        (time, values, payload) = self.last
+        self.last = None
+        if self.kind == 'bucket':
+            if self.agg == 'mean':
+                values = tuple([acc[0] / acc[1] if acc[1] > 0 else None for acc in self.acc])
+            else:
+                values = tuple(self.acc)
+            self.acc = None
+        elif self.kind == 'threshold':
+            self.written = values
+        return [(time, values, payload)]
+
+
+class DumpWriter:
+    """
+    A write-only text file whose writing is done by a background thread, so that disk latency (e.g. on a network
+    filesystem) doesn't stall the simulation. Lines written to it are collected into batches; each batch is handed
+    over to the writer thread, which writes it to the file in one go, and syncs the file to disk every sync_interval
+    seconds rather than after every write. Anything written is only guaranteed to be on disk after close().
+    If the file is to be compressed, the writer thread does the compressing too, by writing to a CompressedFile.
+    """
+
+    def __init__(self, fname, fmode='w', batch_lines=4096, sync_interval=5.0, max_batches=64, compression=None,
+                 level=None):
+        """
+        Open the file and start the writer thread.
+        :param fname: the name of the file.
+        :param fmode: the mode the file is opened in ('w' or 'a').
+        :param batch_lines: how many write() calls are collected before they are handed to the writer thread.
+        :param sync_interval: the writer thread syncs the file to disk at most once every this many seconds
+                              (if None, the file is only synced when it is closed).
+        :param max_batches: if this many batches are waiting to be written, write() blocks until one is done.
+        :param compression: if not None, the file is written by a CompressedFile with this compression (and fmode
+                            is ignored).
+        :param level: the compression level for the CompressedFile.
+        """
+        self.fname = fname
+        self.batch_lines = batch_lines
+        self.sync_interval = sync_interval
+        self.batch = []
+        self.error = None
+        if compression is None:
+            self.file = open(fname, fmode, buffering=1024 * 1024)
+        else:
+            self.file = CompressedFile(fname, compression, level)
+        self.queue = queue.Queue(max_batches)
+        self.thread = threading.Thread(target=self.writer, name='DumpWriter ' + fname, daemon=True)
+        self.thread.start()
+
+    def write(self, s):
+        """ Write a string to the file (eventually) """
+        self.batch.append(s)
+        if len(self.batch) >= self.batch_lines:
+            self.flush()
+
+    def flush(self):
+        """ Hand the current batch to the writer thread (this doesn't wait for it to be written) """
+        if self.error is not None:
+            sys.exit('FAIL: error writing %s: %s' % (self.fname, self.error))
+        if len(self.batch) > 0:
+            self.queue.put(''.join(self.batch))
+            self.batch = []
+
+    def writer(self):
+        """ The writer thread: write each batch as it arrives, syncing now and then, until told to stop (by None) """
+        last_sync = chrono.monotonic()
+        while True:
+            chunk = self.queue.get()
+            try:
+                if chunk is None:
+                    if self.error is None:
+                        self.file.flush()
+                        os.fsync(self.file.fileno())
+                    self.file.close()
+                    return
+                if self.error is not None:
+                    # something went wrong earlier: just drain the queue, so the simulation thread isn't blocked
+                    continue
+                self.file.write(chunk)
+                if self.sync_interval is not None and chrono.monotonic() - last_sync >= self.sync_interval:
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                    last_sync = chrono.monotonic()
+            except Exception as err:
+                # whatever went wrong, keep draining the queue (the simulation thread would otherwise block on a full
+                # queue, or on join() in close()); the error is reported by the next flush() or close()
+                if self.error is None:
+                    self.error = err
+                if chunk is None:
+                    return
+
+    def close(self):
+        """ Write whatever is left, sync the file, and wait for the writer thread to finish """
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            sys.exit('FAIL: error writing %s: %s' % (self.fname, self.error))
+
+
+class ColumnStore:
+    """
+    A binary, column-by-column alternative to one of market_session's CSV output files, which is much smaller and
+    needs no parsing to read back. An output is stored in its own directory: each of the output's tables has one file
+    per column of fixed-width, typed values (little-endian), and schema.json describes the tables, their columns, and
+    how many rows each has. Rows are collected in memory and written to the column files a chunk at a time.
+    Columns of type 'text' (variable-length strings) are stored as a file of UTF-8 text and a file of end-offsets.
+    The column files can be read back with ColumnStoreReader, e.g. memory-mapped into NumPy arrays without copying,
+    and column_store_to_csv() converts an output back into the CSV file that market_session would have written.
+    """
+
+    magic = 'BSE columns'
+    version = 1
+
+    # the tables of each kind of output, and the name and type of each table's columns
+    # NB as in the CSV files, prices are integers (any fractional part is dropped, as '%d' would do when writing CSV);
+    # event and order types are stored as their first three letters
+    schemas = {'tape': {'events': [('etype', 'S3'), ('time', '<f8'), ('price', '<i4'), ('qid', '<i8'),
+                                   ('otype', 'S3')]},
+               'blotters': {'traders': [('tid', 'S8'), ('n_trades', '<i4')],
+                            'trades': [('tid', 'S8'), ('type', 'S5'), ('time', '<f8'), ('price', '<i4'),
+                                       ('party1', 'S8'), ('party2', 'S8'), ('qty', '<i4')]},
+               'LOB_frames': {'frames': [('time', '<f8'), ('n_bids', '<i4'), ('n_asks', '<i4')],
+                              'levels': [('price', '<i4'), ('qty', '<i4')]},
+               'strats': {'frames': [('time', '<f8'), ('line', 'text')]},
+               'avg_balance': {'frames': [('time', '<f8'), ('best_bid', '<i4'), ('best_ask', '<i4'),
+                                          ('n_types', '<i4')],
+                               'types': [('ttype', 'S8'), ('balance_sum', '<f8'), ('n', '<i4')]}}
+
+    # struct format characters for the fixed-width numeric column types
+    struct_codes = {'<f8': 'd', '<i8': 'q', '<i4': 'i'}
+
+    def __init__(self, dirname, output, meta=None, chunk_rows=65536):
+        """
+        Create an empty store.
+        :param dirname: the directory to write the store's files to (created if need be).
+        :param output: which kind of output this is, one of the keys of ColumnStore.schemas.
+        :param meta: a dictionary of any other information to save in the schema (e.g. the session i.d.).
+        :param chunk_rows: how many rows of a table are collected before they're written to file.
+        """
+        if output not in self.schemas:
+            sys.exit('FAIL: unknown output %s for ColumnStore' % output)
+        self.dirname = dirname
+        self.output = output
+        self.meta = meta if meta is not None else {}
+        self.chunk_rows = chunk_rows
+        os.makedirs(dirname, exist_ok=True)
+        self.tables = {}
+        for (tname, columns) in self.schemas[output].items():
+            files = []
+            for (cname, ctype) in columns:
+                fname = os.path.join(dirname, '%s.%s' % (tname, cname))
+                if ctype == 'text':
+                    files.append([open(fname + '.txt', 'wb'), open(fname + '.off', 'wb'), 0])
+                else:
+                    files.append(open(fname + '.bin', 'wb'))
+            self.tables[tname] = {'columns': columns, 'files': files, 'rows': [], 'n_rows': 0}
+        self.write_schema()
+
+    def append(self, tname, row):
+        """
+        Add a row to a table.
+        :param tname: the name of the table.
+        :param row: a tuple of values, one for each of the table's columns, in order.
+        :return: <nothing>
+        """
+        table = self.tables[tname]
+        table['rows'].append(row)
+        if len(table['rows']) >= self.chunk_rows:
+            self.write_chunk(tname)
+
+    def extend(self, tname, rows):
+        """
+        Add several rows to a table.
+        :param tname: the name of the table.
+        :param rows: a list of rows, each a tuple (or list) of values, one for each of the table's columns, in order.
+        :return: <nothing>
+        """
+        table = self.tables[tname]
+        table['rows'].extend(rows)
+        if len(table['rows']) >= self.chunk_rows:
+            self.write_chunk(tname)
+
+    def write_chunk(self, tname):
+        """ Write a table's rows collected so far to the end of its column files """
+        table = self.tables[tname]
+        rows = table['rows']
+        if len(rows) == 0:
+            return
+        for (column, values, colfile) in zip(table['columns'], zip(*rows), table['files']):
+            ctype = column[1]
+            if ctype == 'text':
+                offsets = []
+                end = colfile[2]
+                text = []
+                for value in values:
+                    encoded = value.encode()
+                    end += len(encoded)
+                    offsets.append(end)
+                    text.append(encoded)
+                colfile[0].write(b''.join(text))
+                colfile[1].write(struct.pack('<%dq' % len(offsets), *offsets))
+                colfile[2] = end
+            elif ctype[0] == 'S':
+                width = int(ctype[1:])
+                encoded = [value.encode() for value in values]
+                if max(len(value) for value in encoded) > width:
+                    sys.exit('FAIL: value too wide for column %s.%s in ColumnStore' % (tname, column[0]))
+                colfile.write(b''.join([value.ljust(width, b'\0') for value in encoded]))
+            elif ctype[1] == 'i':
+                colfile.write(struct.pack('<%d%s' % (len(values), self.struct_codes[ctype]), *map(int, values)))
+            else:
+                colfile.write(struct.pack('<%d%s' % (len(values), self.struct_codes[ctype]), *values))
+        table['n_rows'] += len(rows)
+        table['rows'] = []
+        # keep the row counts in the schema up to date, so that the store is readable even if the session crashes
+        self.write_schema()
+
+    def write_schema(self):
+        """ (Re)write the schema file, describing the tables and how many rows of each have been written so far """
+        schema = {'magic': self.magic, 'version': self.version, 'output': self.output, 'meta': self.meta,
+                  'tables': {}}
+        for (tname, table) in self.tables.items():
+            schema['tables'][tname] = {'columns': table['columns'], 'n_rows': table['n_rows']}
+        tmp_fname = os.path.join(self.dirname, 'schema.json.tmp')
+        with open(tmp_fname, 'w') as schema_file:
+            json.dump(schema, schema_file, indent=1)
+        os.replace(tmp_fname, os.path.join(self.dirname, 'schema.json'))
+
+    def close(self):
+        """ Write any rows that are left, and close the column files """
+        for tname in self.tables:
+            table = self.tables[tname]
+            self.write_chunk(tname)
+            for colfile in table['files']:
+                if isinstance(colfile, list):
+                    colfile[0].close()
+                    colfile[1].close()
+                else:
+                    colfile.close()
+
+
+class ColumnStoreReader:
+    """
+    Reads back an output written by a ColumnStore.
+    """
+
+    def __init__(self, dirname, chunk_rows=65536):
+        """
+        Open a store, by reading its schema.
+        :param dirname: the store's directory.
+        :param chunk_rows: how many rows at a time rows() reads from file.
+        """
+        self.dirname = dirname
+        self.chunk_rows = chunk_rows
+        with open(os.path.join(dirname, 'schema.json'), 'r') as schema_file:
+            schema = json.load(schema_file)
+        if schema.get('magic') != ColumnStore.magic or schema.get('version') != ColumnStore.version:
+            sys.exit('FAIL: %s is not a BSE column store that can be read' % dirname)
+        self.output = schema['output']
+        self.meta = schema['meta']
+        self.tables = {}
+        for (tname, table) in schema['tables'].items():
+            self.tables[tname] = {'columns': [tuple(column) for column in table['columns']],
+                                  'n_rows': table['n_rows']}
+
+    def n_rows(self, tname):
+        """ How many rows the table has """
+        return self.tables[tname]['n_rows']
+
+    def column(self, tname, cname):
+        """
+        Read one column of a table into a NumPy array: fixed-width columns are memory-mapped, not copied into memory.
+        String columns are arrays of bytes; a 'text' column is returned as a list of strs instead.
+        :param tname: the name of the table.
+        :param cname: the name of the column.
+        :return: the column's values.
+        """
+        if np is None:
+            sys.exit('FAIL: ColumnStoreReader.column() needs NumPy (use rows() instead)')
+        n_rows = self.n_rows(tname)
+        ctype = dict(self.tables[tname]['columns'])[cname]
+        fname = os.path.join(self.dirname, '%s.%s' % (tname, cname))
+        if ctype == 'text':
+            if n_rows == 0:
+                return []
+            offsets = np.memmap(fname + '.off', dtype='<i8', mode='r', shape=(n_rows,))
+            text = np.memmap(fname + '.txt', dtype='u1', mode='r', shape=(int(offsets[-1]),))
+            starts = [0] + offsets[:-1].tolist()
+            return [bytes(text[start:end]).decode() for (start, end) in zip(starts, offsets.tolist())]
+        if n_rows == 0:
+            return np.zeros(0, dtype=ctype)
+        return np.memmap(fname + '.bin', dtype=ctype, mode='r', shape=(n_rows,))
+
+    def rows(self, tname):
+        """
+        Read a table row by row, without needing NumPy: strings are decoded to strs.
+        :param tname: the name of the table.
+        :return: a generator of tuples, one for each row.
+        """
+        n_rows = self.n_rows(tname)
+        columns = self.tables[tname]['columns']
+        files = []
+        for (cname, ctype) in columns:
+            fname = os.path.join(self.dirname, '%s.%s' % (tname, cname))
+            if ctype == 'text':
+                files.append([open(fname + '.txt', 'rb'), open(fname + '.off', 'rb'), 0])
+            else:
+                files.append(open(fname + '.bin', 'rb'))
+        try:
+            for start in range(0, n_rows, self.chunk_rows):
+                n = min(self.chunk_rows, n_rows - start)
+                values = []
+                for ((cname, ctype), colfile) in zip(columns, files):
+                    if ctype == 'text':
+                        offsets = struct.unpack('<%dq' % n, colfile[1].read(8 * n))
+                        text = colfile[0].read(offsets[-1] - colfile[2])
+                        starts = [colfile[2]] + list(offsets[:-1])
+                        values.append([text[s - colfile[2]:e - colfile[2]].decode()
+                                       for (s, e) in zip(starts, offsets)])
+                        colfile[2] = offsets[-1]
+                    elif ctype[0] == 'S':
+                        width = int(ctype[1:])
+                        data = colfile.read(width * n)
+                        values.append([data[i:i + width].rstrip(b'\0').decode() for i in range(0, width * n, width)])
+                    else:
+                        code = ColumnStore.struct_codes[ctype]
+                        values.append(struct.unpack('<%d%s' % (n, code), colfile.read(struct.calcsize(code) * n)))
+                for row in zip(*values):
+                    yield row
+        finally:
+            for colfile in files:
+                if isinstance(colfile, list):
+                    colfile[0].close()
+                    colfile[1].close()
+                else:
+                    colfile.close()
+
+
+def column_store_to_csv(dirname, csv_fname=None):
+    """
+    Convert an output written as a ColumnStore back into the CSV file that market_session would have written instead.
+    :param dirname: the store's directory, e.g. sess01_tape.bcol
+    :param csv_fname: the name of the CSV file to write; if None, it's dirname with .bcol replaced by .csv
+    :return: the name of the CSV file.
+    """
+    store = ColumnStoreReader(dirname)
+    if csv_fname is None:
+        csv_fname = os.path.splitext(dirname.rstrip('/' + os.sep))[0] + '.csv'
+
+    with open(csv_fname, 'w') as csv_file:
+        if store.output == 'tape':
+            for (etype, time, price, qid, otype) in store.rows('events'):
+                if etype == 'TRD':
+                    csv_file.write('TRD, %f, %d\n' % (time, price))
+                else:
+                    csv_file.write('CAN, %f, %d, %s, %d\n' % (time, qid, otype, price))
+
+        elif store.output == 'blotters':
+            trades = store.rows('trades')
+            for (tid, n_trades) in store.rows('traders'):
+                csv_file.write('%s, %d\n' % (tid, n_trades))
+                for _ in range(n_trades):
+                    csv_file.write('%s, %s, %.3f, %d, %s, %s, %d\n' % next(trades))
+
+        elif store.output == 'LOB_frames':
+            levels = store.rows('levels')
+            for (time, n_bids, n_asks) in store.rows('frames'):
+                lobstring = 'Bid:,%d,' % n_bids
+                for _ in range(n_bids):
+                    lobstring += '%d,%d,' % next(levels)
+                lobstring += 'Ask:,%d,' % n_asks
+                for _ in range(n_asks):
+                    lobstring += '%d,%d,' % next(levels)
+                csv_file.write('%.3f, %s\n' % (time, lobstring))
+
+        elif store.output == 'strats':
+            for (time, line) in store.rows('frames'):
+                csv_file.write('t=,%.0f, %s' % (time, line))
+
+        elif store.output == 'avg_balance':
+            types = store.rows('types')
+            for (time, best_bid, best_ask, n_types) in store.rows('frames'):
+                line = '%s, %06d, ' % (store.meta['expid'], time)
+                # as in trade_stats(), an undefined best price (stored as -1) is written as None
+                for best in (best_bid, best_ask):
+                    if best >= 0:
+                        line += '%d, ' % best
+                    else:
+                        line += 'None, '
+                for _ in range(n_types):
+                    (ttype, s, n) = next(types)
+                    line += '%s, %d, %d, %f, ' % (ttype, s, n, s / float(n))
+                csv_file.write(line + '\n')
+
+        else:
+            sys.exit('FAIL: unknown output %s in column_store_to_csv()' % store.output)
+
+    return csv_fname
+
+
+class RandomStream:
+    """
+    One component's own stream of random numbers, with the same methods as the random-module functions BSE uses
+    (random(), randint(), gauss(), expovariate()), so it can be used in place of the random module.
+    Values are generated in blocks by a NumPy random Generator (or, without NumPy, by a random.Random), so drawing a
+    value is usually just a list look-up. The stream is deterministic: the same seed gives the same sequence.
+    """
+
+    def __init__(self, seed, block_size=4096):
+        """
+        Create a stream.
+        :param seed: the seed for this stream.
+        :param block_size: how many values of each kind to generate at a time.
+        """
+        self.block_size = block_size
+        if np is not None:
+            self.generator = np.random.default_rng(seed)
+        else:
+            self.generator = random.Random(seed)
+        self.uniforms = []      # block of U[0,1) values
+        self.n_uniforms = 0     # how many of the block have been used
+        self.normals = []       # block of N(0,1) values
+        self.n_normals = 0
+        self.exponentials = []  # block of exponential values, with mean 1
+        self.n_exponentials = 0
+
+    def random(self):
+        """ Return a random float in [0.0, 1.0) """
+        if self.n_uniforms == len(self.uniforms):
+            if np is not None:
+                self.uniforms = self.generator.random(self.block_size).tolist()
+            else:
+                self.uniforms = [self.generator.random() for _ in range(self.block_size)]
+            self.n_uniforms = 0
+        self.n_uniforms += 1
+        return self.uniforms[self.n_uniforms - 1]
+
+    def randint(self, a, b):
+        """ Return a random integer in the range [a, b], including both end points """
+        return a + int(self.random() * (b - a + 1))
+
+    def gauss(self, mu, sigma):
+        """ Return a random value from a Gaussian distribution with mean mu and standard deviation sigma """
+        if self.n_normals == len(self.normals):
+            if np is not None:
+                self.normals = self.generator.standard_normal(self.block_size).tolist()
+            else:
+                self.normals = [self.generator.gauss(0.0, 1.0) for _ in range(self.block_size)]
+            self.n_normals = 0
+        self.n_normals += 1
+        return mu + sigma * self.normals[self.n_normals - 1]
+
+    def expovariate(self, lambd):
+        """ Return a random value from an exponential distribution with rate lambd (i.e., mean 1/lambd) """
+        if self.n_exponentials == len(self.exponentials):
+            if np is not None:
+                self.exponentials = self.generator.standard_exponential(self.block_size).tolist()
+            else:
+                self.exponentials = [self.generator.expovariate(1.0) for _ in range(self.block_size)]
+            self.n_exponentials = 0
+        self.n_exponentials += 1
+        return self.exponentials[self.n_exponentials - 1] / lambd
+
+
+class RandomStreams:
+    """
+    A source of independent random-number streams, one for each named component of a market session
+    (e.g. 'select' for picking which trader goes next, 'orders' for customer orders, 'trader/ZIC' for ZIC traders).
+    Each stream's seed is derived from the master seed and the component's name, so a component's sequence of random
+    numbers depends only on the master seed and on what that component does, not on what other components draw.
+    """
+
+    def __init__(self, master_seed, block_size=4096):
+        """
+        :param master_seed: the master seed.
+        :param block_size: how many values of each kind each stream generates at a time.
+        """
+        self.master_seed = master_seed
+        self.block_size = block_size
+        self.streams = {}
+
+    def seed(self, name):
+        """ The seed for the named component """
+        return trial_seed(self.master_seed, name)
+
+    def stream(self, name):
+        """ The named component's stream (the same stream every time for the same name) """
+        if name not in self.streams:
+            self.streams[name] = RandomStream(self.seed(name), self.block_size)
+        return self.streams[name]
+
+
+class TraderRegistry(dict):
+    """
+    The population of traders in a market session: a dictionary of traders indexed by trader-I.D. string (e.g. 'B07'),
+    as used throughout BSE, plus indexes that are built once the population is complete (see build_index()):
+    each trader has a stable integer index; the trader-I.D.s are held in an array in index order, so a trader can
+    be picked at random in O(1) time without making a list of all the I.D.s; and the traders can be looked up by
+    type (e.g. 'ZIPSH') and by side ('B' for buyers, 'S' for sellers, 'P' for proprietary traders).
+    """
+
+    def __init__(self, *args):
+        dict.__init__(self, *args)
+        self.tids = []          # trader-I.D.s, in index order (which is the order they are in this dictionary)
+        self.tid_index = {}     # integer index of each trader-I.D.
+        self.by_type = {}       # indexes of the traders of each type
+        self.by_side = {}       # indexes of the traders on each side: keyed by first character of the trader-I.D.
+        self.type_selections = {}   # cache of lists of traders returned by of_types()
+        self.rng = random           # source of random numbers for picking traders: the random module, or a RandomStream
+
+    def build_index(self):
+        """
+        (Re)build the indexes: call this once the population is complete, and again if traders are added/removed.
+        :return: <nothing>
+        """
+        self.tids = list(self.keys())
+        self.tid_index = {}
+        self.by_type = {}
+        self.by_side = {}
+        self.type_selections = {}
+        for (i, tid) in enumerate(self.tids):
+            self.tid_index[tid] = i
+            self.by_type.setdefault(self[tid].ttype, []).append(i)
+            self.by_side.setdefault(tid[:1], []).append(i)
+
+    def random_tid(self):
+        """ Pick a trader-I.D. at random, with a single call to self.rng.randint() """
+        return self.tids[self.rng.randint(0, len(self.tids) - 1)]
+
+    def of_types(self, ttypes):
+        """
+        All the traders of the given types, in index order.
+        :param ttypes: list of trader-type codes, e.g. ['PRSH', 'PRDE', 'ZIPSH'].
+        :return: list of traders.
+        """
+        key = tuple(ttypes)
+        selection = self.type_selections.get(key)
+        if selection is None:
+            indexes = []
+            for ttype in ttypes:
+                indexes += self.by_type.get(ttype, [])
+            selection = [self[self.tids[i]] for i in sorted(indexes)]
+            self.type_selections[key] = selection
+        return selection
+
+    def on_side(self, side):
+        """
+        All the traders on one side of the market, in index order.
+        :param side: 'B' for buyers, 'S' for sellers, 'P' for proprietary traders.
+        :return: list of traders.
+        """
+        return [self[self.tids[i]] for i in self.by_side.get(side, [])]
 
 
 def populate_market(trdrs_spec, traders, shuffle, vrbs):
@@ -2617,14 +4805,15 @@ def populate_market(trdrs_spec, traders, shuffle, vrbs):
         :param trader_list: the list of traders in which the shuffling happens
         :return: <nothing>
         """
+        tnames = ['%c%02d' % (ttype_char, t) for t in range(n)]
         for swap in range(n):
             t1 = (n - 1) - swap
             t2 = random.randint(0, t1)
-            t1name = '%c%02d' % (ttype_char, t1)
-            t2name = '%c%02d' % (ttype_char, t2)
+            t1name = tnames[t1]
+            t2name = tnames[t2]
             trader_list[t1name].tid = t2name
             trader_list[t2name].tid = t1name
-            temp = traders[t1name]
+            temp = trader_list[t1name]
             trader_list[t1name] = trader_list[t2name]
             trader_list[t2name] = temp
 
@@ -2750,7 +4939,287 @@ def populate_market(trdrs_spec, traders, shuffle, vrbs):
     return {'n_buyers': n_buyers, 'n_sellers': n_sellers, 'n_proptraders': n_proptraders}
 
 
-def customer_orders(time, traders, trader_stats, orders_sched, pending, vrbs):
+class OffsetEventList:
+    """
+    A compiled offset event-list, for use as the dynamic price-offset function on a supply/demand schedule range,
+    e.g. range1 = (75, 110, (OffsetEventList(end_time, offsetfn_events), [])).
+    The event times are held in a sorted list, so the offset at any time is found by binary search, which is
+    O(log n) in the number of events, rather than by walking the whole event-list on every call.
+    """
+
+    def __init__(self, final_time, offset_events):
+        """
+        Compile an offset event-list.
+        :param final_time: the end-time of the session.
+        :param offset_events: the offset event-list: one item for each change in offset value
+                -- each item is fraction of time elapsed, followed by the new offset value at that time;
+                the items must be in time order.
+        """
+        self.final_time = float(final_time)
+        self.times = [event[0] for event in offset_events]
+        self.offsets = [event[1] for event in offset_events]
+        for i in range(len(self.times) - 1):
+            if self.times[i] > self.times[i + 1]:
+                sys.exit('FAIL: offset event-list is not in time order')
+
+    def __call__(self, time):
+        """
+        Return the price offset-value for the given time.
+        :param time: the current time.
+        :return: integer price offset value (or None if the event-list is empty).
+        """
+        if len(self.offsets) < 1:
+            return None
+        # the offset is the value of the first event later than the current time, or of the final event if none is
+        i = bisect.bisect_right(self.times, time / self.final_time)
+        if i == len(self.offsets):
+            i = i - 1
+        return self.offsets[i]
+
+
+class OffsetGrid:
+    """
+    A dynamic price-offset function tabulated on a regular time-grid, for offset functions that are costly to
+    evaluate: e.g. range1 = (75, 110, (OffsetGrid(offsetfn, args, start_time, end_time, 1.0), [])).
+    The function is evaluated once at each grid-point, and the offset at any time is then found in O(1) by linear
+    interpolation between the two nearest grid-points. NB the grid holds one value per grid_step seconds, so for
+    very long sessions choose grid_step with the memory needed in mind.
+    """
+
+    def __init__(self, offsetfn, params, start_time, end_time, grid_step):
+        """
+        Tabulate an offset function.
+        :param offsetfn: the offset function, called as offsetfn(time, *params).
+        :param params: list of parameter values for offsetfn.
+        :param start_time: the time of the first grid-point.
+        :param end_time: the time of the last grid-point (the grid is extended if need be to reach it).
+        :param grid_step: the time between grid-points.
+        """
+        if grid_step <= 0:
+            sys.exit('FAIL: OffsetGrid grid_step must be > 0')
+        self.start_time = float(start_time)
+        self.grid_step = float(grid_step)
+        n_steps = max(1, int(math.ceil((end_time - start_time) / self.grid_step)))
+        self.values = [offsetfn(self.start_time + i * self.grid_step, *params) for i in range(n_steps + 1)]
+
+    def __call__(self, time):
+        """
+        Return the price offset-value for the given time: times off the ends of the grid get the end values.
+        :param time: the current time.
+        :return: integer price offset value.
+        """
+        x = (time - self.start_time) / self.grid_step
+        i = int(math.floor(x))
+        if i < 0:
+            return self.values[0]
+        if i >= len(self.values) - 1:
+            return self.values[-1]
+        frac = x - i
+        return int(round(self.values[i] + frac * (self.values[i + 1] - self.values[i])))
+
+
+def schedule_index(order_schedules):
+    """
+    Compile a list of supply or demand schedules into an index that getschedmode() in customer_orders() can search
+    by binary search rather than by scanning the whole list.
+    :param order_schedules: list of schedules, each a dictionary with 'from', 'to', 'ranges', and 'stepmode' keys.
+    :return: [boundaries, regimes]: boundaries is the sorted list of all the schedules' from/to times; regimes[i] is
+            the first schedule in the list that applies from time boundaries[i] up to boundaries[i+1] (or None if no
+            schedule applies then, and None for times at or after the last boundary).
+    """
+    boundaries = sorted(set([schedule['from'] for schedule in order_schedules] +
+                            [schedule['to'] for schedule in order_schedules]))
+    regimes = []
+    for t in boundaries[:-1]:
+        regime = None
+        for schedule in order_schedules:
+            if (schedule['from'] <= t) and (t < schedule['to']):
+                # first matching timezone has priority over any others
+                regime = schedule
+                break
+        regimes.append(regime)
+    regimes.append(None)
+    return [boundaries, regimes]
+
+
+def schedule_offsetfn_read_file(filename, col_t, col_p, scale_factor=75, vrbs=False, use_cache=True, cache_dir=None):
+    """
+    Read in a CSV data-file for the supply/demand schedule time-varying price-offset value
+    The event-list is cached in a binary file, keyed by a hash of the CSV file's contents and by the column and
+    scale_factor arguments, so that repeat runs (and parallel workers) that read the same file don't re-parse it.
+    The cache is best-effort: if the cache file can't be read or written (e.g. the data directory is read-only),
+    the CSV file is just parsed as normal.
+    :param filename: the CSV file to read
+    :param col_t: column in the CSV that has the time data
+    :param col_p: column in the CSV that has the price data
+    :param scale_factor: multiplier on prices
+    :param vrbs: verbosity Boolean: if True, print a running commentary; if False, stay silent.
+    :param use_cache: if True, read the event-list from the cache if it's there, and write it to the cache if not.
+    :param cache_dir: directory to keep cache files in; if None, a __offsetcache__ directory next to the CSV file.
+    :return: on offset value event-list: one item for each change in offset value
+            -- each item is percentage time elapsed, followed by the new offset value at that time
+    """
+
+    # each cache file is a header (magic string, number of events) followed by one record per event
+    cache_magic = b'BSEOFFS1'
+    cache_header = '<8sq'
+    cache_record = '<dq'
+
+    with open(filename, 'rb') as csv_file:
+        csv_bytes = csv_file.read()
+
+    cache_filename = None
+    if use_cache:
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(filename)), '__offsetcache__')
+        key = hashlib.sha1(csv_bytes).hexdigest()
+        cache_filename = os.path.join(cache_dir, '%s_%s_t%d_p%d_s%s.bin' %
+                                      (os.path.basename(filename), key[:16], col_t, col_p, repr(scale_factor)))
+        cache_bytes = b''
+        if os.path.exists(cache_filename):
+            try:
+                with open(cache_filename, 'rb') as cache_file:
+                    cache_bytes = cache_file.read()
+            except OSError:
+                # can't read the cache, so parse the CSV file instead
+                cache_bytes = b''
+        header_size = struct.calcsize(cache_header)
+        if len(cache_bytes) >= header_size:
+            (magic, n_events) = struct.unpack_from(cache_header, cache_bytes, 0)
+            if magic == cache_magic and \
+                    len(cache_bytes) == header_size + n_events * struct.calcsize(cache_record):
+                offsetfn_eventlist = [[t, p] for (t, p) in struct.iter_unpack(cache_record, cache_bytes[header_size:])]
+                if vrbs:
+                    print('read %d offset events from cache file %s' % (n_events, cache_filename))
+                return offsetfn_eventlist
+
+    # parse the whole file in one go: NB the files are at most a few thousand rows, so this is plain Python --
+    # vectorizing it with NumPy (as the PRZI look-up tables are, when NumPy is available) wouldn't save much
+    # assumes data file is sorted in time order, in correct format, etc. etc.; only rows for the first date are used
+    rows = list(csv.reader(csv_bytes.decode('utf-8-sig').splitlines()))[1:]    # first row is a header
+    first_date = None
+    times = []
+    prices = []
+    for line in rows:
+        row_date = line[col_t][:10]
+        if first_date is None:
+            first_date = row_date
+        if row_date != first_date:
+            continue
+        # time is HH:MM:SS, converted straight to seconds since midnight
+        hms = line[col_t][11:19]
+        times.append(int(hms[0:2]) * 3600 + int(hms[3:5]) * 60 + int(hms[6:8]))
+        # delete any commas so 1,000,000 becomes 1000000
+        prices.append(float(line[col_p].replace(',', '')))
+        if vrbs:
+            print(row_date, hms, prices[-1])
+
+    # normalise times to fractions of entire time-series duration & normalise price range
+    minprice = min(prices)
+    pricerange = max(prices) - minprice
+    firsttime = times[0]
+    endtime = float(times[-1] - firsttime)
+    offsetfn_eventlist = []
+    for (t, p) in zip(times, prices):
+        # normalise price, clip, scale & convert to integer cents
+        normld_price = max(0.0, min((p - minprice) / pricerange, 1.0))
+        offsetfn_eventlist.append([float(t - firsttime) / endtime, int(round(normld_price * scale_factor))])
+
+    if cache_filename is not None:
+        # write to a temporary file and then rename it, so other processes never see a half-written cache file
+        tmp_filename = '%s.%d.tmp' % (cache_filename, os.getpid())
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(tmp_filename, 'wb') as cache_file:
+                cache_file.write(struct.pack(cache_header, cache_magic, len(offsetfn_eventlist)))
+                for event in offsetfn_eventlist:
+                    cache_file.write(struct.pack(cache_record, event[0], event[1]))
+            os.replace(tmp_filename, cache_filename)
+            if vrbs:
+                print('wrote %d offset events to cache file %s' % (len(offsetfn_eventlist), cache_filename))
+        except OSError as err:
+            # the cache is only an optimization, so carry on without it
+            if vrbs:
+                print('could not write offset cache file %s: %s' % (cache_filename, err))
+            if os.path.exists(tmp_filename):
+                try:
+                    os.remove(tmp_filename)
+                except OSError:
+                    pass
+
+    return offsetfn_eventlist
+
+
+def schedule_offsetfn_read_dir(dirname, col_t, col_p, scale_factor=75, vrbs=False, use_cache=True, cache_dir=None):
+    """
+    Read in all the price-offset CSV data-files in a directory (e.g. one file per day), in filename order.
+    :param dirname: the directory to read.
+    :param col_t: column in the CSVs that has the time data
+    :param col_p: column in the CSVs that has the price data
+    :param scale_factor: multiplier on prices
+    :param vrbs: verbosity Boolean: if True, print a running commentary; if False, stay silent.
+    :param use_cache: if True, use schedule_offsetfn_read_file()'s cache of the event-lists.
+    :param cache_dir: directory to keep cache files in; if None, a __offsetcache__ directory inside dirname.
+    :return: list of [filename, offset event-list] pairs, one for each CSV file.
+    """
+    eventlists = []
+    for fname in sorted(os.listdir(dirname)):
+        if fname.lower().endswith('.csv'):
+            path = os.path.join(dirname, fname)
+            eventlists.append([fname, schedule_offsetfn_read_file(path, col_t, col_p, scale_factor,
+                                                                  vrbs, use_cache, cache_dir)])
+    return eventlists
+
+
+class PendingOrders:
+    """
+    The customer orders that have been generated but not yet issued to the traders.
+    The orders are held in a priority queue (a heap) ordered by the time each is due to be issued, so finding the
+    orders that are due doesn't mean scanning all of them, and the time of the next arrival is always at hand.
+    """
+
+    def __init__(self):
+        self.heap = []          # heap of [issue_time, seq_number, order]
+        self.n_pushed = 0       # seq_number of the next order pushed: keeps track of the order they were added in
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __iter__(self):
+        # the orders, in the order they were added
+        for item in sorted(self.heap, key=lambda heap_item: heap_item[1]):
+            yield item[2]
+
+    def push(self, order):
+        """
+        Add an order to the queue.
+        :param order: the customer order; order.time is the time it is due to be issued.
+        :return: <nothing>
+        """
+        heapq.heappush(self.heap, [order.time, self.n_pushed, order])
+        self.n_pushed += 1
+
+    def next_time(self):
+        """ Return the time the next order is due to be issued, or None if the queue is empty """
+        if len(self.heap) > 0:
+            return self.heap[0][0]
+        return None
+
+    def pop_due(self, time):
+        """
+        Remove all the orders due to be issued before the given time.
+        :param time: the current time.
+        :return: list of the orders that are due, in the order they were added to the queue.
+        """
+        due = []
+        while len(self.heap) > 0 and self.heap[0][0] < time:
+            due.append(heapq.heappop(self.heap))
+        if len(due) > 1:
+            due.sort(key=lambda heap_item: heap_item[1])
+        return [item[2] for item in due]
+
+
+def customer_orders(time, traders, trader_stats, orders_sched, pending, vrbs, rng=random, issued=None):
     """
     Generate a list of new customer-orders to be issued to the traders in the immediate/near future,
     and a list of any existing customer-orders that need to be cancelled because they are overridden by new ones.
@@ -2771,10 +5240,15 @@ def customer_orders(time, traders, trader_stats, orders_sched, pending, vrbs):
             if len(range)==4, the third value is function that gives dynamic offset for schedule min, and 4th is a
             function giving dynamic offset for schedule max, so gradient of sup/dem linear curve can vary dynamically
             along with the varying equilibrium price.
-    :param pending: the list of currently pending future orders if this is empty, generates a new one).
+            Optional os['sup_index'] and os['dem_index'] are the schedule_index() of os['sup'] and os['dem']: if
+            present, they're used to look up which schedule applies at the current time.
+    :param pending: the PendingOrders queue of currently pending future orders (if this is empty, generates a new one).
     :param vrbs: verbosity Boolean: if True, print a running commentary; if False, stay silent.
+    :param rng: source of random numbers: the random module, or a RandomStream.
+    :param issued: if not None, a list that the tid of each trader issued with a customer order is appended to.
     :return: [new_pending, cancellations]:
-            new_pending is list of new orders to be issued;
+            new_pending is the PendingOrders queue of orders still to be issued (new_pending.next_time() gives the
+            time that the next of them is due, so a caller can skip straight to it);
             cancellations is list of previously-issued orders now cancelled.
     """
 
@@ -2836,14 +5310,14 @@ def customer_orders(time, traders, trader_stats, orders_sched, pending, vrbs):
         if stepmode == 'fixed':
             order_price = pmin + int(i * stepsize)
         elif stepmode == 'jittered':
-            order_price = pmin + int(i * stepsize) + random.randint(-halfstep, halfstep)
+            order_price = pmin + int(i * stepsize) + rng.randint(-halfstep, halfstep)
         elif stepmode == 'random':
             if len(schedules) > 1:
                 # more than one schedule: choose one equiprobably
-                s = random.randint(0, len(schedules) - 1)
+                s = rng.randint(0, len(schedules) - 1)
                 pmin = sysmin_check(min(schedules[s][0], schedules[s][1]))
                 pmax = sysmax_check(max(schedules[s][0], schedules[s][1]))
-            order_price = random.randint(int(pmin), int(pmax))
+            order_price = rng.randint(int(pmin), int(pmax))
         else:
             sys.exit('FAIL: Unknown mode in schedule')
         order_price = sysmin_check(sysmax_check(order_price))
@@ -2878,10 +5352,10 @@ def customer_orders(time, traders, trader_stats, orders_sched, pending, vrbs):
             elif timemode == 'drip-fixed':
                 arrtime = trdr * tstep
             elif timemode == 'drip-jitter':
-                arrtime = trdr * tstep + tstep * random.random()
+                arrtime = trdr * tstep + tstep * rng.random()
             elif timemode == 'drip-poisson':
                 # poisson requires a bit of extra work
-                interarrivaltime = random.expovariate(n_traders / interval)
+                interarrivaltime = rng.expovariate(n_traders / interval)
                 arrtime += interarrivaltime
             else:
                 sys.exit('FAIL: unknown time-mode in getissuetimes()')
@@ -2897,29 +5371,38 @@ def customer_orders(time, traders, trader_stats, orders_sched, pending, vrbs):
         if shuffle:
             for trdr in range(n_traders):
                 i = (n_traders - 1) - trdr
-                j = random.randint(0, i)
+                j = rng.randint(0, i)
                 tmp = issue_times[i]
                 issue_times[i] = issue_times[j]
                 issue_times[j] = tmp
         return issue_times
 
-    def getschedmode(t_now, order_schedules):
+    def getschedmode(t_now, order_schedules, sched_index):
         """
         return the step-mode for supply/demand schedule at the current time
         :param t_now: the current time
         :param order_schedules: dictionary/list of order schedules
+        :param sched_index: the schedule_index() of order_schedules, or None to search the list itself
         :return: schedrange = the price range for this schedule; mode= the stepmode for this schedule
         """
         got_one = False
         schedrange = None
         stepmode = None
-        for schedule in order_schedules:
-            if (schedule['from'] <= t_now) and (t_now < schedule['to']):
-                # within the timezone for this schedule
-                schedrange = schedule['ranges']
-                stepmode = schedule['stepmode']
+        if sched_index is not None:
+            [boundaries, regimes] = sched_index
+            i = bisect.bisect_right(boundaries, t_now) - 1
+            if i >= 0 and regimes[i] is not None:
+                schedrange = regimes[i]['ranges']
+                stepmode = regimes[i]['stepmode']
                 got_one = True
-                break  # jump out the loop -- so the first matching timezone has priority over any others
+        else:
+            for schedule in order_schedules:
+                if (schedule['from'] <= t_now) and (t_now < schedule['to']):
+                    # within the timezone for this schedule
+                    schedrange = schedule['ranges']
+                    stepmode = schedule['stepmode']
+                    got_one = True
+                    break  # jump out the loop -- so the first matching timezone has priority over any others
         if not got_one:
             sys.exit('Fail: time=%5.2f not within any timezone in order_schedules=%s' % (t_now, order_schedules))
         return schedrange, stepmode
@@ -2932,55 +5415,54 @@ def customer_orders(time, traders, trader_stats, orders_sched, pending, vrbs):
     cancellations = []
 
     if len(pending) < 1:
-        # list of pending (to-be-issued) customer orders is empty, so generate a new one
-        new_pending = []
+        # queue of pending (to-be-issued) customer orders is empty, so generate a new one
+        new_pending = PendingOrders()
 
         # demand side (buyers)
         issuetimes = getissuetimes(n_buyers, orders_sched['timemode'], orders_sched['interval'], shuffle_times, True)
 
         ordertype = 'Bid'
-        (sched, mode) = getschedmode(time, orders_sched['dem'])
+        (sched, mode) = getschedmode(time, orders_sched['dem'], orders_sched.get('dem_index'))
         for t in range(n_buyers):
             issuetime = time + issuetimes[t]
             tname = 'B%02d' % t
             orderprice = getorderprice(t, sched, n_buyers, mode, issuetime)
             order = Order(tname, ordertype, orderprice, 1, issuetime, chrono.time())
-            new_pending.append(order)
+            new_pending.push(order)
 
         # supply side (sellers)
         issuetimes = getissuetimes(n_sellers, orders_sched['timemode'], orders_sched['interval'], shuffle_times, True)
         ordertype = 'Ask'
-        (sched, mode) = getschedmode(time, orders_sched['sup'])
+        (sched, mode) = getschedmode(time, orders_sched['sup'], orders_sched.get('sup_index'))
         for t in range(n_sellers):
             issuetime = time + issuetimes[t]
             tname = 'S%02d' % t
             orderprice = getorderprice(t, sched, n_sellers, mode, issuetime)
             # print('time %d sellerprice %d' % (time,orderprice))
             order = Order(tname, ordertype, orderprice, 1, issuetime, chrono.time())
-            new_pending.append(order)
+            new_pending.push(order)
     else:
         # there are pending future orders: issue any whose timestamp is in the past
-        new_pending = []
-        for order in pending:
-            if order.time < time:
-                # this order should have been issued by now
-                # issue it to the trader
-                tname = order.tid
-                response = traders[tname].add_order(order, vrbs)
+        # (orders that aren't due yet stay on the queue)
+        new_pending = pending
+        for order in pending.pop_due(time):
+            # this order should have been issued by now
+            # issue it to the trader
+            tname = order.tid
+            response = traders[tname].add_order(order, vrbs)
+            if issued is not None:
+                issued.append(tname)
+            if vrbs:
+                print('Customer order: %s %s' % (response, order))
+            if response == 'LOB_Cancel':
+                cancellations.append(tname)
                 if vrbs:
-                    print('Customer order: %s %s' % (response, order))
-                if response == 'LOB_Cancel':
-                    cancellations.append(tname)
-                    if vrbs:
-                        print('Cancellations: %s' % cancellations)
-                # and then don't add it to new_pending (i.e., delete it)
-            else:
-                # this order stays on the pending list
-                new_pending.append(order)
+                    print('Cancellations: %s' % cancellations)
     return [new_pending, cancellations]
 
 
-def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dumpfile_flags, sess_vrbs):
+def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dumpfile_flags, sess_vrbs,
+                   engine='timestep', zip_engine='scalar', rng_seed=None):
     """
     One session in the market.
     :param sess_id: the character-string ID for this session, used in naming output files.
@@ -2989,7 +5471,50 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dum
     :param trader_spec: specification of the traders populating the market for this session.
     :param order_schedule: specification of the "customer orders" assigned to traders, i.e. the supply/demand schedule.
     :param dumpfile_flags: a dictionary of Boolean flags specifying which output files to be written for this session.
+            If the optional flag 'spill_tape' is True, the exchange keeps the whole session's tape, spilling events
+            too old for its in-memory tape to the file <sess_id>_tape_spill.dat.
+            If the optional flag 'background_writer' is True, the output files are written by DumpWriters, i.e. by
+            background threads, in large batches, and synced to disk every dumpfile_flags['sync_interval'] seconds
+            (default 5.0; None => only when the file is closed) instead of after every strategy frame.
+            If the optional value dumpfile_flags['output_format'] is 'columns' (rather than the default 'csv'), each
+            output is written in binary by a ColumnStore, into a directory named like the CSV file but ending .bcol
+            (e.g. <sess_id>_tape.bcol) -- background_writer then doesn't apply; column_store_to_csv() converts each
+            output to the CSV file.
+            If the optional value dumpfile_flags['lob_frames'] is 'delta' (rather than the default 'full'), LOB frames
+            are written delta-encoded by a LOBDeltaRecorder, to <sess_id>_LOB_deltas.csv, with a keyframe every
+            dumpfile_flags['keyframe_interval'] frames (default 1000); read_lob_deltas() reads them back.
+            If the optional value dumpfile_flags['decimate'] is given, it's a dictionary of decimation policies for
+            any of the 'avg_balance', 'LOB_frames', and 'tape' (trades only) outputs, e.g.
+            {'avg_balance': {'bucket': 60, 'agg': 'mean'}, 'LOB_frames': {'every': 10}, 'tape': {'threshold': 5}}:
+            see Decimator for the policies. Decimated values are compared on best bid & ask (avg_balance also on
+            each type's balance_sum; the tape on trade price), and written in the usual format (so e.g. mean prices
+            are written as integers).
+            If the optional value dumpfile_flags['compression'] is 'gzip', 'bz2' or 'lzma', each CSV output file is
+            compressed as it's written, by a CompressedFile, at level dumpfile_flags['compression_level'] (if given),
+            and named with .gz, .bz2 or .xz added (e.g. <sess_id>_LOB_frames.csv.gz); read_dump_lines() reads them.
     :param sess_vrbs: verbosity: if True, output a running commentary on what is going on; if False, stay silent.
+    :param engine: how simulated time is advanced.
+            engine=='timestep' => time goes up in small fixed steps, and at each step one trader chosen at random
+            gets the chance to issue an order (so each trader is polled on average once per second);
+            engine=='event' => a discrete-event simulation: a heap-ordered queue of customer-order arrivals and
+            trader wake-ups is processed in time order, jumping straight from one event to the next.
+            Each trader wakes as a Poisson process with mean interval of one second, matching the timestep engine,
+            but while a trader has no order to work it isn't polled at all (polling it would do nothing) -- because
+            the Poisson process is memoryless, this doesn't change the dynamics. Changes in the order_schedule take
+            effect when each new batch of customer orders is generated, as they do with the timestep engine.
+            The event engine is much faster for long (e.g. multi-day) sessions where many traders are often idle.
+    :param zip_engine: how ZIP (and ZIPSH) traders update their margins after each market event.
+            zip_engine=='scalar' => each ZIP trader updates its own margin, in its respond() method;
+            zip_engine=='vector' => the margins of ZIP traders are updated all at once by ZIPPopulation engines,
+            one for the ZIPs and one for the ZIPSHs, which is much faster when there are many ZIP traders.
+            This needs NumPy; random perturbations are drawn from NumPy's random-number generator, so the results
+            are statistically but not exactly the same.
+    :param rng_seed: if None, random numbers come from the random module, as seeded by the caller.
+            Otherwise, each component of the session -- choosing which trader goes next, generating customer orders,
+            each type of trader, each ZIPPopulation -- draws from its own RandomStream, seeded from rng_seed and the
+            component's name, so the session is reproducible from rng_seed alone.
+            NB random numbers drawn when the traders are created (e.g. their initial strategies) still come from the
+            random module.
     :return: <nothing>.
     """
 
@@ -3002,7 +5527,8 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dum
         :return: <nothing>
         """
 
-        line_str = 't=,%.0f, ' % frametime
+        line_prefix = 't=,%.0f, ' % frametime
+        line_str = line_prefix
 
         best_buyer_id = None
         best_buyer_prof = 0
@@ -3011,40 +5537,38 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dum
         best_seller_prof = 0
         best_seller_strat = None
 
-        # loop through traders to find the best
-        for trdr in traders:
-            trader = trdrs[trdr]
+        # loop through the strategy-optimizing traders to find the best
+        for trader in trdrs.of_types(['PRSH', 'PRDE', 'ZIPSH']):
 
             # print('PRSH/PRDE/ZIPSH strategy recording, t=%s' % trader)
-            if trader.ttype == 'PRSH' or trader.ttype == 'PRDE' or trader.ttype == 'ZIPSH':
-                line_str += 'id=,%s, %s,' % (trader.tid, trader.ttype)
+            line_str += 'id=,%s, %s,' % (trader.tid, trader.ttype)
 
-                if trader.ttype == 'ZIPSH':
-                    # we know that ZIPSH sorts the set of strats into best-first
-                    act_strat = trader.strats[0]['stratvec']
-                    act_prof = trader.strats[0]['pps']
-                else:
-                    act_strat = trader.strats[trader.active_strat]['stratval']
-                    act_prof = trader.strats[trader.active_strat]['pps']
-
-                line_str += 'actvstrat=,%s ' % trader.strat_csv_str(act_strat)
-                line_str += 'actvprof=,%f, ' % act_prof
-
-                if trader.tid[:1] == 'B':
-                    # this trader is a buyer
-                    if best_buyer_id is None or act_prof > best_buyer_prof:
-                        best_buyer_id = trader.tid
-                        best_buyer_strat = act_strat
-                        best_buyer_prof = act_prof
-                elif trader.tid[:1] == 'S':
-                    # this trader is a seller
-                    if best_seller_id is None or act_prof > best_seller_prof:
-                        best_seller_id = trader.tid
-                        best_seller_strat = act_strat
-                        best_seller_prof = act_prof
-                else:
-                    # wtf?
-                    sys.exit('unknown trader id type in market_session')
+            if trader.ttype == 'ZIPSH':
+                # we know that ZIPSH sorts the set of strats into best-first
+                act_strat = trader.strats[0]['stratvec']
+                act_prof = trader.strats[0]['pps']
+            else:
+                act_strat = trader.strats[trader.active_strat]['stratval']
+                act_prof = trader.strats[trader.active_strat]['pps']
+
+            line_str += 'actvstrat=,%s ' % trader.strat_csv_str(act_strat)
+            line_str += 'actvprof=,%f, ' % act_prof
+
+            if trader.tid[:1] == 'B':
+                # this trader is a buyer
+                if best_buyer_id is None or act_prof > best_buyer_prof:
+                    best_buyer_id = trader.tid
+                    best_buyer_strat = act_strat
+                    best_buyer_prof = act_prof
+            elif trader.tid[:1] == 'S':
+                # this trader is a seller
+                if best_seller_id is None or act_prof > best_seller_prof:
+                    best_seller_id = trader.tid
+                    best_seller_strat = act_strat
+                    best_seller_prof = act_prof
+            else:
+                # wtf?
+                sys.exit('unknown trader id type in market_session')
 
         if best_buyer_id is not None:
             line_str += 'best_B_id=,%s, best_B_prof=,%f, best_B_strat=, ' % (best_buyer_id, best_buyer_prof)
@@ -3058,9 +5582,16 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dum
 
         if verbose:
             print('line_str: %s' % line_str)
+        if isinstance(stratfile, ColumnStore):
+            # binary output: the time and the rest of the line are stored separately
+            stratfile.append('frames', (frametime, line_str[len(line_prefix):]))
+            return
         stratfile.write(line_str)
-        stratfile.flush()
-        os.fsync(stratfile)
+        if not isinstance(stratfile, (DumpWriter, CompressedFile)):
+            # a DumpWriter syncs the file itself, every so often; and flushing a CompressedFile ends its current
+            # chunk, so doing that every frame would compress each line on its own
+            stratfile.flush()
+            os.fsync(stratfile)
 
     def blotter_dump(session_id, trdrs):
         """
@@ -3069,7 +5600,15 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dum
         :param trdrs: the population of traders.
         :return: <nothing>
         """
-        bdump = open(session_id+'_blotters.csv', 'w')
+        bdump = open_dump(session_id+'_blotters.csv')
+        if isinstance(bdump, ColumnStore):
+            for trdr in trdrs:
+                bdump.append('traders', (trdrs[trdr].tid, len(trdrs[trdr].blotter)))
+                for b in trdrs[trdr].blotter:
+                    bdump.append('trades', (trdrs[trdr].tid, b['type'], b['time'], b['price'], b['party1'],
+                                            b['party2'], b['qty']))
+            bdump.close()
+            return
         for trdr in trdrs:
             bdump.write('%s, %d\n' % (trdrs[trdr].tid, len(trdrs[trdr].blotter)))
             for b in trdrs[trdr].blotter:
@@ -3077,6 +5616,32 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dum
                             % (traders[trdr].tid, b['type'], b['time'], b['price'], b['party1'], b['party2'], b['qty']))
         bdump.close()
 
+    def open_dump(fname):
+        """
+        Open an output file for writing: directly, or through a DumpWriter if dumpfile_flags asks for one,
+        or as a ColumnStore (in the directory named like the file but ending .bcol) if binary output is asked for.
+        :param fname: the name of the file.
+        :return: the open file.
+        """
+        output_format = dumpfile_flags.get('output_format', 'csv')
+        if output_format == 'columns':
+            output = fname[len(sess_id) + 1:-len('.csv')]
+            return ColumnStore(fname[:-len('.csv')] + '.bcol', output, {'expid': sess_id})
+        if output_format != 'csv':
+            sys.exit('FAIL: unknown output_format %s in market_session()' % output_format)
+        compression = dumpfile_flags.get('compression', None)
+        level = dumpfile_flags.get('compression_level', None)
+        if compression is not None:
+            if compression not in CompressedFile.suffixes:
+                sys.exit('FAIL: unknown compression %s in market_session()' % compression)
+            fname += CompressedFile.suffixes[compression]
+        if dumpfile_flags.get('background_writer', False):
+            return DumpWriter(fname, 'w', sync_interval=dumpfile_flags.get('sync_interval', 5.0),
+                              compression=compression, level=level)
+        if compression is not None:
+            return CompressedFile(fname, compression, level)
+        return open(fname, 'w')
+
     orders_verbose = False
     lob_verbose = False
     process_verbose = False
@@ -3085,32 +5650,116 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dum
     populate_verbose = False
 
     if dumpfile_flags['dump_strats']:
-        strat_dump = open(sess_id + '_strats.csv', 'w')
+        strat_dump = open_dump(sess_id + '_strats.csv')
     else:
         strat_dump = None
 
-    if dumpfile_flags['dump_lobs']:
-        lobframes = open(sess_id + '_LOB_frames.csv', 'w')
+    if dumpfile_flags['dump_lobs'] and dumpfile_flags.get('lob_frames', 'full') == 'delta':
+        if dumpfile_flags.get('output_format', 'csv') != 'csv':
+            sys.exit('FAIL: delta-encoded LOB frames are only written in csv output_format')
+        lobframes = LOBDeltaRecorder(open_dump(sess_id + '_LOB_deltas.csv'),
+                                     dumpfile_flags.get('keyframe_interval', 1000))
+    elif dumpfile_flags['dump_lobs']:
+        lobframes = open_dump(sess_id + '_LOB_frames.csv')
     else:
         lobframes = None
 
     if dumpfile_flags['dump_avgbals']:
-        avg_bals = open(sess_id + '_avg_balance.csv', 'w')
+        avg_bals = open_dump(sess_id + '_avg_balance.csv')
     else:
         avg_bals = None
         
     if dumpfile_flags['dump_tape']:
         # NB writing transactions only -- not writing cancellations
-        tape_dump = open(sess_id + '_tape.csv', 'w')
+        tape_dump = open_dump(sess_id + '_tape.csv')
     else:
         tape_dump = None
         
     # initialise the exchange
-    exchange = Exchange()
+    if dumpfile_flags.get('spill_tape', False):
+        # keep the whole session's tape: events too old for the in-memory tape are spilled to a memory-mapped file
+        exchange = Exchange(sess_id + '_tape_spill.dat')
+    else:
+        exchange = Exchange()
+
+    # decimation policies for the output files, if any
+    decimators = {}
+    for (output, policy) in dumpfile_flags.get('decimate', {}).items():
+        if output not in ('avg_balance', 'LOB_frames', 'tape'):
+            sys.exit('FAIL: output %s cannot be decimated (only avg_balance, LOB_frames, tape)' % output)
+        decimators[output] = Decimator(policy, output)
+    if 'LOB_frames' in decimators:
+        if dumpfile_flags.get('lob_frames', 'full') == 'delta':
+            sys.exit('FAIL: delta-encoded LOB frames cannot be decimated')
+        if decimators['LOB_frames'].kind == 'bucket' and decimators['LOB_frames'].agg != 'last':
+            sys.exit("FAIL: LOB frames can only be decimated into buckets with agg 'last'")
+    exchange.tape_decimator = decimators.get('tape')
+    exchange.lob_decimator = decimators.get('LOB_frames')
+
+    # index the supply and demand schedules, so customer_orders() can find the current one by binary search
+    order_schedule = dict(order_schedule)
+    order_schedule['sup_index'] = schedule_index(order_schedule['sup'])
+    order_schedule['dem_index'] = schedule_index(order_schedule['dem'])
 
     # create a bunch of traders
-    traders = {}
+    traders = TraderRegistry()
     trader_stats = populate_market(trader_spec, traders, True, populate_verbose)
+    traders.build_index()
+
+    # where the random numbers come from
+    rng_streams = None
+    cust_rng = random
+    if rng_seed is not None:
+        rng_streams = RandomStreams(rng_seed)
+        traders.rng = rng_streams.stream('select')
+        cust_rng = rng_streams.stream('orders')
+        for t in traders:
+            traders[t].rng = rng_streams.stream('trader/' + traders[t].ttype)
+
+    # running totals of balances etc for each type of trader, for trade_stats()
+    type_aggs = TypeAggregates(traders)
+
+    # group the traders into batches for respond_batch(): each batch is a run of consecutive traders of the same
+    # class, subscribed to the same market events, so the traders still respond in the same order as they would if
+    # each one's respond() was called in turn
+    respond_batches = []
+    for t in traders:
+        trader_class = type(traders[t])
+        respond_events = traders[t].respond_events
+        if len(respond_batches) > 0 and respond_batches[-1][0] is trader_class and \
+                respond_batches[-1][1] == respond_events:
+            respond_batches[-1][2].append(traders[t])
+        else:
+            respond_batches.append([trader_class, respond_events, [traders[t]]])
+
+    if zip_engine == 'vector':
+        if np is None:
+            print('WARNING: zip_engine=vector needs NumPy, which is not available; using zip_engine=scalar')
+        else:
+            # the ZIPPopulation engines draw their own random numbers, so here the batches can instead be one for
+            # all the traders of the same class that are subscribed to the same market events, in the order the
+            # first of each is met: i.e., one ZIPPopulation for all the vanilla ZIPs, and one for all the ZIPSHs
+            # (which respond to every event, for their strategy-optimization, so are batched separately)
+            class_batches = []
+            batch_index = {}
+            for (trader_class, respond_events, batch) in respond_batches:
+                batch_key = (trader_class, respond_events)
+                if batch_key not in batch_index:
+                    batch_index[batch_key] = len(class_batches)
+                    class_batches.append([trader_class, respond_events, []])
+                class_batches[batch_index[batch_key]][2].extend(batch)
+            respond_batches = class_batches
+            for (trader_class, respond_events, batch) in respond_batches:
+                if issubclass(trader_class, TraderZIP):
+                    if rng_streams is not None:
+                        ZIPPopulation(batch, np.random.default_rng(rng_streams.seed('zip/' + batch[0].ttype)))
+                    else:
+                        ZIPPopulation(batch)
+    elif zip_engine != 'scalar':
+        sys.exit('FAIL: unknown zip_engine %s in market_session()' % zip_engine)
+
+    # the respond_batches that respond to each set of market events, worked out the first time that set happens
+    responders = {}
 
     # timestep set so that can process all traders in one second
     # NB minimum interarrival time of customer orders may be much less than this!!
@@ -3120,7 +5769,7 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dum
 
     time = starttime
 
-    pending_cust_orders = []
+    pending_cust_orders = PendingOrders()
 
     if sess_vrbs:
         print('\n%s;  ' % sess_id)
@@ -3128,78 +5777,203 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dum
     # frames_done is record of what frames we have printed data for thus far
     frames_done = set()
 
-    while time < endtime:
-
-        # how much time left, as a percentage?
-        time_left = (endtime - time) / session_duration
-
+    def cancel_quotes(kill_time, kill_list):
+        """
+        If any newly-issued customer orders mean quotes on the LOB need to be cancelled, kill them.
+        :param kill_time: the current time.
+        :param kill_list: tids of traders whose customer orders have been overridden.
+        :return: <nothing>
+        """
+        for kill in kill_list:
+            # if verbose : print('lastquote=%s' % traders[kill].lastquote)
+            if traders[kill].lastquote is not None:
+                # if verbose : print('Killing order %s' % (str(traders[kill].lastquote)))
+                # NB if exchange.del_order() third argument = None then cancellations not written to tape file.
+                # exchange.del_order(kill_time, traders[kill].lastquote, tape_dump, sess_vrbs)
+                exchange.del_order(kill_time, traders[kill].lastquote, None, sess_vrbs)
+
+    def trader_turn(turn_time, turn_left, tid):
+        """
+        Give one trader the chance to issue an order; if it does, process the order and let all traders respond.
+        :param turn_time: the current time.
+        :param turn_left: how much of the session is left, as a fraction.
+        :param tid: the trader I.D. of the trader whose turn it is.
+        :return: if the trader issued an order, a list of the tids of the traders whose orders may have changed
+            (the trader itself; if there was a trade, the two parties to it; and any trader that responded and has
+            an order of its own to work, e.g. PT1/PT2); otherwise None.
+        """
+        # get a limit-order quote (or None) from the trader
+        order = traders[tid].getorder(turn_time, turn_left, exchange.publish_lob(turn_time, lobframes, lob_verbose))
         if sess_vrbs:
-            print('\n\n%s; t=%08.2f (%4.1f/100) ' % (sess_id, time, time_left*100))
+            print('trader=%s order=%s' % (tid, order))
 
+        if order is None:
+            return None
+
+        if order.otype == 'Ask' and order.price < traders[tid].orders[0].price:
+            sys.exit('Bad ask')
+        if order.otype == 'Bid' and order.price > traders[tid].orders[0].price:
+            sys.exit('Bad bid')
+        # send order to exchange
+        traders[tid].n_quotes = 1
+        trade = exchange.process_order(turn_time, order, tape_dump, process_verbose)
+        changed = [tid]
+        if trade is not None:
+            # trade occurred,
+            # so the counterparties update order lists and blotters
+            traders[trade['party1']].bookkeep(turn_time, trade, order, bookkeep_verbose)
+            traders[trade['party2']].bookkeep(turn_time, trade, order, bookkeep_verbose)
+            type_aggs.trade(traders[trade['party1']].ttype)
+            type_aggs.trade(traders[trade['party2']].ttype)
+            changed.extend([trade['party1'], trade['party2']])
+            if dumpfile_flags['dump_avgbals']:
+                trade_stats(sess_id, traders, avg_bals, turn_time,
+                            exchange.publish_lob(turn_time, lobframes, lob_verbose), type_aggs,
+                            decimators.get('avg_balance'))
+
+        # traders respond to whatever happened
+        lob = exchange.publish_lob(turn_time, lobframes, lob_verbose)
+        events = frozenset(exchange.market_events())
+        batches = responders.get(events)
+        if batches is None:
+            # leave out the batches of traders that nothing has happened for them to respond to
+            batches = [(trader_class, respond_events, batch)
+                       for (trader_class, respond_events, batch) in respond_batches
+                       if respond_events is None or not respond_events.isdisjoint(events)]
+            responders[events] = batches
+        any_record_frame = False
+        for (trader_class, respond_events, batch) in batches:
+            # NB respond just updates trader's internal variables
+            # doesn't alter the LOB, so processing each trader in
+            # sequence (rather than random/shuffle) isn't a problem
+            record_frame = trader_class.respond_batch(batch, turn_time, lob, trade, respond_verbose)
+            if record_frame:
+                any_record_frame = True
+            if trader_class.orders_self:
+                # responding may have given these traders orders (NB the event engine only wakes those asleep)
+                changed.extend([trader.tid for trader in batch if len(trader.orders) > 0])
+
+        # log all the PRSH/PRDE/ZIPSH strategy info for this timestep?
+        if any_record_frame and dumpfile_flags['dump_strats']:
+            # print one more frame to strategy dumpfile
+            dump_strats_frame(turn_time, strat_dump, traders)
+            # record that we've written this frame
+            frames_done.add(int(turn_time))
+
+        return changed
+
+    if engine == 'timestep':
+
+        while time < endtime:
+
+            # how much time left, as a percentage?
+            time_left = (endtime - time) / session_duration
+
+            if sess_vrbs:
+                print('\n\n%s; t=%08.2f (%4.1f/100) ' % (sess_id, time, time_left*100))
+
+            [pending_cust_orders, kills] = customer_orders(time, traders, trader_stats, order_schedule,
+                                                           pending_cust_orders, orders_verbose, cust_rng)
+
+            # if any newly-issued customer orders mean quotes on the LOB need to be cancelled, kill them
+            if len(kills) > 0:
+                # if verbose : print('Kills: %s' % (kills))
+                cancel_quotes(time, kills)
+
+            # give a randomly chosen trader the chance to issue an order
+            trader_turn(time, time_left, traders.random_tid())
+
+            time = time + timestep
+
+    elif engine == 'event':
+
+        # the event queue is a heap of [event_time, seq_number, event_type, tid] lists;
+        # seq_number breaks ties, so simultaneous events are processed in the order they were scheduled
+        events = []
+        n_events = 0
+        # traders with no wake-up event on the queue
+        asleep = set(traders)
+
+        def wake_trader(wake_time, tid):
+            """ Put this trader's next wake-up event on the queue """
+            nonlocal n_events
+            # mean interval between wake-ups is one second, as in the timestep engine
+            heapq.heappush(events, [wake_time + traders.rng.expovariate(1.0), n_events, 'Wake', tid])
+            n_events += 1
+            asleep.discard(tid)
+
+        def wake_idle_traders(wake_time, tids):
+            """ Wake any of the given traders that is asleep but now has an order to work """
+            for tid in tids:
+                if tid in asleep and len(traders[tid].orders) > 0:
+                    wake_trader(wake_time, tid)
+
+        # the first batch of customer orders
         [pending_cust_orders, kills] = customer_orders(time, traders, trader_stats,
-                                                       order_schedule, pending_cust_orders, orders_verbose)
-
-        # if any newly-issued customer orders mean quotes on the LOB need to be cancelled, kill them
-        if len(kills) > 0:
-            # if verbose : print('Kills: %s' % (kills))
-            for kill in kills:
-                # if verbose : print('lastquote=%s' % traders[kill].lastquote)
-                if traders[kill].lastquote is not None:
-                    # if verbose : print('Killing order %s' % (str(traders[kill].lastquote)))
-                    # NB if exchange.del_order() third argument = None then cancellations not written to tape file.
-                    # exchange.del_order(time, traders[kill].lastquote, tape_dump, sess_vrbs)
-                    exchange.del_order(time, traders[kill].lastquote, None, sess_vrbs)
-
-        # get a limit-order quote (or None) from a randomly chosen trader
-        tid = list(traders.keys())[random.randint(0, len(traders) - 1)]
-
-        order = traders[tid].getorder(time, time_left, exchange.publish_lob(time, lobframes, lob_verbose))
-        if sess_vrbs:
-            print('trader=%s order=%s' % (tid, order))
+                                                       order_schedule, pending_cust_orders, orders_verbose, cust_rng)
+        heapq.heappush(events, [time, n_events, 'Customer', None])
+        n_events += 1
+
+        while len(events) > 0 and events[0][0] < endtime:
+
+            [time, _, event_type, tid] = heapq.heappop(events)
+
+            time_left = (endtime - time) / session_duration
+
+            if sess_vrbs:
+                print('\n\n%s; t=%08.2f (%4.1f/100) %s %s' % (sess_id, time, time_left*100, event_type, tid))
+
+            if event_type == 'Customer':
+                # issue the customer orders that are now due
+                issued = []
+                [pending_cust_orders, kills] = customer_orders(time, traders, trader_stats, order_schedule,
+                                                               pending_cust_orders, orders_verbose, cust_rng,
+                                                               issued)
+                if len(kills) > 0:
+                    cancel_quotes(time, kills)
+                    # record any change to the LOB at the time it happened
+                    exchange.publish_lob(time, lobframes, lob_verbose)
+                if len(pending_cust_orders) < 1:
+                    # that was the last of the current batch, so generate the next batch
+                    [pending_cust_orders, kills] = customer_orders(time, traders, trader_stats,
+                                                                   order_schedule, pending_cust_orders,
+                                                                   orders_verbose, cust_rng)
+                # customer_orders() issues orders that are due strictly before the time it's called with, so the
+                # next customer event is at the first representable time after the next pending order is due
+                next_due = pending_cust_orders.next_time()
+                heapq.heappush(events, [math.nextafter(next_due, math.inf), n_events, 'Customer', None])
+                n_events += 1
+                # only the traders that have just been given orders can need waking
+                wake_idle_traders(time, issued)
+
+            elif event_type == 'Wake':
+                asleep.add(tid)
+                # NB if the trader has no order to work, it stays asleep until it is given one
+                if len(traders[tid].orders) > 0:
+                    changed = trader_turn(time, time_left, tid)
+                    if changed is not None:
+                        # the trader may still have an order to work, the parties to any trade may have been given
+                        # new orders by their bookkeep(), and PT1/PT2 may have given themselves orders in respond()
+                        wake_idle_traders(time, changed)
+                    else:
+                        wake_trader(time, tid)
 
-        if order is not None:
-            if order.otype == 'Ask' and order.price < traders[tid].orders[0].price:
-                sys.exit('Bad ask')
-            if order.otype == 'Bid' and order.price > traders[tid].orders[0].price:
-                sys.exit('Bad bid')
-            # send order to exchange
-            traders[tid].n_quotes = 1
-            trade = exchange.process_order(time, order, tape_dump, process_verbose)
-            if trade is not None:
-                # trade occurred,
-                # so the counterparties update order lists and blotters
-                traders[trade['party1']].bookkeep(time, trade, order, bookkeep_verbose)
-                traders[trade['party2']].bookkeep(time, trade, order, bookkeep_verbose)
-                if dumpfile_flags['dump_avgbals']:
-                    trade_stats(sess_id, traders, avg_bals, time, exchange.publish_lob(time, lobframes, lob_verbose))
-
-            # traders respond to whatever happened
-            lob = exchange.publish_lob(time, lobframes, lob_verbose)
-            any_record_frame = False
-            for t in traders:
-                # NB respond just updates trader's internal variables
-                # doesn't alter the LOB, so processing each trader in
-                # sequence (rather than random/shuffle) isn't a problem
-                record_frame = traders[t].respond(time, lob, trade, respond_verbose)
-                if record_frame:
-                    any_record_frame = True
-
-            # log all the PRSH/PRDE/ZIPSH strategy info for this timestep?
-            if any_record_frame and dumpfile_flags['dump_strats']:
-                # print one more frame to strategy dumpfile
-                dump_strats_frame(time, strat_dump, traders)
-                # record that we've written this frame
-                frames_done.add(int(time))
-
-        time = time + timestep
+        time = endtime
+
+    else:
+        sys.exit('FAIL: unknown engine %s in market_session()' % engine)
 
     # session has ended
 
     # write trade_stats for this session (NB could use this to write end-of-session summary only)
     if dumpfile_flags['dump_avgbals']:
-        trade_stats(sess_id, traders, avg_bals, time, exchange.publish_lob(time, lobframes, lob_verbose))
+        trade_stats(sess_id, traders, avg_bals, time, exchange.publish_lob(time, lobframes, lob_verbose), type_aggs,
+                    decimators.get('avg_balance'), last=True)
         avg_bals.close()
 
+    # write anything that the decimators have held back
+    exchange.flush_decimators(tape_dump, lobframes)
+
     if dumpfile_flags['dump_blotters']:
         # record the blotter for each trader
         blotter_dump(sess_id, traders)
@@ -3210,6 +5984,313 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, dum
     if dumpfile_flags['dump_lobs']:
         lobframes.close()
 
+    if dumpfile_flags['dump_tape']:
+        tape_dump.close()
+
+    exchange.tape.close()
+
+
+def trial_seed(master_seed, trial_id):
+    """
+    Derive the random-number seed for one trial from the master seed and the trial's i.d. string.
+    The same master seed and trial i.d. always give the same seed (on any machine, in any process), and different
+    trial i.d.s give seeds that are in effect independent of each other.
+    :param master_seed: the master seed for the whole set of trials.
+    :param trial_id: the trial's i.d. string.
+    :return: the trial's seed, a 64-bit non-negative integer.
+    """
+    digest = hashlib.sha256(('%s/%s' % (master_seed, trial_id)).encode()).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+def run_trial(trial_args):
+    """
+    Run one trial (i.e. one market session) with its own seed: this is what each worker process in run_trials() does.
+    :param trial_args: [trial_id, seed, start_time, end_time, trader_spec, order_schedule, dumpfile_flags, vrbs,
+            engine]
+    :return: the trial_id.
+    """
+    [trial_id, seed, start_time, end_time, trader_spec, order_schedule, dumpfile_flags, vrbs, engine] = trial_args
+    random.seed(seed)
+    market_session(trial_id, start_time, end_time, trader_spec, order_schedule, dumpfile_flags, vrbs, engine)
+    return trial_id
+
+
+def merge_trial_files(trial_ids, merged_id, suffixes):
+    """
+    Merge the per-trial output files into one file per suffix, taking the trials in the order given.
+    Lines that don't already start with their trial's i.d. (e.g. those in the tape and blotter files) have it added
+    as an extra first column, so that every line of a merged file says which trial it came from.
+    :param trial_ids: the trial i.d. strings, in the order they're to be merged.
+    :param merged_id: the i.d. string used to name the merged files, e.g. merged_id + '_avg_balance.csv'.
+    :param suffixes: which output files to merge, e.g. ['_avg_balance.csv', '_tape.csv'].
+    :return: <nothing>
+    """
+    for suffix in suffixes:
+        # the trials' files might have been written compressed, in which case the merged file is compressed too
+        for compression_suffix in [''] + list(CompressedFile.suffixes.values()):
+            merged = None
+            for trial_id in trial_ids:
+                fname = trial_id + suffix + compression_suffix
+                if not os.path.exists(fname):
+                    continue
+                if merged is None:
+                    merged_fname = merged_id + suffix + compression_suffix
+                    if compression_suffix == '':
+                        merged = open(merged_fname, 'w')
+                    else:
+                        merged = CompressedFile(merged_fname, CompressedFile.compression_of(merged_fname))
+                for line in read_dump_lines(fname):
+                    if line.startswith(trial_id):
+                        merged.write(line)
+                    else:
+                        merged.write('%s, %s' % (trial_id, line))
+            if merged is not None:
+                merged.close()
+
+
+def run_trials(trials, start_time, end_time, trader_spec, order_schedule, master_seed, n_workers=None,
+               merged_id=None, vrbs=False, engine='timestep'):
+    """
+    Run a set of trials (market sessions), spread over a pool of worker processes.
+    Each trial is seeded with trial_seed(master_seed, trial_id), so the results of every trial depend only on the
+    master seed and its trial i.d.: re-running with the same master seed reproduces exactly the same output files,
+    however many workers there are and whichever order the trials happen to finish in.
+    NB the trader_spec and order_schedule are sent to the worker processes, so any offset functions in the order
+    schedule have to be picklable: module-level functions or objects such as OffsetEventList, not lambdas.
+    :param trials: list of [trial_id, dumpfile_flags] pairs: each trial writes its own output files, named by trial_id.
+    :param start_time: the time each session starts.
+    :param end_time: the time each session ends.
+    :param trader_spec: specification of the traders populating the market.
+    :param order_schedule: specification of the customer orders, i.e. the supply/demand schedule.
+    :param master_seed: the master random-number seed that each trial's seed is derived from.
+    :param n_workers: how many worker processes to use; if None, one per CPU; if 1, run in this process.
+    :param merged_id: if not None, the per-trial output files are merged into files named merged_id + suffix: any
+            output written as a ColumnStore is converted to CSV first; delta-encoded LOB frames can't be merged.
+    :param vrbs: verbosity passed to each market session (best used with n_workers=1, else the output is jumbled).
+    :param engine: market_session() engine, 'timestep' or 'event'.
+    :return: dictionary of the seed used for each trial_id.
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    # the output files each of the dumpfile_flags switches on, in the order they're merged
+    merge_outputs = [('dump_avgbals', '_avg_balance.csv'), ('dump_tape', '_tape.csv'),
+                     ('dump_blotters', '_blotters.csv'), ('dump_strats', '_strats.csv'),
+                     ('dump_lobs', '_LOB_frames.csv')]
+
+    seeds = {}
+    trial_args = []
+    for [trial_id, dumpfile_flags] in trials:
+        if trial_id in seeds:
+            sys.exit('FAIL: duplicate trial_id %s in run_trials()' % trial_id)
+        delta_lobs = dumpfile_flags['dump_lobs'] and dumpfile_flags.get('lob_frames', 'full') == 'delta'
+        if merged_id is not None and delta_lobs:
+            # each delta file only makes sense read from its own first keyframe, so they can't be merged into one
+            sys.exit("FAIL: run_trials() can't merge the delta-encoded LOB frames of trial %s: use lob_frames='full' "
+                     "or merged_id=None" % trial_id)
+        seeds[trial_id] = trial_seed(master_seed, trial_id)
+        trial_args.append([trial_id, seeds[trial_id], start_time, end_time, trader_spec, order_schedule,
+                           dumpfile_flags, vrbs, engine])
+
+    if n_workers <= 1:
+        for args in trial_args:
+            run_trial(args)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as pool:
+            # list() waits for all the trials to finish, and passes on any exception raised in a worker
+            list(pool.map(run_trial, trial_args))
+
+    if merged_id is not None:
+        # merge just the outputs the trials wrote, after converting any ColumnStores to the CSV files they stand for
+        suffixes = []
+        for (flag, suffix) in merge_outputs:
+            for [trial_id, dumpfile_flags] in trials:
+                if not dumpfile_flags[flag]:
+                    continue
+                if dumpfile_flags.get('output_format', 'csv') == 'columns':
+                    column_store_to_csv(trial_id + suffix[:-len('.csv')] + '.bcol')
+                if suffix not in suffixes:
+                    suffixes.append(suffix)
+        merge_trial_files([trial[0] for trial in trials], merged_id, suffixes)
+
+    return seeds
+
+
+def strategy_mixes(n_types, n_traders, min_n):
+    """
+    Enumerate every way of splitting a population of traders between a number of trader-types (i.e. the points on
+    the simplex of strategy mixes), in the same order as nested loops over the counts would.
+    :param n_types: how many different trader-types.
+    :param n_traders: the total number of traders.
+    :param min_n: the minimum number of traders of each type.
+    :return: list of mixes, each a list of n_types counts that sum to n_traders.
+    """
+    if n_types == 1:
+        if n_traders >= min_n:
+            return [[n_traders]]
+        return []
+    mixes = []
+    for n in range(min_n, n_traders + 1):
+        for rest in strategy_mixes(n_types - 1, n_traders - n, min_n):
+            mixes.append([n] + rest)
+    return mixes
+
+
+def run_sweep_cell(cell_args):
+    """
+    Run one cell of a sweep, i.e. one trial of one strategy mix: this is what each worker process in run_sweep() does.
+    :param cell_args: [trial_id, seed, start_time, end_time, trader_spec, order_schedule, engine]
+    :return: [trial_id, the trade_stats() line for the end of the session]
+    """
+    [trial_id, seed, start_time, end_time, trader_spec, order_schedule, engine] = cell_args
+    random.seed(seed)
+    dump_flags = {'dump_blotters': False, 'dump_lobs': False, 'dump_strats': False,
+                  'dump_avgbals': True, 'dump_tape': False}
+    market_session(trial_id, start_time, end_time, trader_spec, order_schedule, dump_flags, False, engine)
+    # the last line of the session's avg_balance file is the end-of-session summary: that's all the sweep keeps
+    fname = trial_id + '_avg_balance.csv'
+    with open(fname, 'r') as avg_bals:
+        final_line = avg_bals.readlines()[-1]
+    os.remove(fname)
+    return [trial_id, final_line]
+
+
+def run_sweep(sweep_id, trader_types, n_traders, n_trials_per_mix, start_time, end_time, order_schedule,
+              master_seed, min_n=1, n_workers=None, engine='timestep'):
+    """
+    Run an exhaustive sweep over all mixes of a set of trader-types, with n_trials_per_mix trials of each mix
+    (each mix applies to both the buyers and the sellers), spreading the trials over a pool of worker processes.
+    The sweep is checkpointed: as each trial finishes its end-of-session balances are appended to the file
+    sweep_id + '_manifest.csv', and if the sweep is stopped (or crashes) then calling run_sweep() again with the same
+    arguments carries on from where it stopped, running only the trials that aren't yet in the manifest.
+    When all the trials are done, the balances are written, in sweep order, to one table: sweep_id + '_balances.csv',
+    which has the same four columns (type, balance, number of traders, profit per trader) for each of the trader_types,
+    in the order they're given, with zeros for any type that isn't in a trial's mix.
+    If a trial raises an exception, the other trials are still run and recorded in the manifest; once they've all
+    finished, the trials that failed are listed and the first exception is raised again.
+    Each trial is seeded with trial_seed(master_seed, trial_id), so its results don't depend on whether it was run
+    before or after a restart.
+    :param sweep_id: the i.d. string for this sweep, used in naming its files and its trials.
+    :param trader_types: list of the trader-types to mix: each is a type string (e.g. 'ZIC'), or a
+            [type, parameters] pair for trader-types that take parameters (e.g. ['PRZI', {'s_min': -1, 's_max': 1}]).
+            NB balances are totalled by type, so the same type can't be listed twice (e.g. with different parameters).
+    :param n_traders: the number of buyers (and of sellers) in each market.
+    :param n_trials_per_mix: how many trials to run for each mix.
+    :param start_time: the time each session starts.
+    :param end_time: the time each session ends.
+    :param order_schedule: specification of the customer orders, i.e. the supply/demand schedule.
+    :param master_seed: the master random-number seed that each trial's seed is derived from.
+    :param min_n: the minimum number of traders of each type in any mix.
+    :param n_workers: how many worker processes to use; if None, one per CPU; if 1, run in this process.
+    :param engine: market_session() engine, 'timestep' or 'event'.
+    :return: the number of trials run by this call.
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    type_names = [trader_type if isinstance(trader_type, str) else trader_type[0] for trader_type in trader_types]
+    if len(set(type_names)) < len(type_names):
+        sys.exit('FAIL: run_sweep() trader_types %s lists the same type more than once, so their balances would be '
+                 'totalled together' % type_names)
+
+    # first line of the manifest records the sweep's arguments, so a resumed sweep can check that they're the same
+    signature = '# sweep=%s types=%s n_traders=%d n_trials_per_mix=%d min_n=%d start=%s end=%s seed=%s engine=%s\n' \
+                % (sweep_id, trader_types, n_traders, n_trials_per_mix, min_n, start_time, end_time, master_seed,
+                   engine)
+
+    cells = []
+    for mix_number, mix in enumerate(strategy_mixes(len(trader_types), n_traders, min_n)):
+        buyers_spec = []
+        for (trader_type, n) in zip(trader_types, mix):
+            if n > 0:
+                if isinstance(trader_type, str):
+                    buyers_spec.append((trader_type, n))
+                else:
+                    buyers_spec.append((trader_type[0], n, trader_type[1]))
+        trader_spec = {'sellers': buyers_spec, 'buyers': buyers_spec}
+        for trial in range(n_trials_per_mix):
+            trial_id = '%s_m%05d_t%04d' % (sweep_id, mix_number, trial)
+            cells.append([trial_id, trial_seed(master_seed, trial_id), start_time, end_time, trader_spec,
+                          order_schedule, engine])
+
+    # read back the manifest from any earlier run of this sweep
+    manifest_name = sweep_id + '_manifest.csv'
+    done = {}
+    if os.path.exists(manifest_name):
+        with open(manifest_name, 'r') as manifest:
+            lines = manifest.readlines()
+        if len(lines) > 0 and lines[0] != signature:
+            sys.exit('FAIL: %s is the manifest of a sweep with different arguments' % manifest_name)
+        # a line without a newline at the end was being written when the sweep stopped, so is ignored
+        lines = [line for line in lines[1:] if line.endswith('\n')]
+        for line in lines:
+            [trial_id, final_line] = line.split(', ', 1)
+            done[trial_id] = final_line
+        with open(manifest_name, 'w') as manifest:
+            manifest.write(signature)
+            manifest.writelines(lines)
+    else:
+        with open(manifest_name, 'w') as manifest:
+            manifest.write(signature)
+
+    todo = [cell for cell in cells if cell[0] not in done]
+
+    with open(manifest_name, 'a') as manifest:
+
+        def record(trial_id, final_line):
+            """ Add a finished trial to the manifest, and make sure it's on disk before carrying on """
+            manifest.write('%s, %s' % (trial_id, final_line))
+            manifest.flush()
+            os.fsync(manifest.fileno())
+            done[trial_id] = final_line
+
+        # a trial that fails (NB BSE's fatal errors call sys.exit()) doesn't stop the others: they're all recorded,
+        # and the failures are reported at the end
+        failures = []
+        if n_workers <= 1:
+            for cell in todo:
+                try:
+                    record(*run_sweep_cell(cell))
+                except (Exception, SystemExit) as err:
+                    failures.append([cell[0], err])
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as pool:
+                futures = {pool.submit(run_sweep_cell, cell): cell[0] for cell in todo}
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        record(*future.result())
+                    except (Exception, SystemExit) as err:
+                        failures.append([futures[future], err])
+
+    if len(failures) > 0:
+        for (trial_id, err) in failures:
+            print('run_sweep %s: trial %s failed: %r' % (sweep_id, trial_id, err))
+        print('run_sweep %s: %d of %d trials failed; the rest are in %s, so calling run_sweep() again re-runs only the '
+              'failed trials' % (sweep_id, len(failures), len(todo), manifest_name))
+        raise failures[0][1]
+
+    # all done: write the consolidated balances table, in sweep order
+    with open(sweep_id + '_balances.csv', 'w') as balances:
+        balances.write('expid, time, best_bid, best_ask, ')
+        for type_name in type_names:
+            balances.write('type, balance, number of traders, profit per trader, ')
+        balances.write('\n')
+        for cell in cells:
+            # each trade_stats() line has four columns for each type in the trial, in alphabetical order of type:
+            # rearrange them into the order of trader_types, with zeros for any type missing from this trial's mix
+            fields = done[cell[0]].split(', ')
+            groups = {}
+            for g in range(4, len(fields) - 3, 4):
+                groups[fields[g]] = fields[g:g + 4]
+            balances.write(', '.join(fields[0:4]) + ', ')
+            for type_name in type_names:
+                group = groups.get(type_name, [type_name, '0', '0', '%f' % 0.0])
+                balances.write(', '.join(group) + ', ')
+            balances.write('\n')
+
+    return len(todo)
+
 
 #############################
 # # Below here is where we set up and run a whole series of experiments
@@ -3231,119 +6312,6 @@ if __name__ == "__main__":
     duration = end_time - start_time
 
 
-    def schedule_offsetfn_read_file(filename, col_t, col_p, scale_factor=75):
-        """
-        Read in a CSV data-file for the supply/demand schedule time-varying price-offset value
-        :param filename: the CSV file to read
-        :param col_t: column in the CSV that has the time data
-        :param col_p: column in the CSV that has the price data
-        :param scale_factor: multiplier on prices
-        :return: on offset value event-list: one item for each change in offset value
-                -- each item is percentage time elapsed, followed by the new offset value at that time
-        """
-        
-        vrbs = True
-        
-        # does two passes through the file
-        # assumes data file is all for one date, sorted in time order, in correct format, etc. etc.
-        rwd_csv = csv.reader(open(filename, 'r'))
-        
-        # first pass: get time & price events, find out how long session is, get min & max price
-        minprice = None
-        maxprice = None
-        firsttimeobj = None
-        timesincestart = 0
-        priceevents = []
-        
-        first_row_is_header = True
-        this_is_first_row = True
-        this_is_first_data_row = True
-        first_date = None
-        
-        for line in rwd_csv:
-            
-            if vrbs:
-                print(line)
-            
-            if this_is_first_row and first_row_is_header:
-                this_is_first_row = False
-                this_is_first_data_row = True
-                continue
-                
-            row_date = line[col_t][:10]
-            
-            if this_is_first_data_row:
-                first_date = row_date
-                this_is_first_data_row = False
-                
-            if row_date != first_date:
-                continue
-                
-            time = line[col_t][11:19]
-            if firsttimeobj is None:
-                firsttimeobj = datetime.strptime(time, '%H:%M:%S')
-                
-            timeobj = datetime.strptime(time, '%H:%M:%S')
-            
-            price_str = line[col_p]
-            # delete any commas so 1,000,000 becomes 1000000
-            price_str_no_commas = price_str.replace(',', '')
-            price = float(price_str_no_commas)
-            
-            if minprice is None or price < minprice:
-                minprice = price
-            if maxprice is None or price > maxprice:
-                maxprice = price
-            timesincestart = (timeobj - firsttimeobj).total_seconds()
-            priceevents.append([timesincestart, price])
-            
-            if vrbs:
-                print(row_date, time, timesincestart, price)
-            
-        # second pass: normalise times to fractions of entire time-series duration
-        #              & normalise price range
-        pricerange = maxprice - minprice
-        endtime = float(timesincestart)
-        offsetfn_eventlist = []
-        for event in priceevents:
-            # normalise price
-            normld_price = (event[1] - minprice) / pricerange
-            # clip
-            normld_price = min(normld_price, 1.0)
-            normld_price = max(0.0, normld_price)
-            # scale & convert to integer cents
-            price = int(round(normld_price * scale_factor))
-            normld_event = [event[0] / endtime, price]
-            if vrbs:
-                print(normld_event)
-            offsetfn_eventlist.append(normld_event)
-        
-        return offsetfn_eventlist
-
-
-    def schedule_offsetfn_from_eventlist(time, params):
-        """
-        Returns a price offset-value for the current time, by reading from an offset event-list.
-        :param time: the current time
-        :param params: a list of parameter values...
-            params[1] is the final time (the end-time) of the current session.
-            params[2] is the offset event-list: one item for each change in offset value
-                        -- each item is percentage time elapsed, followed by the new offset value at that time
-        :return: integer price offset value
-        """
-
-        final_time = float(params[0])
-        offset_events = params[1]
-        # this is quite inefficient: on every call it walks the event-list
-        percent_elapsed = time/final_time
-        offset = None
-        for event in offset_events:
-            offset = event[1]
-            if percent_elapsed < event[0]:
-                break
-        return offset
-
-
     def schedule_offsetfn_increasing_sinusoid(t, params):
         """
         Returns sinusoidal time-dependent price-offset, steadily increasing in frequency & amplitude
@@ -3362,6 +6330,10 @@ if __name__ == "__main__":
     #
     # range1 = (10, 190, (schedule_offsetfn, args)) # args is the list of arguments to the function
     # range2 = (200, 300, (schedule_offsetfn, args))
+    #
+    # An offset function that is costly to compute can instead be tabulated once, on a time-grid:
+    #
+    # range1 = (10, 190, (OffsetGrid(schedule_offsetfn, args, start_time, end_time, 1.0), []))
 
     # Here is an example of how to switch from range1 to range2 and then back to range1,
     # introducing two "market shocks"
@@ -3376,12 +6348,15 @@ if __name__ == "__main__":
     if price_offset_filename is not None:
         offsetfn_events = schedule_offsetfn_read_file(price_offset_filename, 0, 1)
 
+    # the offset event-list is compiled once, so that looking up the offset for each customer order is quick
+    offsetfn_from_eventlist = OffsetEventList(end_time, offsetfn_events)
+
     # supply schedule (defines the supply curve)
-    range1 = (75, 110, (schedule_offsetfn_from_eventlist, [[end_time, offsetfn_events]]))
+    range1 = (75, 110, (offsetfn_from_eventlist, []))
     supply_schedule = [{'from': start_time, 'to': end_time, 'ranges': [range1], 'stepmode': 'random'}]
 
     # demand schedule (defines the demand curve)
-    range2 = (125, 90, (schedule_offsetfn_from_eventlist, [[end_time, offsetfn_events]]))
+    range2 = (125, 90, (offsetfn_from_eventlist, []))
     demand_schedule = [{'from': start_time, 'to': end_time, 'ranges': [range2], 'stepmode': 'random'}]
 
     # new customer orders arrive at each trader approx once every order_interval seconds
@@ -3436,49 +6411,31 @@ if __name__ == "__main__":
 
         trial = trial + 1
 
+    # The code in comments below here is for illustration, in case you want to run many trials in parallel: if its of
+    # no interest, it can be deleted.
+    #
+    # run_trials() spreads the trials over a pool of worker processes (n_workers=None means one per CPU core), and
+    # each trial's random-number seed is derived from master_seed and its trial_id, so re-running with the same
+    # master_seed reproduces exactly the same results. If merged_id is not None, each trial's data-files are then
+    # merged into one set of files.
+    #
+    # master_seed = 0
+    # n_workers = None
+    # trials = []
+    # for trial in range(1, n_trials + 1):
+    #     trial_id = 'bse_d%03d_i%02d_%04d' % (n_days, order_interval, trial)
+    #     trials.append([trial_id, dump_flags])
+    # merged_id = 'bse_d%03d_i%02d_all' % (n_days, order_interval)
+    # run_trials(trials, start_time, end_time, traders_spec, order_sched, master_seed, n_workers, merged_id, verbose)
+
     # The code in comments below here is for illustration, in case you want to do an exhaustive sweep of all possible
     # combinations of some set of trading strategies: if its of no interest, it can be deleted.
     #
-    # run a sequence of trials that exhaustively varies the ratio of four trader types
+    # run a sweep that exhaustively varies the ratio of four trader types, with 50 trials of each ratio.
     # NB this has weakness of symmetric proportions on buyers/sellers -- combinatorics of varying that are quite nasty
+    # If the sweep is interrupted, running it again picks up where it left off.
     #
-    # n_trader_types = 4
-    # equal_ratio_n = 4
+    # n_traders = 16
     # n_trials_per_ratio = 50
-    #
-    # n_traders = n_trader_types * equal_ratio_n
-    #
-    # fname = 'balances_%03d.csv' % equal_ratio_n
-    #
-    # tdump = open(fname, 'w')
-    #
-    # min_n = 1
-    #
-    # trialnumber = 1
-    # trdr_1_n = min_n
-    # while trdr_1_n <= n_traders:
-    #     trdr_2_n = min_n
-    #     while trdr_2_n <= n_traders - trdr_1_n:
-    #         trdr_3_n = min_n
-    #         while trdr_3_n <= n_traders - (trdr_1_n + trdr_2_n):
-    #             trdr_4_n = n_traders - (trdr_1_n + trdr_2_n + trdr_3_n)
-    #             if trdr_4_n >= min_n:
-    #                 buyers_spec = [('GVWY', trdr_1_n), ('SHVR', trdr_2_n),
-    #                                ('ZIC', trdr_3_n), ('ZIP', trdr_4_n)]
-    #                 sellers_spec = buyers_spec
-    #                 traders_spec = {'sellers': sellers_spec, 'buyers': buyers_spec}
-    #                 # print buyers_spec
-    #                 trial = 1
-    #                 while trial <= n_trials_per_ratio:
-    #                     trial_id = 'trial%07d' % trialnumber
-    #                     market_session(trial_id, start_time, end_time, traders_spec,
-    #                                    order_sched, tdump, False, True)
-    #                     tdump.flush()
-    #                     trial = trial + 1
-    #                     trialnumber = trialnumber + 1
-    #             trdr_3_n += 1
-    #         trdr_2_n += 1
-    #     trdr_1_n += 1
-    # tdump.close()
-    #
-    # print(trialnumber)
+    # run_sweep('balances_%03d' % n_traders, ['GVWY', 'SHVR', 'ZIC', 'ZIP'], n_traders, n_trials_per_ratio,
+    #           start_time, end_time, order_sched, master_seed=0, min_n=1, n_workers=None)
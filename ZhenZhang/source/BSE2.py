@@ -48,6 +48,7 @@
 import sys
 import math
 import random
+import bisect
 import csv
 from datetime import datetime
 
@@ -68,6 +69,7 @@ from ZZISHV import Trader_ZZISHV
 bse_sys_minprice = 1  # minimum price in the system, in cents/pennies
 bse_sys_maxprice = 200  # maximum price in the system, in cents/pennies: Todo -- eliminate reliance on this
 ticksize = 1  # minimum change in price, in cents/pennies
+lob_backend = 'dict'  # 'dict' rebuilds each side of the LOB from scratch on every change; 'ladder' uses a tick-ladder
 
 
 
@@ -112,7 +114,7 @@ class Orderbook_half:
                 # OXO stores details of "other" for OSO and OCO orders
                 self.oxo = []
                 # summary stats
-                # self.best_price = None
+                self.best_price = None
                 self.worst_price = worstprice
                 # self.n_orders = 0  # how many orders?
                 # self.lob_depth = 0  # how many different prices on lob?
@@ -203,11 +205,9 @@ class Orderbook_half:
                 if verbose: print self.lob_anon
 
                 # record best price and associated trader-id
+                # lob_anon is sorted best price first on both sides of the book
                 if len(self.lob) > 0 :
-                        if self.booktype == 'Bid':
-                                self.best_price = self.lob_anon[-1][0] #assumes reverse order COME BACK HERE
-                        else :
-                                self.best_price = self.lob_anon[0][0]
+                        self.best_price = self.lob_anon[0][0]
                 else :
                         self.best_price = None
 
@@ -307,16 +307,16 @@ class Orderbook_half:
 
                 # initial checks, return FAIL if there is simply no hope of executing this order
 
-                if len(self.lob) == 0:
+                if self.book_is_empty():
                         # no point going any further; LOB is empty
                         add_msg(msg_list, order.tid, order.orderid, "FAIL", [], None, fee, verbose)
                         return {"TraderMsgs": msg_list, "TapeEvents": tape_events}
 
                 # how deep is the book? (i.e. what is cumulative qty available) at this order's indicated price level?
                 depth = 0
-                for level in self.lob_anon:
-                        if self.equaltoorbetterthan(level[0], order.price, verbose):
-                                depth += level[1]
+                for (level_price, level_qty) in self.book_levels():
+                        if self.equaltoorbetterthan(level_price, order.price, verbose):
+                                depth += level_qty
                         else:  # we're past the level in the LOB where the prices are good for this order
                                 break
 
@@ -325,7 +325,7 @@ class Orderbook_half:
                         # so we first check that this order can in principle be filled: is there enough liquidity available?
                         if depth < order.qty:
                                 # there is not enough depth at prices that allow this order to completely fill
-                                add_msg(msg_list, order.tid, order.oid, "FAIL", [], None, fee, verbose)
+                                add_msg(msg_list, order.tid, order.orderid, "FAIL", [], None, fee, verbose)
                                 # NB here book_take() sends a msg back that an AON order is FAIL, that needs to be picked up by the
                                 # exchange logic and not passed back to the trader concerned, unless the AON has actually timed out
                                 return {"TraderMsgs": msg_list, "TapeEvents": tape_events}
@@ -359,7 +359,7 @@ class Orderbook_half:
 
                 qty_remaining = order.qty
 
-                best_lob_price = self.lob[0][0]
+                best_lob_price = self.book_best()[0]
 
                 good_price = True
 
@@ -367,9 +367,11 @@ class Orderbook_half:
                         good_price = self.equaltoorbetterthan(best_lob_price, order.price, verbose)
 
                 # this while loop consumes the top of the LOB while trying to fill the order
-                while good_price and (qty_remaining > 0) and (len(self.orders)>0):
+                while good_price and (qty_remaining > 0) and (not self.book_is_empty()):
 
-                        good_price = self.equaltoorbetterthan(self.lob[0][0], order.price, verbose)
+                        (best_lob_price, best_lob_order) = self.book_best()
+
+                        good_price = self.equaltoorbetterthan(best_lob_price, order.price, verbose)
 
                         if verbose:
                                 print('BK_TAKE: qty_rem=%d; lob=%s; good_price=%s' % (qty_remaining, str(self.lob), good_price))
@@ -379,12 +381,9 @@ class Orderbook_half:
                                 # current LOB best price is unacceptable for IOC
                                 if verbose: print(
                                                 'BK_TAKE: IOC breaks out of while loop (otype=%s best LOB price = %d; order price = %d)' %
-                                                (order.otype, self.lob[0][0], order.price))
+                                                (order.otype, best_lob_price, order.price))
                                 break  # out of the while loop
 
-                        best_lob_price = self.lob[0][0]
-                        best_lob_orders = self.lob[0][1]
-                        best_lob_order = best_lob_orders[0]
                         best_lob_order_qty = best_lob_order[1]
                         best_lob_order_tid = best_lob_order[2]
                         best_lob_order_oid = best_lob_order[3]
@@ -406,7 +405,6 @@ class Orderbook_half:
                                 qty = qty_remaining
                                 price = best_lob_price
                                 qty_filled = qty_filled + qty
-                                best_lob_order_qty = best_lob_order_qty - qty
                                 # the incoming order is a complete fill
                                 transaction = {"Price":price, "Qty":qty}
                                 trnsctns.append(transaction)
@@ -419,29 +417,19 @@ class Orderbook_half:
 
                                 # so far have dealt with effect of match on incoming order
                                 # now need to deal with effect of match on best order on LOB (the other side of the deal)
-                                if best_lob_order_qty > 0:
+                                self.book_consume_best(qty)
+                                if best_lob_order_qty > qty:
                                         # the best LOB order is only partially consumed
-                                        best_lob_order[1] = best_lob_order_qty
-                                        best_lob_orders[0] = best_lob_order
-                                        self.lob[0][1] = best_lob_orders
-                                        self.orders[best_lob_order_oid].qty = best_lob_order_qty
+                                        self.orders[best_lob_order_oid].qty = best_lob_order_qty - qty
                                         # The LOB order it matched against is only a partial fill
                                         add_msg(msg_list, best_lob_order_tid, best_lob_order_oid, "PART", [transaction], self.orders[best_lob_order_oid], fee, verbose)
                                         # add_tapeitem(tape_events, 'Trade', time, price, qty, tid_from, tid_to, verbose)
                                 else:
-                                        # the best LOB order is fully consumed: delete it from LOB
-                                        del(best_lob_orders[0])
+                                        # the best LOB order is fully consumed: delete it from the order-list
                                         del(self.orders[best_lob_order_oid])
                                         # The LOB order it matched against also complete
                                         add_msg(msg_list, best_lob_order_tid, best_lob_order_oid, "FILL", [transaction], None, fee, verbose)
                                         # add_tapeitem(tape_events, 'Trade', time, price, qty, tid_from, tid_to, verbose)
-                                        # check: are there other remaining orders at this price?
-                                        if len(best_lob_orders) > 0:
-                                                # yes
-                                                self.lob[0][1] = best_lob_orders
-                                        else:
-                                                # no
-                                                del (self.lob[0])  # consumed the last order on the LOB at this price
                                 qty_remaining = 0  # liquidity-taking all done
                         else:
                                 # order is only partially filled by current best order, but current best LOB order is fully filled
@@ -459,16 +447,8 @@ class Orderbook_half:
                                 add_tapeitem(tape_events, pool_id, 'Trade', time, price, qty, tid_from, tid_to, verbose)
 
                                 # the best LOB order is fully consumed: delete it from LOB and from order-list
+                                self.book_consume_best(qty)
                                 del(self.orders[best_lob_order_oid])
-                                del(best_lob_orders[0])
-
-                                # check: are there other remaining orders at this price?
-                                if len(best_lob_orders) > 0:
-                                        # yes
-                                        self.lob[0][1] = best_lob_orders
-                                else:
-                                        # no
-                                        del (self.lob[0])  # consumed the last order on the LOB at this price
 
                                 qty_remaining = qty_remaining - qty
                                 if verbose: print('New LOB=%s orders=%s' % (str(self.lob), str(self.orders)))
@@ -503,6 +483,250 @@ class Orderbook_half:
                 return {"TraderMsgs":msg_list, "TapeEvents":tape_events}
 
 
+        # level-access helpers used by book_take(): a different backend for the book only needs to override these
+
+        def book_is_empty(self):
+                # is this side of the book empty?
+                return len(self.lob) == 0
+
+
+        def book_levels(self):
+                # the price levels, as (price, total qty), from the best price to the worst
+                for level in self.lob_anon:
+                        yield (level[0], level[1])
+
+
+        def book_best(self):
+                # the best price, and the [time, qty, tid, orderid] item for the order at the front of its queue
+                return (self.lob[0][0], self.lob[0][1][0])
+
+
+        def book_consume_best(self, qty):
+                # take qty off the order at the front of the queue at the best price, deleting it if none left
+                # NB only changes the lob: the caller updates the order-list, and build_lob() is called once book_take() is done
+                best_lob_orders = self.lob[0][1]
+                best_lob_orders[0][1] -= qty
+                if best_lob_orders[0][1] <= 0:
+                        del(best_lob_orders[0])
+                        if len(best_lob_orders) == 0:
+                                del(self.lob[0])  # consumed the last order on the LOB at this price
+
+
+
+# Orderbook_half_ladder is an alternative backend for one side of the book, selected by setting lob_backend='ladder'
+# Prices are bounded, so instead of rebuilding & re-sorting the whole LOB on every change, it keeps a dense
+# "tick ladder": one slot per tick between the system min and max prices, each slot holding a queue of
+# the orders at that price (in arrival order), plus a pointer to the slot holding the current best price.
+# The non-empty slots are also marked in a bitmap (a Python int, bit n set if slot n has orders in it), so that when
+# the best slot empties the next best is found from the bitmap's highest/lowest set bit rather than by walking ticks.
+# Adding, cancelling, and (partially) filling an order then costs O(1) amortized, and the lob and lob_anon lists are
+# only built, on demand, when something reads them after the book has changed.
+# NB inherits from object as well as Orderbook_half so that the lob and lob_anon properties work in Python 2.
+
+class Orderbook_half_ladder(Orderbook_half, object):
+
+        def __init__(self, booktype, worstprice, minprice, maxprice):
+
+                self.min_price = minprice
+                self.max_price = maxprice
+                n_slots = int((maxprice - minprice) / ticksize) + 1
+                # each slot is a list of [time, qty, tid, orderid] items, in arrival order
+                self.ladder = [[] for slot in range(n_slots)]
+                # total quantity resting in each slot
+                self.ladder_qty = [0] * n_slots
+                # index of the slot holding the best price, or None if this side of the book is empty
+                self.best_slot = None
+                # number of non-empty slots, and the bitmap marking which they are
+                self.n_levels = 0
+                self.level_bits = 0
+                # cached lob and lob_anon, rebuilt lazily: None means "needs rebuilding"
+                self.lob_cache = None
+                self.lob_anon_cache = None
+
+                Orderbook_half.__init__(self, booktype, worstprice)
+
+                self.n_orders = 0
+
+
+        # the lob, as a list of [price, orderlist], sorted best price first -- built only when read
+        # NB the ladder is the master copy of the book, so assigning to lob or lob_anon just forces a rebuild
+        def get_lob(self):
+                if self.lob_cache is None:
+                        self.lob_cache = []
+                        for slot in self.ladder_slots():
+                                self.lob_cache.append([self.slot_price(slot), [list(item) for item in self.ladder[slot]]])
+                return self.lob_cache
+
+        def set_lob(self, lob):
+                self.lob_cache = None
+
+        lob = property(get_lob, set_lob)
+
+
+        # the anonymized lob, as a list of [price, qty], sorted best price first -- built only when read
+        def get_lob_anon(self):
+                if self.lob_anon_cache is None:
+                        self.lob_anon_cache = []
+                        for slot in self.ladder_slots():
+                                self.lob_anon_cache.append([self.slot_price(slot), self.ladder_qty[slot]])
+                return self.lob_anon_cache
+
+        def set_lob_anon(self, lob_anon):
+                self.lob_anon_cache = None
+
+        lob_anon = property(get_lob_anon, set_lob_anon)
+
+
+        def slot_price(self, slot):
+                return self.min_price + slot * ticksize
+
+
+        def price_slot(self, price):
+                # which slot does this price go in? the ladder is extended if the price is above its current top
+                if price < self.min_price:
+                        sys.exit('Fail: Orderbook_half_ladder given price=%s below min_price=%s' % (price, self.min_price))
+                slot = int((price - self.min_price) / ticksize)
+                if slot >= len(self.ladder):
+                        n_extra = slot + 1 - len(self.ladder)
+                        self.ladder.extend([[] for extra in range(n_extra)])
+                        self.ladder_qty.extend([0] * n_extra)
+                        self.max_price = self.slot_price(slot)
+                return slot
+
+
+        def slot_is_better(self, slot1, slot2):
+                # is the price at slot1 better than the price at slot2?
+                if self.booktype == 'Bid':
+                        return slot1 > slot2
+                else:
+                        return slot1 < slot2
+
+
+        # generator for the non-empty slots, from the best price to the worst: read off the bitmap's set bits
+        def ladder_slots(self):
+                bits = self.level_bits
+                if self.booktype == 'Bid':
+                        while bits:
+                                slot = bits.bit_length() - 1
+                                bits ^= 1 << slot
+                                yield slot
+                else:
+                        while bits:
+                                low_bit = bits & -bits
+                                bits ^= low_bit
+                                yield low_bit.bit_length() - 1
+
+
+        def ladder_changed(self):
+                # after any change to the ladder: update best price & order count, and flag the lazy lob copies as stale
+                if self.n_levels > 0:
+                        self.best_price = self.slot_price(self.best_slot)
+                else:
+                        self.best_slot = None
+                        self.best_price = None
+                self.n_orders = len(self.orders)
+                self.lob_cache = None
+                self.lob_anon_cache = None
+
+
+        def ladder_add(self, order):
+                # put the order on the back of the queue in its slot
+                slot = self.price_slot(int(order.price))
+                queue = self.ladder[slot]
+                item = [order.time, order.qty, order.tid, order.orderid]
+                if len(queue) == 0 or queue[-1] <= item:
+                        queue.append(item)
+                else:
+                        # out-of-sequence timestamp: keep the queue sorted the same way build_lob() does
+                        bisect.insort(queue, item)
+                if self.ladder_qty[slot] == 0:
+                        self.n_levels += 1
+                        self.level_bits |= 1 << slot
+                self.ladder_qty[slot] += order.qty
+                if self.best_slot is None or self.slot_is_better(slot, self.best_slot):
+                        self.best_slot = slot
+
+
+        def ladder_remove(self, slot, position, qty):
+                # take qty off the order at the given position in the slot's queue, deleting it if none left
+                queue = self.ladder[slot]
+                queue[position][1] -= qty
+                if queue[position][1] <= 0:
+                        del(queue[position])
+                self.ladder_qty[slot] -= qty
+                if len(queue) == 0:
+                        self.ladder_qty[slot] = 0
+                        self.n_levels -= 1
+                        self.level_bits &= ~(1 << slot)
+                        if slot == self.best_slot:
+                                self.ladder_next_best()
+
+
+        def ladder_next_best(self):
+                # the best slot has been emptied: the new best is the highest (bids) or lowest (asks) non-empty slot
+                if self.level_bits == 0:
+                        self.best_slot = None
+                elif self.booktype == 'Bid':
+                        self.best_slot = self.level_bits.bit_length() - 1
+                else:
+                        self.best_slot = (self.level_bits & -self.level_bits).bit_length() - 1
+
+
+        def build_lob(self, verbose):
+                # the ladder is maintained incrementally, so there's nothing to rebuild: just refresh the summary stats
+                self.ladder_changed()
+                if verbose: print(self.lob_anon)
+
+
+        def book_add(self, order, verbose):
+                # add an order to the master list holding the orders, and to the ladder
+                if verbose: print('>book_add %s' % (order))
+                old_order = self.orders.get(order.orderid)
+                if old_order is not None:
+                        # replacing an order with the same orderid: take the old one off the ladder first
+                        slot = self.price_slot(int(old_order.price))
+                        for position in range(len(self.ladder[slot])):
+                                if self.ladder[slot][position][3] == order.orderid:
+                                        self.ladder_remove(slot, position, self.ladder[slot][position][1])
+                                        break
+                self.orders[order.orderid] = order
+                self.ladder_add(order)
+                self.ladder_changed()
+                return None #null response
+
+
+        def book_CAN(self, time, order, pool_id, verbose):
+                # delete (CANcel) an order: take it off the ladder here, the rest is done by Orderbook_half.book_CAN()
+                oid = order.orderid
+                live_order = self.orders.get(oid)
+                if live_order is not None:
+                        slot = self.price_slot(int(live_order.price))
+                        for position in range(len(self.ladder[slot])):
+                                if self.ladder[slot][position][3] == oid:
+                                        self.ladder_remove(slot, position, self.ladder[slot][position][1])
+                                        break
+                return Orderbook_half.book_CAN(self, time, order, pool_id, verbose)
+
+
+        # level-access helpers for Orderbook_half.book_take(), working directly on the ladder
+
+        def book_is_empty(self):
+                return self.n_levels == 0
+
+
+        def book_levels(self):
+                for slot in self.ladder_slots():
+                        yield (self.slot_price(slot), self.ladder_qty[slot])
+
+
+        def book_best(self):
+                return (self.slot_price(self.best_slot), self.ladder[self.best_slot][0])
+
+
+        def book_consume_best(self, qty):
+                self.ladder_remove(self.best_slot, 0, qty)
+
+
 
 # Orderbook for a single instrument: list of bids and list of asks and methods to manipulate them
 
@@ -511,8 +735,12 @@ class Orderbook(Orderbook_half):
 
         def __init__(self, id_string):
                 self.idstr = id_string          # give it a name
-                self.bids = Orderbook_half('Bid', bse_sys_minprice)
-                self.asks = Orderbook_half('Ask', bse_sys_maxprice)
+                if lob_backend == 'ladder':
+                        self.bids = Orderbook_half_ladder('Bid', bse_sys_minprice, bse_sys_minprice, bse_sys_maxprice)
+                        self.asks = Orderbook_half_ladder('Ask', bse_sys_maxprice, bse_sys_minprice, bse_sys_maxprice)
+                else:
+                        self.bids = Orderbook_half('Bid', bse_sys_minprice)
+                        self.asks = Orderbook_half('Ask', bse_sys_maxprice)
                 self.ob_tape = []               # tape of just this orderbook's activities (may be consolidated at Exchange level)
                 self.last_trans_t = None        # time of last transaction
                 self.last_trans_p = None        # price of last transaction
@@ -553,14 +781,11 @@ class Orderbook(Orderbook_half):
         def add_lim_order(self, order, verbose):
                 # add a LIM order to the LOB and update records
                 if verbose: print('>add_lim_order: order.orderid=%d' % (order.orderid))
+                # NB book_add() updates the best price
                 if order.otype == 'Bid':
                         response=self.bids.book_add(order, verbose)
-                        best_price = self.bids.lob_anon[0][0]
-                        self.bids.best_price = best_price
                 else:
                         response=self.asks.book_add(order, verbose)
-                        best_price = self.asks.lob_anon[0][0]
-                        self.asks.best_price = best_price
                 return response
 
 
@@ -647,18 +872,18 @@ class Orderbook(Orderbook_half):
                 # does the LIM price cross the spread?
 
                 if order.otype == 'Bid':
-                        if len(self.asks.lob) > 0 and oprice >= self.asks.lob[0][0]:
+                        if len(self.asks.orders) > 0 and oprice >= self.asks.best_price:
                                 # crosses: this LIM bid lifts the best ask, so treat as IOC
-                                if verbose: print("Bid LIM $%s lifts best ask ($%s) =>IOC" % (oprice, self.asks.lob[0][0]))
+                                if verbose: print("Bid LIM $%s lifts best ask ($%s) =>IOC" % (oprice, self.asks.best_price))
                                 order.ostyle = 'IOC'
                                 response = self.process_order_take(time, order, verbose)
                         else:
                                 response = process_LIM(order, verbose)
 
                 elif order.otype == 'Ask':
-                        if len(self.bids.lob) > 0 and oprice <= self.bids.lob[0][0]:
+                        if len(self.bids.orders) > 0 and oprice <= self.bids.best_price:
                                 # crosses: this LIM ask hits the best bid, so treat as IOC
-                                if verbose: print("Ask LIM $%s hits best bid ($%s) =>IOC" % (oprice, self.bids.lob[0][0]))
+                                if verbose: print("Ask LIM $%s hits best bid ($%s) =>IOC" % (oprice, self.bids.best_price))
                                 order.ostyle = 'IOC'
                                 response = self.process_order_take(time, order, verbose)
                         else:
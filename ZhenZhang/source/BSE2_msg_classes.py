@@ -23,7 +23,10 @@ class Assignment:
 # has a trader id, a type (buy/sell), a style (LIM, MKT, etc), a price,
 # a quantity, a timestamp, and a unique i.d.
 # The order-style may require additional parameters which are bundled into style_params (=None if not)
-class Order:
+class Order(object):
+
+        # orders are created in huge numbers, so they have fixed slots rather than a per-instance __dict__
+        __slots__ = ('tid', 'otype', 'ostyle', 'price', 'qty', 'time', 'endtime', 'orderid', 'myref', 'styleparams')
 
         def __init__(self, trader_id, otype, ostyle, price, qty, time, endtime, orderid):
                 self.tid = trader_id    # trader i.d.
@@ -3,11 +3,12 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import csv
+from dump_files import open_dump
 from pylab import *
 # Fixing random state for reproducibility
 np.random.seed(19680801)
 
-csv_file = open("../Mybalances.csv","r")
+csv_file = open_dump("../Mybalances.csv")
 csv_reader = csv.reader(csv_file);
 
 y1 = []
@@ -0,0 +1,59 @@
+# Opening market-session output files for analysis, whether or not they were written compressed.
+# BSE can compress its output files as it writes them (gzip, bz2 or lzma, named e.g. Mybalances.csv.gz):
+# open_dump() opens a compressed file and decompresses it as it's read, so the analysis scripts needn't care.
+
+import sys
+import os
+import gzip
+import bz2
+
+try:
+    import lzma
+except ImportError:
+    # Python 2 has no lzma module
+    lzma = None
+
+# the first bytes of each kind of compressed file, and the suffix BSE adds to the file name
+compressed_formats = [(b'\x1f\x8b', '.gz', 'gzip'),
+                      (b'BZh', '.bz2', 'bz2'),
+                      (b'\xfd7zXZ\x00', '.xz', 'lzma')]
+
+
+def open_dump(fname):
+    """
+    Open an output file for reading, as text, decompressing it if it's compressed.
+    If there's no file called fname but there is a compressed version of it (fname + '.gz' etc.), that's opened.
+    :param fname: the name of the file, e.g. "../Mybalances.csv"
+    :return: the open file, ready for csv.reader() or for reading line by line.
+    """
+    if not os.path.exists(fname):
+        for (magic, suffix, compression) in compressed_formats:
+            if os.path.exists(fname + suffix):
+                fname = fname + suffix
+                break
+    dump_file = open(fname, 'rb')
+    magic_bytes = dump_file.read(6)
+    dump_file.close()
+
+    compression = None
+    for (magic, suffix, name) in compressed_formats:
+        if magic_bytes.startswith(magic):
+            compression = name
+
+    if sys.version_info[0] < 3:
+        # Python 2's csv module reads byte-strings; NB its bz2 module only reads the first chunk of a BSE file
+        if compression == 'gzip':
+            return gzip.open(fname, 'rb')
+        elif compression == 'bz2':
+            return bz2.BZ2File(fname, 'rb')
+        elif compression == 'lzma':
+            sys.exit('FAIL: reading lzma-compressed %s needs Python 3' % fname)
+        return open(fname, 'r')
+
+    if compression == 'gzip':
+        return gzip.open(fname, 'rt')
+    elif compression == 'bz2':
+        return bz2.open(fname, 'rt')
+    elif compression == 'lzma':
+        return lzma.open(fname, 'rt')
+    return open(fname, 'r')
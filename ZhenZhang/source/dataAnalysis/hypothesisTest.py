@@ -3,7 +3,8 @@
 
 import scipy.stats as stats
 import csv
-csv_file = open("../Mybalances.csv","r")
+from dump_files import open_dump
+csv_file = open_dump("../Mybalances.csv")
 csv_reader = csv.reader(csv_file);
 
 y1 = []
@@ -2,6 +2,7 @@
 
 from matplotlib import pyplot as plot
 import csv
+from dump_files import open_dump
 import random
 
 
@@ -9,7 +10,7 @@ import random
 
 
 
-csv_file = open("../Mybalances.csv","r")
+csv_file = open_dump("../Mybalances.csv")
 csv_reader = csv.reader(csv_file);
 
 y1 = []
@@ -0,0 +1,145 @@
+"""
+Regression checks for BSE.py: run with pytest from this directory.
+"""
+
+import random
+
+import pytest
+
+import BSE
+
+
+def quiet_flags(**dump):
+    """ dumpfile_flags with every output switched off, except for those given as keyword arguments """
+    flags = {'dump_blotters': False, 'dump_lobs': False, 'dump_strats': False, 'dump_avgbals': False,
+             'dump_tape': False}
+    flags.update(dump)
+    return flags
+
+
+def order_schedule(end_time):
+    """ A simple fixed, periodic supply/demand schedule """
+    schedule = [{'from': 0, 'to': end_time, 'ranges': [(50, 150)], 'stepmode': 'fixed'}]
+    return {'sup': schedule, 'dem': schedule, 'interval': 30, 'timemode': 'periodic'}
+
+
+def blotter_counts(fname):
+    """ The number of trades in each trader's blotter, read from a _blotters.csv file """
+    counts = {}
+    with open(fname, 'r') as blotters:
+        for line in blotters:
+            fields = [field.strip() for field in line.split(',')]
+            if len(fields) == 2:
+                counts[fields[0]] = int(fields[1])
+    return counts
+
+
+def test_proptraders_trade_with_event_engine(tmp_path, monkeypatch):
+    """ PT1/PT2 give themselves orders in respond(): the event engine must wake them to work those orders """
+    monkeypatch.chdir(tmp_path)
+    traders_spec = {'sellers': [('ZIC', 10)], 'buyers': [('ZIC', 10)],
+                    'proptraders': [('PT1', 2, {'bid_percent': 0.95, 'ask_delta': 7}),
+                                    ('PT2', 2, {'n_past_trades': 25})]}
+    pt_trades = {}
+    for engine in ['timestep', 'event']:
+        pt_trades[engine] = 0
+        for seed in [1, 2, 3]:
+            random.seed(seed)
+            sess_id = '%s_%d' % (engine, seed)
+            BSE.market_session(sess_id, 0, 600, traders_spec, order_schedule(600), quiet_flags(dump_blotters=True),
+                               False, engine=engine)
+            counts = blotter_counts(sess_id + '_blotters.csv')
+            pt_trades[engine] += sum(n for (tid, n) in counts.items() if tid.startswith('P'))
+
+    assert pt_trades['timestep'] > 0
+    # the two engines have the same statistical dynamics, so the PTs should trade about as much with either
+    assert 0.5 * pt_trades['timestep'] <= pt_trades['event'] <= 2.0 * pt_trades['timestep']
+
+
+def test_trader_registry_by_type_and_side():
+    """ TraderRegistry looks traders up by type and by side, and picks them at random from its tid array """
+    random.seed(1)
+    traders = BSE.TraderRegistry()
+    traders_spec = {'sellers': [('ZIC', 3), ('GVWY', 2)], 'buyers': [('ZIP', 4)],
+                    'proptraders': [('PT2', 1, {'n_past_trades': 25})]}
+    BSE.populate_market(traders_spec, traders, True, False)
+    traders.build_index()
+
+    assert sorted(t.tid for t in traders.on_side('B')) == ['B%02d' % i for i in range(4)]
+    assert sorted(t.tid for t in traders.on_side('S')) == ['S%02d' % i for i in range(5)]
+    assert [t.tid for t in traders.on_side('P')] == ['P00']
+    assert traders.on_side('X') == []
+    assert all(t.ttype == 'ZIP' for t in traders.on_side('B'))
+
+    assert sorted(t.ttype for t in traders.of_types(['ZIC', 'GVWY'])) == ['GVWY'] * 2 + ['ZIC'] * 3
+    # of_types() and on_side() both give the traders in index order
+    for selection in [traders.of_types(['ZIC', 'GVWY', 'ZIP']), traders.on_side('S')]:
+        indexes = [traders.tid_index[t.tid] for t in selection]
+        assert indexes == sorted(indexes)
+
+    for _ in range(20):
+        assert traders.random_tid() in traders
+
+
+def test_type_aggregates_count_every_trade(tmp_path, monkeypatch):
+    """ TypeAggregates counts every trade done by each type, including those by PTs and by ZIPSH across strategies """
+    monkeypatch.chdir(tmp_path)
+    recorded = []
+
+    class RecordedAggregates(BSE.TypeAggregates):
+        def __init__(self, traders):
+            self.traders = list(traders.values())
+            super().__init__(traders)
+            recorded.append(self)
+
+        def add_trader(self, trader):
+            if trader.ttype == 'ZIPSH':
+                # switch strategy every few minutes, so that load_strat() resets n_trades within the session
+                trader.strat_wait_time = 300
+                trader.strat_eval_time = trader.k * trader.strat_wait_time
+            super().add_trader(trader)
+
+    monkeypatch.setattr(BSE, 'TypeAggregates', RecordedAggregates)
+    random.seed(4)
+    traders_spec = {'sellers': [('ZIC', 5), ('ZIPSH', 5, {'k': 4})], 'buyers': [('GVWY', 5), ('ZIPSH', 5, {'k': 4})],
+                    'proptraders': [('PT1', 2, {'bid_percent': 0.95, 'ask_delta': 7})]}
+    BSE.market_session('aggs', 0, 1800, traders_spec, order_schedule(1800), quiet_flags(), False)
+
+    type_aggs = recorded[0]
+    blotter_trades = {}
+    for trader in type_aggs.traders:
+        assert len(trader.blotter) < trader.blotter_length
+        blotter_trades[trader.ttype] = blotter_trades.get(trader.ttype, 0) + len(trader.blotter)
+    assert blotter_trades['ZIPSH'] > 0 and blotter_trades['PT1'] > 0
+    # at least one ZIPSH trader has traded before its latest strategy switch, which reset its own n_trades
+    assert any(t.n_trades < len(t.blotter) for t in type_aggs.traders if t.ttype == 'ZIPSH')
+    assert {ttype: totals['n_trades'] for ttype, totals in type_aggs.types.items()} == blotter_trades
+
+
+def test_run_trials_merges_column_stores(tmp_path, monkeypatch):
+    """ run_trials() merges trials written as ColumnStores into the same files as trials written as CSV """
+    traders_spec = {'sellers': [('ZIC', 5)], 'buyers': [('ZIC', 5)]}
+    flags = quiet_flags(dump_blotters=True, dump_lobs=True, dump_avgbals=True, dump_tape=True)
+    for (output_format, trial_flags) in [('csv', flags), ('columns', dict(flags, output_format='columns'))]:
+        # the same trial i.d.s give the same seeds, so the two sets of trials only differ in their output format
+        (tmp_path / output_format).mkdir()
+        monkeypatch.chdir(tmp_path / output_format)
+        trials = [['trial_%d' % n, trial_flags] for n in range(2)]
+        BSE.run_trials(trials, 0, 300, traders_spec, order_schedule(300), 7, n_workers=1, merged_id='merged')
+
+    for suffix in ['_avg_balance.csv', '_tape.csv', '_blotters.csv', '_LOB_frames.csv']:
+        csv_merged = (tmp_path / 'csv' / ('merged' + suffix)).read_text()
+        assert csv_merged.count('trial_1') > 0
+        assert (tmp_path / 'columns' / ('merged' + suffix)).read_text() == csv_merged
+    # only the outputs the trials were asked for are merged
+    assert not (tmp_path / 'csv' / 'merged_strats.csv').exists()
+
+
+def test_run_trials_refuses_to_merge_lob_deltas(tmp_path, monkeypatch):
+    """ run_trials() fails before running any trial if it's asked to merge delta-encoded LOB frames """
+    monkeypatch.chdir(tmp_path)
+    trials = [['delta_0', quiet_flags(dump_lobs=True, lob_frames='delta')]]
+    with pytest.raises(SystemExit):
+        BSE.run_trials(trials, 0, 300, {'sellers': [('ZIC', 5)], 'buyers': [('ZIC', 5)]}, order_schedule(300), 7,
+                       n_workers=1, merged_id='delta')
+    assert not (tmp_path / 'delta_0_LOB_deltas.csv').exists()